@@ -0,0 +1,65 @@
+'''
+Benchmark the wire codecs.
+
+Compares the payload size and the encode/decode time of serialized TaskUnits
+(as sent by the master) and their results with each codec.
+
+Run from the root of the repository:
+
+    python benchmarks/bench_codec.py
+'''
+# Standard imports
+import argparse
+import os
+import sys
+import timeit
+
+# Set environment variable.
+sys.path.append(os.getcwd())
+
+# Custom imports
+import codec
+import taskunit
+
+
+def payloads():
+    '''Generate (name, serialized message) pairs to benchmark.
+    '''
+    attrs = ['id', 'job_id', 'data', 'retries', 'processor_digest']
+    tu = taskunit.TaskUnit(id='d41d8cd98f00b204e9800998ecf8427e',
+                           job_id='d41d8cd98f00b204e9800998ecf8427e')
+    tu.processor_digest = 'd41d8cd98f00b204e9800998ecf8427e'
+
+    tu.data = 'the quick brown fox jumps over the lazy dog'
+    yield ('str data', tu.serialize(include_attrs=attrs))
+    tu.data = list(range(1000))
+    yield ('int list', tu.serialize(include_attrs=attrs))
+    tu.data = [i / 7 for i in range(1000)]
+    yield ('float list', tu.serialize(include_attrs=attrs))
+    tu.data = os.urandom(64 * 1024)
+    yield ('64K bytes', tu.serialize(include_attrs=attrs))
+
+
+def main(number):
+    for name, msg in payloads():
+        for c in (codec.JSON, codec.PICKLE):
+            try:
+                payload = c.encode(msg)
+            except TypeError:
+                print('%-10s %-8s can not encode' % (name, c.NAME))
+                continue
+            encode_time = min(timeit.repeat(lambda: c.encode(msg),
+                                            number=number, repeat=3))
+            decode_time = min(timeit.repeat(lambda: c.decode(payload),
+                                            number=number, repeat=3))
+            print('%-10s %-8s %8d bytes  encode: %8.2f us  decode: %8.2f us' %
+                  (name, c.NAME, len(payload), encode_time / number * 1e6,
+                   decode_time / number * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the codecs.')
+    parser.add_argument('--number', '-n', type=int, default=1000,
+                        help='the number of times to encode each message')
+    args = parser.parse_args()
+    main(args.number)
@@ -0,0 +1,78 @@
+'''
+Benchmark the heap used by the scheduler.
+
+Runs the scheduler's hot path (take the least loaded machine and put it back
+with more load) on utils.heap.Heap and on utils.heap.IndexedHeap for
+different numbers of machines. Heap.pop is O(n), so it's only run for up to
+--max-heap-ops operations; the time per operation is what's compared.
+
+Run from the root of the repository:
+
+    python benchmarks/bench_heap.py
+    python benchmarks/bench_heap.py --machines 10000 --ops 10000000
+'''
+# Standard imports
+import argparse
+import os
+import random
+import sys
+import time
+
+# Set environment variable.
+sys.path.append(os.getcwd())
+
+# Custom imports
+from utils.heap import Heap, IndexedHeap
+
+
+def bench_heap(machines, ops, sizes):
+    '''Schedule ops jobs on machines with Heap.
+    '''
+    heap = Heap([(i, 0) for i in range(machines)], key=lambda x: x[1])
+    start = time.perf_counter()
+    for size in sizes[:ops]:
+        machine, load = heap.pop()
+        heap.push((machine, load + size))
+
+    return time.perf_counter() - start
+
+
+def bench_indexed_heap(machines, ops, sizes):
+    '''Schedule ops jobs on machines with IndexedHeap.
+    '''
+    heap = IndexedHeap()
+    handles = [heap.push(i, 0) for i in range(machines)]
+    start = time.perf_counter()
+    for size in sizes[:ops]:
+        machine, load = heap.peek()
+        handles[machine] = heap.update(handles[machine], load + size)
+
+    return time.perf_counter() - start
+
+
+def main(machine_counts, ops, max_heap_ops):
+    rand = random.Random(0)
+    sizes = [rand.randint(1, 10) for _ in range(ops)]
+    for machines in machine_counts:
+        heap_ops = min(ops, max_heap_ops)
+        heap_time = bench_heap(machines, heap_ops, sizes)
+        indexed_time = bench_indexed_heap(machines, ops, sizes)
+        print('%6d machines  Heap: %9.3f us/op (%d ops)  '
+              'IndexedHeap: %7.3f us/op (%d ops)  speedup: %.1fx' %
+              (machines, heap_time / heap_ops * 1e6, heap_ops,
+               indexed_time / ops * 1e6, ops,
+               (heap_time / heap_ops) / (indexed_time / ops)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the heaps.')
+    parser.add_argument('--machines', '-m', type=str,
+                        default='10,100,1000,10000',
+                        help='comma separated numbers of machines')
+    parser.add_argument('--ops', '-n', type=int, default=1000000,
+                        help='the number of jobs to schedule (up to 10M)')
+    parser.add_argument('--max-heap-ops', type=int, default=100000,
+                        help='the most jobs to schedule with Heap')
+    args = parser.parse_args()
+    main([int(m) for m in args.machines.split(',')], args.ops,
+         args.max_heap_ops)
@@ -0,0 +1,119 @@
+'''
+Compare the schedulers on simulated workloads.
+
+Runs each workload on a simulated cluster with each scheduler (see
+``simulate``) and reports the makespan, the mean and p99 latency of the
+taskunits, how busy the slaves were and the CPU time spent in the scheduler
+for each taskunit it scheduled. The times are in (simulated) seconds of work
+on a slave of speed 1.
+
+Run from the root of the repository:
+
+    python benchmarks/bench_schedule.py
+    python benchmarks/bench_schedule.py --units 100000 --speeds 1,1,2,4 \
+        --sizes pareto --arrivals poisson --rate 5 --failure-rates 0,0.1
+    python benchmarks/bench_schedule.py --workload recorded.jsonl
+'''
+# Standard imports
+import argparse
+import os
+import sys
+
+# Set environment variable.
+sys.path.append(os.getcwd())
+
+# Custom imports
+import schedule
+import simulate
+
+# The schedulers to compare, by name: (scheduler class, batch).
+SCHEDULERS = {
+    'minmakespan': (schedule.MinMakespan, False),
+    'lpt': (schedule.MinMakespan, True),
+    'roundrobin': (schedule.RoundRobin, False),
+}
+
+
+def cycle(values, count):
+    '''Repeat the list of values up to count values.
+    '''
+    return [values[i % len(values)] for i in range(count)]
+
+
+def main(args):
+    if args.workload:
+        workload = simulate.Workload.load(args.workload,
+                                          estimate_error=args.estimate_error,
+                                          seed=args.seed)
+    else:
+        workload = simulate.Workload.synthetic(
+            args.units, sizes=args.sizes, arrivals=args.arrivals,
+            rate=args.rate, estimate_error=args.estimate_error,
+            seed=args.seed)
+    speeds = [float(speed) for speed in args.speeds.split(',')]
+    failure_rates = [float(rate) for rate in args.failure_rates.split(',')]
+    cluster = simulate.Cluster(cycle(speeds, args.machines),
+                               cycle(failure_rates, args.machines),
+                               max_inflight=args.max_inflight,
+                               seed=args.seed)
+
+    print('%d units on %d machines' % (len(workload), len(cluster)))
+    print('%-12s %10s %10s %10s %6s %12s %8s' %
+          ('scheduler', 'makespan', 'mean lat', 'p99 lat', 'util',
+           'us/decision', 'failures'))
+    for name in args.schedulers.split(','):
+        scheduler_class, batch = SCHEDULERS[name]
+        if batch and not workload.known():
+            print('%-12s (only for workloads that all come in at the start)'
+                  % name)
+            continue
+        simulator = simulate.Simulator(workload, cluster, scheduler_class(),
+                                       batch=batch,
+                                       max_retries=args.max_retries)
+        result = simulator.run().summary()
+        print('%-12s %10.2f %10.2f %10.2f %6.2f %12.2f %8d' %
+              (name, result['makespan'], result['mean_latency'],
+               result['p99_latency'], result['utilization'],
+               result['time_per_decision'] * 1e6, result['failures']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the schedulers on '
+                                                 'simulated workloads.')
+    parser.add_argument('--schedulers', default=','.join(SCHEDULERS),
+                        help='comma separated schedulers to compare '
+                             '(default: %(default)s)')
+    parser.add_argument('--workload',
+                        help='a recorded workload to replay (a JSON object '
+                             'with "size" and optionally "arrival" and '
+                             '"estimate" on each line) instead of a '
+                             'synthetic one')
+    parser.add_argument('--units', '-n', type=int, default=10000,
+                        help='the number of units in a synthetic workload')
+    parser.add_argument('--sizes', choices=simulate.Workload.SIZES,
+                        default='uniform',
+                        help='the sizes of the units in a synthetic workload')
+    parser.add_argument('--arrivals', choices=simulate.Workload.ARRIVALS,
+                        default='batch',
+                        help='when the units of a synthetic workload come in')
+    parser.add_argument('--rate', type=float, default=10,
+                        help='units per second for poisson arrivals')
+    parser.add_argument('--estimate-error', type=float, default=0,
+                        help='how far off the size estimates are (standard '
+                             'deviation of the log of the error factor)')
+    parser.add_argument('--machines', '-m', type=int, default=8,
+                        help='the number of slaves')
+    parser.add_argument('--speeds', default='1,2',
+                        help='comma separated speeds of the slaves '
+                             '(repeated for all of them)')
+    parser.add_argument('--failure-rates', default='0',
+                        help='comma separated chances of the slaves failing '
+                             'a unit (repeated for all of them)')
+    parser.add_argument('--max-inflight', type=int, default=64,
+                        help='the number of units each slave can have in '
+                             'flight at any time')
+    parser.add_argument('--max-retries', type=int, default=3,
+                        help='how many times a unit that fails is sent again')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the seed for the random numbers')
+    main(parser.parse_args())
@@ -0,0 +1,73 @@
+'''
+Microbenchmark for Serializable.serialize.
+
+Compares serializing TaskUnits and Jobs with the per-class schema cache warm
+against having it cleared before every call (which is what every call used to
+cost: walking dir() and reading the methods' source).
+
+Run from the root of the repository:
+
+    python benchmarks/bench_serialize.py
+'''
+# Standard imports
+import argparse
+import os
+import sys
+import timeit
+
+# Set environment variable.
+sys.path.append(os.getcwd())
+
+# Custom imports
+import job
+import serialize
+import taskunit
+
+
+def processor(self, string):
+    return string[::-1]
+
+
+def clear_caches():
+    '''Forget all the cached schemas and method sources.
+    '''
+    serialize._schemas.clear()
+    serialize._sources.clear()
+
+
+def bench(name, serialize_fn, number):
+    '''Time serialize_fn with cold and warm caches and print the results.
+    '''
+    def cold():
+        clear_caches()
+        serialize_fn()
+
+    cold_time = min(timeit.repeat(cold, number=number, repeat=3))
+    serialize_fn()
+    warm_time = min(timeit.repeat(serialize_fn, number=number, repeat=3))
+    print('%-10s cold: %8.2f us/op  warm: %8.2f us/op  speedup: %5.1fx' %
+          (name, cold_time / number * 1e6, warm_time / number * 1e6,
+           cold_time / warm_time))
+
+
+def main(number):
+    tu = taskunit.TaskUnit(id='0', job_id='0', data='hello world',
+                           processor=processor)
+    attrs = ['id', 'job_id', 'data', 'retries', 'processor_digest']
+    bench('TaskUnit', lambda: tu.serialize(include_attrs=attrs,
+                                           json_encode=True), number)
+
+    result_attrs = ['id', 'job_id', 'state', 'result']
+    bench('Result', lambda: tu.serialize(include_attrs=result_attrs,
+                                         json_encode=True), number)
+
+    j = job.Job(input_data='hello\nworld', processor=processor)
+    bench('Job', lambda: j.serialize(json_encode=True), number // 10)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark serialization.')
+    parser.add_argument('--number', '-n', type=int, default=10000,
+                        help='the number of times to serialize each object')
+    args = parser.parse_args()
+    main(args.number)
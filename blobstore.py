@@ -0,0 +1,178 @@
+# Standard imports
+import array
+import collections
+import hashlib
+import os
+import pickle
+
+
+class BlobStore:
+    '''A store of large data (blobs) keyed by the digest of their content.
+
+    The master puts the data of large TaskUnits in a BlobStore and sends each
+    blob to each slave only once (see ``Master.send_blob``); after that the
+    TaskUnits refer to their data by its digest. The slaves keep the blobs
+    they were sent in their own BlobStore and ask the master for the ones
+    they don't have (any more) with a FETCH message.
+
+    The blobs are kept in memory up to ``max_bytes``. Past that, the least
+    recently used blobs are written out to ``spill_dir`` (or dropped if there
+    is none) and read back in the next time they are used.
+    '''
+    # The class of the message used to send a blob to a node.
+    CLASS = 'blobstore.Blob'
+    # The types of data that can be blobs and the tags that go in their
+    # digests (so that e.g. a string and its bytes don't get the same one).
+    TYPE_TAGS = ((str, b's'), (bytes, b'b'), (bytearray, b'b'),
+                 (memoryview, b'b'), (array.array, b'a'))
+
+    def __init__(self, max_bytes=None, spill_dir=None):
+        '''
+        :param max_bytes: The most bytes of blobs to keep in memory. Defaults
+        to no limit.
+        :param spill_dir: The directory to write the blobs that don't fit in
+        memory out to. It is created when it's first needed.
+        '''
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        # Map of digests to blobs in memory, least recently used first.
+        self.blobs = collections.OrderedDict()
+        self.nbytes = 0
+        # Digests of the blobs written out to spill_dir.
+        self.spilled = set()
+
+    @classmethod
+    def is_blob(cls, data):
+        '''Whether data can be a blob.
+        '''
+        return isinstance(data, tuple(t for t, _ in cls.TYPE_TAGS))
+
+    @staticmethod
+    def size(data):
+        '''Get the size of the blob in bytes (characters for strings).
+        '''
+        if isinstance(data, str):
+            return len(data)
+
+        return memoryview(data).nbytes
+
+    @classmethod
+    def compute_digest(cls, data):
+        '''Compute the digest of a blob.
+
+        The digest is the MD5 hash of the type and the content of the blob.
+        '''
+        m = hashlib.md5()
+        for blob_type, tag in cls.TYPE_TAGS:
+            if isinstance(data, blob_type):
+                m.update(tag)
+                break
+        if isinstance(data, str):
+            m.update(data.encode('utf-8'))
+        else:
+            view = memoryview(data)
+            if view.format != 'B':
+                m.update(view.format.encode('utf-8'))
+            m.update(view.cast('B') if view.c_contiguous else view.tobytes())
+
+        return m.hexdigest()
+
+    def put(self, data, digest=None):
+        '''Add a blob to the store.
+
+        :param digest: The digest of the blob, if already known.
+        :returns: The digest of the blob.
+        '''
+        if digest is None:
+            digest = self.compute_digest(data)
+        if digest in self.blobs:
+            self.blobs.move_to_end(digest)
+            return digest
+
+        self.blobs[digest] = data
+        self.nbytes += self.size(data)
+        self.evict()
+
+        return digest
+
+    def get(self, digest):
+        '''Get the blob for digest.
+
+        Raises KeyError if the blob is not in the store.
+        '''
+        try:
+            self.blobs.move_to_end(digest)
+            return self.blobs[digest]
+        except KeyError:
+            pass
+
+        if digest not in self.spilled:
+            raise KeyError(digest)
+        path = os.path.join(self.spill_dir, digest)
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        self.spilled.discard(digest)
+        os.remove(path)
+        self.put(data, digest)
+
+        return data
+
+    def discard(self, digest):
+        '''Remove the blob for digest from the store if it's there.
+        '''
+        try:
+            data = self.blobs.pop(digest)
+        except KeyError:
+            pass
+        else:
+            self.nbytes -= self.size(data)
+        if digest in self.spilled:
+            self.spilled.discard(digest)
+            os.remove(os.path.join(self.spill_dir, digest))
+
+        return
+
+    def __contains__(self, digest):
+        return digest in self.blobs or digest in self.spilled
+
+    def __len__(self):
+        return len(self.blobs) + len(self.spilled)
+
+    def digests(self):
+        '''Get the digests of all of the blobs in the store.
+        '''
+        return list(self.blobs) + list(self.spilled)
+
+    def evict(self):
+        '''Spill (or drop) the least recently used blobs until the ones in
+        memory fit in max_bytes.
+
+        The blob that was used last is always kept, even if it doesn't fit.
+        '''
+        if self.max_bytes is None:
+            return
+
+        while self.nbytes > self.max_bytes and len(self.blobs) > 1:
+            digest, data = self.blobs.popitem(last=False)
+            self.nbytes -= self.size(data)
+            if self.spill_dir is None:
+                continue
+            if isinstance(data, memoryview):
+                data = (data.tobytes() if data.format == 'B' else
+                        array.array(data.format, data))
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(os.path.join(self.spill_dir, digest), 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.spilled.add(digest)
+
+        return
+
+    @staticmethod
+    def message(digest, data):
+        '''Get the message used to send a blob to a node.
+
+        The blob is an attribute so that large ones are sent out-of-band (see
+        ``codec.PickleCodec``).
+        '''
+        return {'class': BlobStore.CLASS,
+                'attrs': {'digest': digest, 'data': data}}
@@ -0,0 +1,208 @@
+'''
+Codecs
+
+A codec turns the messages sent between nodes (serialized objects, i.e.
+dicts, lists, strings, numbers etc.) into bytes and back. Each ZMQ message
+says which codec its payload was encoded with, and the codec to use for a
+peer is negotiated when connecting (see ``ZMQMessenger.connect``). JSON is
+always supported and is used when nothing else is agreed on.
+'''
+# Standard imports
+import array
+import json
+import pickle
+
+# Custom imports
+import message
+
+
+class Codec:
+    '''Encodes and decodes messages.
+    '''
+    # The name of the codec, as sent on the wire.
+    NAME = None
+
+    def encode(self, msg):
+        '''Encode the msg to bytes.
+        '''
+        raise NotImplementedError()
+
+    def encode_frames(self, msg):
+        '''Encode the msg to bytes and a list of out-of-band buffers.
+
+        The out-of-band buffers are sent as separate frames without being
+        copied (see ``PickleCodec``). Codecs that don't support out-of-band
+        buffers return an empty list.
+
+        :returns: (payload, buffers)
+        :rtype: tuple
+        '''
+        return (self.encode(msg), [])
+
+    def pack_batch(self, encoded_msgs):
+        '''Pack a list of already encoded messages into one payload.
+        '''
+        raise NotImplementedError()
+
+    def decode(self, payload, buffers=()):
+        '''Decode a payload.
+
+        :param buffers: The out-of-band buffers that came with the payload.
+        :returns: The list of messages in the payload (more than one if the
+        payload is a batch).
+        :rtype: list
+        '''
+        raise NotImplementedError()
+
+
+class JSONCodec(Codec):
+    '''Encodes messages as JSON.
+
+    Bytes can't be encoded with this codec.
+    '''
+    NAME = 'json'
+
+    def encode(self, msg):
+        return json.dumps(msg).encode('utf-8')
+
+    def pack_batch(self, encoded_msgs):
+        return (b'{"class": "' + message.ZMQBatch.CLASS.encode('utf-8') +
+                b'", "items": [' + b', '.join(encoded_msgs) + b']}')
+
+    def decode(self, payload, buffers=()):
+        msg = json.loads(bytes(payload).decode('utf-8'))
+        if message.ZMQBatch.is_batch(msg):
+            return msg['items']
+
+        return [msg]
+
+
+class PickleCodec(Codec):
+    '''Encodes messages with pickle protocol 5.
+
+    This is a compact binary encoding that also handles bytes, tuples etc.
+    and is much cheaper to encode and decode than JSON.
+
+    Large buffers (bytes, bytearray, memoryview, array) in the attributes of
+    a serialized object (e.g. a TaskUnit's data or result) are sent
+    out-of-band by ``encode_frames``: they are not copied into the payload
+    and are decoded as (read-only) memoryviews of the received frames.
+
+    NOTE: Unpickling can run arbitrary code. This is no different to what
+    nodes already do with the code (processors etc.) they are sent, so the
+    peers must be trusted either way.
+    '''
+    NAME = 'pickle5'
+    PROTOCOL = 5
+    # Buffers at least this big are sent out-of-band.
+    OUT_OF_BAND_THRESHOLD = 64 * 1024
+
+    def encode(self, msg):
+        return pickle.dumps(to_picklable(msg), protocol=self.PROTOCOL)
+
+    def encode_frames(self, msg):
+        buffers = []
+        payload = pickle.dumps(
+            to_picklable(msg, self.OUT_OF_BAND_THRESHOLD),
+            protocol=self.PROTOCOL, buffer_callback=buffers.append)
+
+        return (payload, buffers)
+
+    def pack_batch(self, encoded_msgs):
+        return pickle.dumps((message.ZMQBatch.CLASS, encoded_msgs),
+                            protocol=self.PROTOCOL)
+
+    def decode(self, payload, buffers=()):
+        msg = pickle.loads(payload, buffers=buffers)
+        if isinstance(msg, tuple) and msg[0] == message.ZMQBatch.CLASS:
+            return [pickle.loads(encoded) for encoded in msg[1]]
+
+        return [msg]
+
+
+def typed_view(typecode, buffer):
+    '''Get a memoryview of buffer with the items of typecode.
+    '''
+    return memoryview(buffer).cast('B').cast(typecode)
+
+
+class TypedBuffer:
+    '''Pickles a typed buffer (e.g. an array) as a typed memoryview.
+
+    The raw bytes are pickled as a ``pickle.PickleBuffer`` so they can be
+    sent out-of-band. They are unpickled as a memoryview cast back to the
+    original typecode.
+    '''
+    def __init__(self, view):
+        self.view = view
+
+    def __reduce_ex__(self, protocol):
+        return (typed_view, (self.view.format, pickle.PickleBuffer(self.view)))
+
+
+def to_picklable(msg, threshold=None):
+    '''Prepare the buffers in a serialized object's attributes for pickling.
+
+    memoryviews can't be pickled as they are. If threshold is not None,
+    buffers of at least threshold bytes are wrapped so that they are pickled
+    out-of-band. A new dict is returned if anything had to change.
+    '''
+    if not isinstance(msg, dict) or not isinstance(msg.get('attrs'), dict):
+        return msg
+    attrs = None
+    for name, value in msg['attrs'].items():
+        if not isinstance(value, (bytes, bytearray, memoryview, array.array)):
+            continue
+        view = memoryview(value)
+        large = threshold is not None and view.nbytes >= threshold
+        if large and view.c_contiguous and view.format == 'B':
+            value = pickle.PickleBuffer(value)
+        elif large and view.c_contiguous:
+            value = TypedBuffer(view)
+        elif isinstance(value, memoryview):
+            value = view.tobytes() if view.format == 'B' else array.array(
+                view.format, view)
+        else:
+            continue
+        if attrs is None:
+            attrs = dict(msg['attrs'])
+        attrs[name] = value
+    if attrs is None:
+        return msg
+    msg = dict(msg)
+    msg['attrs'] = attrs
+
+    return msg
+
+
+JSON = JSONCodec()
+PICKLE = PickleCodec()
+
+# All the known codecs by name.
+CODECS = {codec.NAME: codec for codec in (JSON, PICKLE)}
+
+# The codecs supported by default, in order of preference.
+DEFAULT_CODECS = [PICKLE.NAME, JSON.NAME]
+
+
+def get(name):
+    '''Get the codec called name.
+
+    Raises KeyError for unknown codecs.
+    '''
+    return CODECS[name]
+
+
+def negotiate(ours, theirs):
+    '''Pick the codec to use with a peer.
+
+    :param ours: The names of the codecs we support, in order of preference.
+    :param theirs: The names of the codecs the peer supports.
+    :returns: The first of our codecs the peer also supports, JSON otherwise.
+    :rtype: Codec
+    '''
+    for name in ours:
+        if name in theirs and name in CODECS:
+            return CODECS[name]
+
+    return JSON
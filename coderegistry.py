@@ -0,0 +1,86 @@
+# Standard imports
+import hashlib
+
+# Custom imports
+import serialize
+
+
+class CodeRegistry:
+    '''A registry of function sources (processors etc.) keyed by digest.
+
+    The master uses a CodeRegistry to send the source of a function to each
+    slave only once; after that the function is referred to by its digest.
+    The slaves keep the sources in their own CodeRegistry and the compiled
+    functions in ``serialize.function_cache``.
+    '''
+    # The class of the message used to send code to a node.
+    CLASS = 'coderegistry.Code'
+
+    def __init__(self):
+        # Map of digests to function source.
+        self.sources = {}
+
+    @staticmethod
+    def compute_digest(source):
+        '''Compute the digest of a function's source.
+
+        The digest is the MD5 hash of the (normalized) source.
+        '''
+        m = hashlib.md5()
+        m.update(source.encode('utf-8'))
+
+        return m.hexdigest()
+
+    @staticmethod
+    def function_name(source):
+        '''Get the name of the function defined by source.
+        '''
+        return source[len('def '):source.index('(')].strip()
+
+    def add(self, source, digest=None):
+        '''Add a function's source to the registry.
+
+        :param source: The normalized source of the function (see
+        ``Serializable.serialize_method``).
+        :param digest: The digest of the source, if already known.
+        :returns: The digest of the source.
+        '''
+        if digest is None:
+            digest = self.compute_digest(source)
+        # The source for a digest never changes, so it's only replaced if
+        # it's missing.
+        if self.sources.get(digest) is None:
+            self.sources[digest] = source
+
+        return digest
+
+    def __contains__(self, digest):
+        return digest in self.sources
+
+    def get_source(self, digest):
+        '''Get the source for digest.
+
+        Raises KeyError if the digest is not in the registry.
+        '''
+        return self.sources[digest]
+
+    def get_function(self, digest):
+        '''Get the function for digest.
+
+        The function is compiled the first time and kept in the process wide
+        ``serialize.function_cache`` after that.
+
+        Raises KeyError if the digest is not in the registry.
+        '''
+        source = self.sources[digest]
+
+        return serialize.load_function(self.function_name(source), source,
+                                       digest=digest)
+
+    @staticmethod
+    def message(digest, source):
+        '''Get the message used to send source to a node.
+        '''
+        return {'class': CodeRegistry.CLASS,
+                'digest': digest,
+                'source': source}
@@ -13,7 +13,8 @@ from job import Job, Splitter, Combiner
 import messenger
 import message
 
-def enqueue_job(iszmq, jobpath, destip, destport):
+def enqueue_job(iszmq, jobpath, destip, destport, deadline=None,
+                priority=None):
     # Bind to some other port. Not to the main 33310.
     if iszmq:
         messenger_type = messenger.ZMQMessenger.TYPE_CLIENT
@@ -24,28 +25,58 @@ def enqueue_job(iszmq, jobpath, destip, destport):
     my_hostname = socket.gethostname()
     m.register_destination(my_hostname,
                            (destip, destport))
-    # This file contains at most 3 methods: split, combine, processor and
-    # at most 1 variables: input_data
+    # This file contains at most 7 methods: split, combine (or accumulate,
+    # finalize and merge), processor, reduce and at most 9 variables:
+    # input_data, chunk_bytes, chunk_time, pushdown, retries, weight,
+    # priority, deadline, known_split
     jobdir, jobfile = os.path.split(jobpath)
     job_module_name = jobfile[:-3]
     pkg = __import__(jobdir, globals(), locals(), [job_module_name], 0)
     jobcode = getattr(pkg, job_module_name)
+    reduce = getattr(jobcode, 'reduce', None)
+    combiner = Combiner(keyed=reduce is not None)
     try:
-        combiner = Combiner()
         combiner.set_combine_method(jobcode.combine)
     except:
-        combiner = None
+        pass
+    try:
+        combiner.set_accumulate_method(jobcode.accumulate,
+                                       getattr(jobcode, 'finalize', None),
+                                       getattr(jobcode, 'merge', None))
+    except:
+        pass
 
+    # The default split method can group lines into taskunits of about
+    # chunk_bytes bytes or chunk_time seconds of work.
+    # The default split gives a fixed set of taskunits, so they can all be
+    # scheduled at once. A job's own split has to say so with known_split.
+    splitter = Splitter(chunk_bytes=getattr(jobcode, 'chunk_bytes', None),
+                        chunk_time=getattr(jobcode, 'chunk_time', None),
+                        known=getattr(jobcode, 'known_split',
+                                      not hasattr(jobcode, 'split')))
     try:
-        splitter = Splitter()
         splitter.set_split_method(jobcode.split)
     except:
-        splitter = None
+        pass
 
+    # A processor declares that it can work on memoryviews (so large data
+    # isn't copied on the slaves) with:
+    #     processor.accepts_memoryview = True
+    accepts_memoryview = getattr(jobcode.processor, 'accepts_memoryview',
+                                 False)
     job = Job(processor=jobcode.processor,
               input_data=jobcode.input_data,
               splitter=splitter,
-              combiner=combiner)
+              combiner=combiner,
+              accepts_memoryview=accepts_memoryview,
+              pushdown=getattr(jobcode, 'pushdown', False),
+              reduce=reduce,
+              retries=getattr(jobcode, 'retries', 0),
+              weight=getattr(jobcode, 'weight', 1),
+              priority=(getattr(jobcode, 'priority', 0) if priority is None
+                        else priority),
+              deadline=(getattr(jobcode, 'deadline', None) if deadline is None
+                        else deadline))
     try:
         job.input_data = jobcode.input_data
     except:
@@ -77,6 +108,12 @@ if __name__ == '__main__':
     parser.add_argument('--destport',
                         type=int,
                         help='send to this destination port')
+    parser.add_argument('--deadline', type=float,
+                        help='the number of seconds the job should be done '
+                             'in (overrides the job file)')
+    parser.add_argument('--priority', type=int,
+                        help='the priority of the job; higher goes first '
+                             '(overrides the job file)')
 
     args = parser.parse_args()
     if args.zmq:
@@ -85,4 +122,5 @@ if __name__ == '__main__':
     else:
         destport = args.destport or messenger.UDPMessenger.DEFAULT_PORT
         destip = args.destip or messenger.UDPMessenger.DEFAULT_IP
-    enqueue_job(args.zmq, args.jobpath, destip, destport)
+    enqueue_job(args.zmq, args.jobpath, destip, destport, args.deadline,
+                args.priority)
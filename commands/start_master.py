@@ -7,13 +7,22 @@ import sys
 sys.path.append(os.getcwd())
 
 # Custom imports
+import codec
 import master
 import messenger
+import serialize
 
-def start_master(port):
+def start_master(port, max_inflight=master.Master.DEFAULT_MAX_INFLIGHT,
+                 batch_size=messenger.ZMQMessenger.DEFAULT_BATCH_SIZE,
+                 codecs=codec.DEFAULT_CODECS, pull=False,
+                 locality_tolerance=master.Master.DEFAULT_LOCALITY_TOLERANCE,
+                 blob_threshold=master.Master.DEFAULT_BLOB_THRESHOLD):
     '''Create and start a new master.
     '''
-    this_node = master.Master(port)
+    this_node = master.Master(port, max_inflight=max_inflight,
+                              batch_size=batch_size, codecs=codecs, pull=pull,
+                              locality_tolerance=locality_tolerance,
+                              blob_threshold=blob_threshold)
     this_node.worker()
 
 
@@ -22,8 +31,42 @@ if __name__ == '__main__':
                                                  'of a slave Node.')
     parser.add_argument('--port', '-p', type=int,
                         help='the port the master should use')
+    parser.add_argument('--max-inflight', type=int,
+                        default=master.Master.DEFAULT_MAX_INFLIGHT,
+                        help='the number of taskunits each slave can have in '
+                             'flight at any time')
+    parser.add_argument('--batch-size', type=int,
+                        default=messenger.ZMQMessenger.DEFAULT_BATCH_SIZE,
+                        help='the max number of taskunits to send to a slave '
+                             'in one message (1 disables batching)')
+    parser.add_argument('--codecs',
+                        default=','.join(codec.DEFAULT_CODECS),
+                        help='comma separated list of codecs to use with the '
+                             'slaves, in order of preference (default: '
+                             '%(default)s)')
+    parser.add_argument('--pull', action='store_true',
+                        help='only send taskunits to the slaves that ask for '
+                             'them and let idle slaves steal queued taskunits')
+    parser.add_argument('--locality-tolerance', type=float,
+                        default=master.Master.DEFAULT_LOCALITY_TOLERANCE,
+                        help='how much busier (in estimated seconds of work) '
+                             'a slave that already has the code for a '
+                             'taskunit can be than the least busy slave and '
+                             'still get it (default: %(default)s)')
+    parser.add_argument('--blob-threshold', type=int,
+                        default=master.Master.DEFAULT_BLOB_THRESHOLD,
+                        help='the size (in bytes) of the data of a taskunit '
+                             'from which on it is sent to each slave only '
+                             'once (default: %(default)s)')
+    parser.add_argument('--dump-code', action='store_true',
+                        help='write the source of all received code to '
+                             'cache_store/ (for debugging)')
 
 
     args = parser.parse_args()
+    if args.dump_code:
+        serialize.function_cache.dump_dir = 'cache_store'
     port = args.port if args.port else messenger.UDPMessenger.DEFAULT_PORT
-    start_master(port)
+    start_master(port, args.max_inflight, args.batch_size,
+                 args.codecs.split(','), args.pull, args.locality_tolerance,
+                 args.blob_threshold)
@@ -8,12 +8,13 @@ sys.path.append(os.getcwd())
 
 # Custom imports
 import messenger
+import serialize
 import slave
 
-def start_slave(port):
+def start_slave(port, workers=None):
     '''Create and start a new slave.
     '''
-    this_node = slave.Slave(port)
+    this_node = slave.Slave(port, workers=workers)
     this_node.worker()
 
 
@@ -22,8 +23,16 @@ if __name__ == '__main__':
                                                  'of a slave Node.')
     parser.add_argument('--port', '-p', type=int,
                         help='the port the slave should use')
+    parser.add_argument('--workers', '-w', type=int,
+                        help='the number of processes to run taskunits on '
+                             '(default: number of cores)')
+    parser.add_argument('--dump-code', action='store_true',
+                        help='write the source of all received code to '
+                             'cache_store/ (for debugging)')
 
 
     args = parser.parse_args()
+    if args.dump_code:
+        serialize.function_cache.dump_dir = 'cache_store'
     port = args.port if args.port is not None else messenger.UDPMessenger.DEFAULT_PORT
-    start_slave(port)
+    start_slave(port, args.workers)
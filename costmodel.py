@@ -0,0 +1,77 @@
+class CostModel:
+    '''An online model of how long processors take to run on their input.
+
+    The cost of a processor (keyed by the digest of its source, see
+    ``CodeRegistry``) is a moving average of the seconds it takes per unit of
+    input size (see ``input_size``). It is learned from the run times the
+    slaves report with the results and it's kept across jobs, so jobs that
+    are run again are scheduled with the costs learned the last time.
+
+    The estimated cost of a TaskUnit is used as its ``job_size`` by the
+    scheduler.
+    '''
+    # Weight of the latest run time in the moving average of the cost.
+    WEIGHT = 0.2
+
+    def __init__(self):
+        # Map of processor digests to seconds per unit of input size.
+        self.costs = {}
+
+    @staticmethod
+    def input_size(data):
+        '''Get the size of the data a processor runs on.
+
+        This is the length of strings, the size in bytes of buffers (bytes,
+        arrays, memoryviews etc.) and the sum of the sizes of the items of
+        lists (e.g. batched TaskUnits). It is at least 1, for the fixed cost
+        of running a TaskUnit.
+
+        :rtype: int
+        '''
+        if isinstance(data, str):
+            size = len(data)
+        elif isinstance(data, (list, tuple)):
+            size = sum(CostModel.input_size(item) for item in data)
+        else:
+            try:
+                size = memoryview(data).nbytes
+            except TypeError:
+                size = getattr(data, 'nbytes', 1)
+
+        return max(1, size)
+
+    def record(self, digest, size, run_time):
+        '''Record that the processor took run_time seconds on size input.
+
+        :param digest: The digest of the processor.
+        :param size: The input size (see ``input_size``).
+        :param run_time: The run time reported by the slave.
+        '''
+        if run_time is None:
+            return
+
+        cost = run_time / size
+        try:
+            self.costs[digest] += self.WEIGHT * (cost - self.costs[digest])
+        except KeyError:
+            self.costs[digest] = cost
+
+        return
+
+    def estimate(self, digest, size):
+        '''Estimate how long (in seconds) the processor takes on size input.
+
+        Processors that haven't been run yet are estimated at the average
+        cost of the ones that have. With nothing to go by, the estimate is 1
+        for each TaskUnit.
+
+        :rtype: float
+        '''
+        try:
+            return self.costs[digest] * size
+        except KeyError:
+            pass
+        if self.costs:
+            return sum(self.costs.values()) / len(self.costs) * size
+
+        return 1
@@ -0,0 +1,196 @@
+# Standard imports
+import collections
+import concurrent.futures
+import os
+
+# Custom imports
+import coderegistry
+import taskunit
+
+
+# The processors loaded by this (worker) process.
+code = coderegistry.CodeRegistry()
+
+
+class MissingCode(KeyError):
+    '''Raised in a worker process that doesn't have the processor of a
+    TaskUnit (and wasn't given its source).
+    '''
+    pass
+
+
+def run_taskunit(serialized, attrs, processor_source=None):
+    '''Deserialize, run and serialize back a TaskUnit.
+
+    This is the function that runs in the pool's worker processes. Doing the
+    deserialization here (instead of on the Slave's receive loop) means that
+    loading the processor is also spread across the cores.
+
+    :param serialized: The serialized TaskUnit as received from the master.
+    :param attrs: The attributes of the TaskUnit to serialize in the result.
+    :param processor_source: The source of the processor, if the TaskUnit
+    only refers to it by its digest. It's only needed the first time a
+    worker process sees the processor; without it, this raises MissingCode
+    if the worker didn't load the processor before.
+    :returns: The serialized TaskUnit after it has been run.
+    :rtype: dict
+    '''
+    tu = taskunit.TaskUnit.deserialize(serialized)
+    if tu.processor_digest is not None:
+        if processor_source is not None:
+            code.add(processor_source, tu.processor_digest)
+        elif tu.processor_digest not in code:
+            raise MissingCode(tu.processor_digest)
+        tu.set_processor(code.get_function(tu.processor_digest))
+    tu.run()
+    return tu.serialize(include_attrs=attrs)
+
+
+class TaskUnitExecutor:
+    '''Runs TaskUnits on a pool of worker processes.
+
+    TaskUnits are submitted in their serialized form and the serialized
+    results are collected as soon as they are done, in whatever order they
+    finish. The executor never has more than ``max_pending`` TaskUnits
+    submitted to the pool at any time; the rest are expected to wait on the
+    caller's task queue.
+
+    TaskUnits whose data arrived as a memoryview (i.e. a large buffer that was
+    received without being copied) would have to be copied to get to a worker
+    process. If their processor accepts memoryviews, they are run on a pool
+    of threads in this process instead, so the data is never copied.
+    Processors working on large buffers (hashlib, zlib etc.) usually release
+    the GIL, so these still run in parallel.
+    '''
+    RESULT_ATTRS = ['id', 'job_id', 'state', 'result', 'run_time']
+    # The result of a TaskUnit that is to be combined on the slave also needs
+    # these (see ``job.Partial``).
+    PARTIAL_ATTRS = RESULT_ATTRS + ['batched', 'combiner_digest']
+
+    def __init__(self, workers=None, on_done=None):
+        '''
+        :param workers: Number of worker processes. Defaults to the number of
+        cores on this machine.
+        :param on_done: Called with the future of each TaskUnit that is done,
+        from the pool's callback thread. Lets an event loop know that there
+        are results to collect with ``completed``.
+        '''
+        self.workers = workers if workers else (os.cpu_count() or 1)
+        # Keep a couple of TaskUnits per worker in the pool so that the
+        # workers don't go idle between two ticks of the Slave's loop.
+        self.max_pending = 2 * self.workers
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers)
+        self.threads = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers)
+
+        # Map of futures to the (address, serialized taskunit) they run.
+        self.running = {}
+        # Futures that are done. Appended to from the pool's callback thread.
+        self.done = collections.deque()
+        self.on_done = on_done
+
+        return
+
+    def has_capacity(self):
+        '''Whether more TaskUnits can be submitted right now.
+        '''
+        return len(self.running) < self.max_pending
+
+    def submit(self, serialized, address, processor_source=None):
+        '''Submit a serialized TaskUnit to be run on the pool.
+
+        :param serialized: The serialized TaskUnit.
+        :param address: The address of the master to send the result to.
+        :param processor_source: The source of the TaskUnit's processor if it
+        is only referred to by digest. It is only sent to the worker if the
+        worker doesn't have the processor yet (see ``completed``).
+        '''
+        attrs = serialized['attrs']
+        data = attrs.get('data')
+        if isinstance(data, memoryview) and attrs.get('accepts_memoryview'):
+            pool = self.threads
+        elif isinstance(data, memoryview):
+            # memoryviews can't be sent to another process as they are.
+            attrs['data'] = taskunit.TaskUnit.copy_buffer(data)
+            pool = self.pool
+        else:
+            pool = self.pool
+        if attrs.get('combiner_digest'):
+            result_attrs = self.PARTIAL_ATTRS
+        else:
+            result_attrs = self.RESULT_ATTRS
+        self.start(pool, serialized, address, result_attrs, processor_source)
+
+        return
+
+    def start(self, pool, serialized, address, result_attrs, processor_source,
+              send_source=False):
+        '''Run the TaskUnit on the pool.
+
+        :param send_source: Whether to send the processor's source along.
+        '''
+        future = pool.submit(run_taskunit, serialized, result_attrs,
+                             processor_source if send_source else None)
+        self.running[future] = (address, serialized, pool, result_attrs,
+                                processor_source, send_source)
+        future.add_done_callback(self.finished)
+
+        return
+
+    def finished(self, future):
+        '''Callback for the futures of the TaskUnits that are done.
+        '''
+        self.done.append(future)
+        if self.on_done is not None:
+            self.on_done(future)
+
+        return
+
+    def completed(self):
+        '''Generate (address, serialized result) for finished TaskUnits.
+
+        A TaskUnit whose worker didn't have its processor is run again, this
+        time with the processor's source, so the source is only sent to the
+        workers that need it.
+
+        If running the TaskUnit raised (e.g. the processor couldn't be
+        loaded), the result is reported as BAILED so that the master doesn't
+        wait for it forever.
+        '''
+        while self.done:
+            future = self.done.popleft()
+            (address, serialized, pool, result_attrs, processor_source,
+             send_source) = self.running.pop(future)
+            try:
+                result = future.result()
+            except MissingCode:
+                if processor_source is None or send_source:
+                    result = self.bailed(serialized)
+                else:
+                    self.start(pool, serialized, address, result_attrs,
+                               processor_source, send_source=True)
+                    continue
+            except Exception:
+                result = self.bailed(serialized)
+            yield (address, result)
+
+    @staticmethod
+    def bailed(serialized):
+        '''Get a BAILED result for the serialized TaskUnit.
+        '''
+        attrs = serialized['attrs']
+
+        return {'class': serialized['class'],
+                'attrs': {'id': attrs.get('id'),
+                          'job_id': attrs.get('job_id'),
+                          'state': 'BAILED',
+                          'result': None}}
+
+    def shutdown(self):
+        '''Shut down the worker processes.
+        '''
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.threads.shutdown(wait=False, cancel_futures=True)
+
+        return
@@ -2,6 +2,7 @@
 import hashlib
 import json
 import time
+import types
 
 # Custom imports
 import serialize
@@ -14,14 +15,34 @@ class Job(serialize.Serializable):
     An instance of this class represents a job to be run on a distributed
     system cluster. The job defines a splitter, a combiner, the input to the
     job, the processor for the taskunits.
+
+    A job can also define a reduce. Its processor then produces lists of
+    (key, value) pairs. These are partitioned by key (a partition for each
+    slave) and each partition is reduced on a slave in a keyed taskunit (see
+    ``TaskUnit``). The combiner gets the (key, reduced value) pairs.
     '''
     def __init__(self, id=None, input_data=None, processor=None, splitter=None,
-                 combiner=None):
+                 combiner=None, accepts_memoryview=False, pushdown=False,
+                 reduce=None, retries=0, weight=1, priority=0, deadline=None):
         '''
         :param input_data: An elementary type.
         :param splitter: An instance of Splitter. Default used if None.
         :param combiner: An instance of Combiner. Default used if None.
         :param processor: A function which processes input to a TaskUnit.
+        :param accepts_memoryview: Whether the processor can take large
+        buffers as memoryviews (without them being copied on the slave).
+        :param pushdown: Whether the slaves combine the results with the
+        combiner's accumulate before sending them back (see ``Partial``).
+        Only used if the combiner is incremental and there's no reduce.
+        :param reduce: A function which reduces the values for a key.
+        :param retries: The number of times each taskunit is retried after it
+        fails, unless the splitter gives it more.
+        :param weight: The job's share of the slaves relative to the other
+        jobs of the same priority.
+        :param priority: The jobs with a higher priority get the slaves
+        first.
+        :param deadline: How long (in seconds) after the master gets the job
+        it is due.
         '''
         super().__init__(recursive_serialize=True)
         self.noserialize += ['taskunits', 'compute_id']
@@ -34,6 +55,16 @@ class Job(serialize.Serializable):
         self.splitter = splitter if splitter else Splitter()
         self.combiner = combiner if combiner else Combiner()
 
+        self.accepts_memoryview = accepts_memoryview
+        self.pushdown = pushdown
+        self.reduce = reduce
+        self.retries = retries
+        if weight <= 0:
+            raise ValueError("Weight must be > 0.")
+        self.weight = weight
+        self.priority = priority
+        self.deadline = deadline
+
         # Map of taskunit ids to TaskUnits.
         self.taskunits = {}
 
@@ -50,10 +81,11 @@ class Job(serialize.Serializable):
         :returns: MD5 hex digest
         '''
         m = hashlib.md5()
-        if isinstance(input_data, bytes):
-            input_data_bytes = input_data
+        # Buffers are hashed in place to avoid copying large input data.
+        if isinstance(input_data, (bytes, bytearray, memoryview)):
+            m.update(input_data)
         else:
-            input_data_bytes = bytes(input_data, 'UTF-8')
+            m.update(bytes(input_data, 'UTF-8'))
 
         if isinstance(processor_code, bytes):
             processor_code_bytes = processor_code
@@ -70,8 +102,8 @@ class Job(serialize.Serializable):
         else:
             combine_code_bytes = bytes(combine_code, 'UTF-8')
 
-        hashable = (input_data_bytes + processor_code_bytes +
-                    split_code_bytes + combine_code_bytes)
+        hashable = (processor_code_bytes + split_code_bytes +
+                    combine_code_bytes)
         m.update(hashable)
 
         return m.hexdigest()
@@ -82,10 +114,44 @@ class Splitter(serialize.Serializable):
 
     The users of the system can define their own splitters to be used by the
     master.
+
+    The default split method can group lines into batched taskunits (see
+    ``TaskUnit.unbatch``) of about ``chunk_bytes`` bytes and/or of about
+    ``chunk_time`` seconds of work on a slave. The number of lines per
+    taskunit for ``chunk_time`` is worked out from the run times reported by
+    the slaves (see ``record_run_time``) as the job runs.
+
+    If the split is ``known``, i.e. it gives a fixed set of taskunits that
+    doesn't depend on how the job runs, the master can schedule all of them
+    at once (see ``MinMakespan.schedule_batch``).
     '''
-    def __init__(self):
+    # Number of lines in the taskunits when chunking by time before there are
+    # any run times to go by.
+    INITIAL_CHUNK_LINES = 16
+    # The most lines put in a single taskunit.
+    MAX_CHUNK_LINES = 1 << 16
+    # Weight of the latest run time in the moving average of time per line.
+    RUN_TIME_WEIGHT = 0.25
+
+    def __init__(self, chunk_bytes=None, chunk_time=None, known=False):
+        '''
+        :param chunk_bytes: Group lines into taskunits of about this many
+        bytes.
+        :param chunk_time: Group lines into taskunits that take about this many
+        seconds to run.
+        :param known: Whether the split gives a fixed (and not too large) set
+        of taskunits. Not used with ``chunk_time``.
+        '''
         super().__init__()
-        self.noserialize += ['set_split_method']
+        self.noserialize += ['set_split_method', 'chunks', 'chunk_lines',
+                             'record_run_time', 'line_time',
+                             'INITIAL_CHUNK_LINES', 'MAX_CHUNK_LINES',
+                             'RUN_TIME_WEIGHT']
+        self.chunk_bytes = chunk_bytes
+        self.chunk_time = chunk_time
+        self.known = known
+        # Moving average of the time (in seconds) it takes to run a line.
+        self.line_time = None
 
     def set_split_method(self, split_method):
         '''Set the method to be used to split a job into taskunits.
@@ -99,7 +165,8 @@ class Splitter(serialize.Serializable):
         '''Generate splits (taskunits) given an input file and a processor.
 
         The input_data is split at newlines and one taskunit is created for
-        each line.
+        each line. If ``chunk_bytes`` or ``chunk_time`` is set, one batched
+        taskunit is created for each chunk of lines instead (see ``chunks``).
 
         This method can be overwritten if the user of the system decides to use
         their own splitter.
@@ -109,50 +176,238 @@ class Splitter(serialize.Serializable):
         :generates: TaskUnit
         '''
         input_lines = input_data.split('\n')
+        if self.chunk_bytes or self.chunk_time:
+            for chunk in self.chunks(input_lines):
+                yield taskunit.TaskUnit(data=chunk, processor=processor,
+                                        batched=True)
+            return
         for input_line in input_lines:
             t = taskunit.TaskUnit(data=input_line, processor=processor)
             yield t
 
+    def chunks(self, lines):
+        '''Generate lists of consecutive lines.
+
+        A chunk ends when it has ``chunk_bytes`` bytes or ``chunk_lines()``
+        lines. The chunk size is looked up again for every line since the
+        generator is only advanced as taskunits are dispatched, and run times
+        keep coming in in the meanwhile.
+
+        :param lines: The lines to group into chunks.
+        :generates: list of lines
+        '''
+        chunk = []
+        chunk_bytes = 0
+        for line in lines:
+            chunk.append(line)
+            chunk_bytes += len(line) + 1
+            if ((self.chunk_bytes and chunk_bytes >= self.chunk_bytes) or
+                    len(chunk) >= self.chunk_lines()):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+        if chunk:
+            yield chunk
+
+    def chunk_lines(self):
+        '''Get the number of lines to put in the next chunk.
+
+        :rtype: int
+        '''
+        if not self.chunk_time:
+            return self.MAX_CHUNK_LINES
+        if not self.line_time:
+            return self.INITIAL_CHUNK_LINES
+
+        lines = int(self.chunk_time / self.line_time)
+        return max(1, min(lines, self.MAX_CHUNK_LINES))
+
+    def record_run_time(self, lines, run_time):
+        '''Record that running a taskunit of lines lines took run_time seconds.
+
+        :param lines: The number of lines in the taskunit.
+        :param run_time: The run time reported by the slave.
+        '''
+        if not lines or run_time is None:
+            return
+
+        line_time = run_time / lines
+        if self.line_time is None:
+            self.line_time = line_time
+        else:
+            self.line_time += self.RUN_TIME_WEIGHT * (line_time -
+                                                      self.line_time)
+
+        return
+
 
 class Combiner(serialize.Serializable):
     '''Represents a combiner used by a master to combine TaskUnit results.
 
     The users of the system can define their own combiners to be used by the
     master.
+
+    A combiner is either incremental or not. An incremental combiner has each
+    result passed to ``accumulate`` as soon as it comes back, and
+    ``finalize`` is called once all of them are back. The master then doesn't
+    need to hold on to the taskunits of the job. Otherwise, all the taskunits
+    are passed to ``add_taskunits`` at the end and ``combine`` is called.
     '''
-    def __init__(self):
+    def __init__(self, incremental=True, keyed=False):
+        '''
+        :param incremental: Whether the results are combined as they come
+        back with ``accumulate`` and ``finalize``.
+        :param keyed: Whether the results are (key, value) pairs, i.e. the job
+        has a reduce.
+        '''
         super().__init__()
-        self.noserialize += ['set_combine_method', 'add_taskunits',
-                             'taskunits']
+        self.noserialize += ['set_combine_method', 'set_accumulate_method',
+                             'add_taskunits', 'taskunits']
+        self.incremental = incremental
+        self.keyed = keyed
         self.taskunits = []
+        # The results combined so far (by the default accumulate).
+        self.result = {} if keyed else 0
 
     def set_combine_method(self, combine_method):
         '''Set the method to be used to combine the results from taskunits.
+
+        The combiner is no longer incremental since a combine method needs
+        all the taskunits.
         '''
         self.__class__.combine = combine_method
+        self.incremental = False
+
+    def set_accumulate_method(self, accumulate_method, finalize_method=None,
+                              merge_method=None):
+        '''Set the methods to be used to combine the results incrementally.
+
+        :param accumulate_method: Called with each result as it comes back.
+        :param finalize_method: Called once all the results are back. The
+        default finalize dumps ``self.result`` if None.
+        :param merge_method: Called with each ``Partial`` result sent by the
+        slaves if the job is pushed down. The default merge accumulates the
+        partial result like any other result if None.
+        '''
+        self.__class__.accumulate = accumulate_method
+        if finalize_method is not None:
+            self.__class__.finalize = finalize_method
+        if merge_method is not None:
+            self.__class__.merge = merge_method
+        self.incremental = True
 
     def add_taskunits(self, tu):
         '''Add a taskunit to combine.
 
         When all the taskunits are available (determined by the master),
         the combine() method needs to called to actually combine the results.
+
+        Batched taskunits are added as one taskunit per item (see
+        ``TaskUnit.unbatch``) so that combine() doesn't need to know about
+        batching. Keyed taskunits are added as one taskunit per key.
         '''
-        self.taskunits.extend(tu)
+        for t in tu:
+            self.taskunits.extend(t.unbatch())
 
     def combine(self):
         '''Combine all the added TaskUnit results.
 
-        This method just uses the "sum" operator to combine all the results
-        and then dumps the results as a JSON string to the file
-        result_<date>.json
+        This method just passes each of the results to ``accumulate`` and
+        then calls ``finalize``.
 
         In most situations, the system users would want to define their own
-        combine method to combine the results.
+        combine method (or accumulate and finalize methods) to combine the
+        results.
+        '''
+        for t in self.taskunits:
+            self.accumulate(t.result)
+        self.finalize()
+
+    def accumulate(self, result):
+        '''Add a TaskUnit result to the results combined so far.
+
+        This method just uses the "+" operator to add the result to
+        ``self.result``. If the combiner is keyed, the result is a (key, value)
+        pair which is put in the ``self.result`` dict instead.
+        '''
+        if self.keyed:
+            key, value = result
+            self.result[key] = value
+        else:
+            self.result += result
+
+    def merge(self, partial):
+        '''Add the result of a ``Partial`` to the results combined so far.
+
+        This method just accumulates it like any other result, which works
+        for sums and counts but not e.g. for a combiner that accumulates
+        results into a list.
+        '''
+        self.accumulate(partial)
+
+    def finalize(self):
+        '''Finish combining the results once all of them are added.
+
+        This method dumps the combined result as a JSON string to the file
+        result_<date>.json
         '''
-        taskunits = self.taskunits
-        results = [t.result for t in taskunits]
-        combined_result = sum(results)  # Just sum the values.
-        json_string = json.dumps(combined_result, indent=2)
+        json_string = json.dumps(self.result, indent=2)
         result_file = open('result_' + time.strftime('%Y-%m-%d_%H:%M:%S'), 'w')
         result_file.write(json_string)
         result_file.close()
+
+
+class Partial:
+    '''The results of some of the taskunits of a job, combined on a slave.
+
+    If a job is pushed down, the slaves accumulate the results of its
+    taskunits with (a copy of) the job's combiner instead of sending them
+    back. They send back the ids of the taskunits along with the combined
+    result every now and then. The master merges it into the job's combiner
+    (see ``Combiner.merge``).
+    '''
+    CLASS = 'job.Partial'
+
+    def __init__(self, job_id, accumulate_method):
+        '''
+        :param job_id: The id of the job the taskunits are part of.
+        :param accumulate_method: The accumulate method of the job's
+        combiner.
+        '''
+        self.job_id = job_id
+        self.combiner = Combiner()
+        self.combiner.accumulate = types.MethodType(accumulate_method,
+                                                    self.combiner)
+        self.ids = []
+        self.run_times = []
+        self.created = time.time()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, result):
+        '''Accumulate the (serialized) result of a completed taskunit.
+
+        :param result: The serialized taskunit, with the batched attribute if
+        the taskunit is batched.
+        '''
+        attrs = result['attrs']
+        if attrs.get('batched'):
+            results = attrs['result']
+        else:
+            results = [attrs['result']]
+        for item_result in results:
+            self.combiner.accumulate(item_result)
+        self.ids.append(attrs['id'])
+        self.run_times.append(attrs.get('run_time'))
+
+        return
+
+    def message(self):
+        '''Get the message to send the partial result to the master with.
+        '''
+        return {'class': Partial.CLASS,
+                'job_id': self.job_id,
+                'ids': self.ids,
+                'run_times': self.run_times,
+                'result': self.combiner.result}
@@ -1,7 +1,19 @@
 # Standard imports
+import asyncio
+import collections
+import functools
 import inspect
+import itertools
+import math
+import random
+import time
+import traceback
 
 # Custom imports
+import blobstore
+import codec
+import coderegistry
+import costmodel
 import job
 import messenger
 import message
@@ -16,100 +28,1069 @@ class Master(node.LocalNode):
     A master node assigns work to its slaves after the job has been split up
     into taskunits. It then combines the results into the final expected result
     when it gets back the "intermediate results" from the slaves.
+
+    Taskunits are either pushed to the slaves, as long as they have credit
+    for more (see ``dispatch``), or, in pull mode, only sent to the slaves
+    that ask for work (with a WORK message). In pull mode, once there are no
+    taskunits left to send, the slaves that ask for work steal taskunits
+    that are still queued on the busiest slave: the master asks it (with a
+    STEAL message) to give some back (with a RELEASE message) and sends them
+    to the idle slaves instead.
+
+    Taskunits that take much longer than the others of their job to come
+    back (stragglers) are sent to another slave as well, and whichever
+    result comes back first is used (see ``speculate``). The other one is
+    dropped.
+
+    When there are several jobs, the slaves are shared between them with
+    weighted fair queueing: the next taskunit is taken from the job of the
+    highest priority that has had the least work sent out for its weight
+    (see ``next_job``). So a small job that comes in while a large one is
+    running doesn't wait for all of the large one to be sent out. Jobs of
+    the same priority with a deadline go before the ones without, earliest
+    deadline first. When a job comes in, the slaves are asked to give back
+    the taskunits of less urgent jobs they haven't started yet (see
+    ``preempt``), and those are sent out again after it. Jobs that miss
+    their deadline are reported (see ``missed_deadlines``).
+
+    If a job's split is known up front (see ``Splitter``), all of its
+    taskunits are scheduled at once with ``MinMakespan.schedule_batch`` (see
+    ``plan_job``) and sent to their slaves as they have credit for them.
+    Otherwise, each taskunit is scheduled as it is split.
+
+    Each taskunit is sent to a slave that already has its processor, if
+    there is one that isn't more than ``locality_tolerance`` (in estimated
+    seconds of work) busier than the least busy slave. The slaves report
+    what they already have when they connect (with a CACHED message).
+
+    The data of taskunits of at least ``blob_threshold`` bytes is sent to
+    each slave only once, as a blob (see ``BlobStore``), and the taskunits
+    refer to it by its digest. So the same data in another taskunit (e.g. a
+    retry, or a job that is run again) isn't sent again. Slaves that don't
+    have a blob (any more) ask for it with a FETCH message. The slaves that
+    have a taskunit's data are preferred for it over the ones that have its
+    code. The master only keeps the blobs of the jobs that are running.
+
+    Taskunits that fail (and have retries left) are sent again after a
+    backoff, to a slave they haven't failed on if there is one (see
+    ``retry``). The scheduler holds the failures against the slave.
     '''
-    def __init__(self, port):
+    # Default number of taskunits that can be in flight on each slave.
+    DEFAULT_MAX_INFLIGHT = 64
+    # Default for how much more work (in estimated seconds) a slave that has
+    # a taskunit's code can have than the least busy slave and still get it.
+    DEFAULT_LOCALITY_TOLERANCE = 0.1
+    # Default for the size (in bytes) of the data of a taskunit from which on
+    # it is sent as a blob.
+    DEFAULT_BLOB_THRESHOLD = 64 * 1024
+    # The most taskunits of a job that are scheduled at once. The taskunits
+    # of a larger job are scheduled as they are split.
+    MAX_PLANNED_TASKUNITS = 1 << 16
+
+    # How often (in seconds) to look for stragglers.
+    SPECULATION_INTERVAL = 0.5
+    # A taskunit is a straggler once it has been in flight for
+    # SPECULATION_FACTOR times the 90th percentile of the latencies of the
+    # job's taskunits (and at least MIN_SPECULATION_TIME seconds). There need
+    # to be at least MIN_LATENCIES latencies to go by. The latest
+    # LATENCY_SAMPLES latencies of each job are kept.
+    SPECULATION_FACTOR = 2.0
+    MIN_SPECULATION_TIME = 1.0
+    MIN_LATENCIES = 10
+    LATENCY_SAMPLES = 256
+
+    # A taskunit that failed is sent again after RETRY_DELAY seconds, doubled
+    # for each time it failed before (up to MAX_RETRY_DELAY seconds). The
+    # delay is jittered by up to RETRY_JITTER of it either way.
+    RETRY_DELAY = 0.1
+    MAX_RETRY_DELAY = 5.0
+    RETRY_JITTER = 0.5
+
+    def __init__(self, port, max_inflight=DEFAULT_MAX_INFLIGHT,
+                 batch_size=messenger.ZMQMessenger.DEFAULT_BATCH_SIZE,
+                 codecs=codec.DEFAULT_CODECS, pull=False,
+                 locality_tolerance=DEFAULT_LOCALITY_TOLERANCE,
+                 blob_threshold=DEFAULT_BLOB_THRESHOLD):
         '''
         :param port: port number to run this master on.
+        :param max_inflight: the number of taskunits each slave can have in
+        flight (sent but not returned) at any time. Not used in pull mode.
+        :param batch_size: the max number of taskunits sent to a slave in one
+        message.
+        :param codecs: the codecs to use with the slaves, in order of
+        preference (see ``codec``).
+        :param pull: Whether to only send taskunits to the slaves that ask for
+        them.
+        :param locality_tolerance: how much busier (in estimated seconds of
+        work) a slave that has a taskunit's code can be than the least busy
+        slave and still be preferred for it.
+        :param blob_threshold: the size (in bytes) of the data of a taskunit
+        from which on it is sent to each slave only once (as a blob).
         '''
         super().__init__()
 
         self.config['port'] = port
+        self.config['max_inflight'] = max_inflight
+        self.config['pull'] = pull
+        self.config['blob_threshold'] = blob_threshold
 
+        # Jobs that still have taskunits to be split and dispatched.
         self.pending_jobs = []
+        # The virtual time (work sent out for its weight) of the job whose
+        # taskunit was sent out last. Jobs that become pending start here.
+        self.virtual_time = 0
         self.completed_jobs = []
+        # The ids of the jobs whose results couldn't be combined.
+        self.failed_jobs = []
+        # The ids of the jobs that were done after their deadline.
+        self.missed_deadlines = []
         self.slave_nodes = []
-        self.scheduler = schedule.MinMakespan()
+        # Map of slave addresses to their index in slave_nodes (which is also
+        # their machine number in the scheduler).
+        self.slave_index = {}
+        # inflight[i] is the number of taskunits in flight on slave i.
+        self.inflight = []
+        # Slaves which have credit for more taskunits.
+        self.available_slaves = set()
+        # requested[i] is the number of taskunits slave i asked for and
+        # didn't get yet (in pull mode).
+        self.requested = []
+        # Slaves that were asked to give back taskunits and didn't yet.
+        self.stealing = set()
+        # Map of (job id, taskunit id) to a [machine, time sent, taskunit]
+        # list for each copy of the taskunit in flight.
+        self.dispatched = {}
+        # (job id, taskunit id) of the stragglers that were sent again.
+        self.speculated = set()
+        # Map of (job id, taskunit id) to the set of slaves the taskunit
+        # failed on.
+        self.failed_on = {}
+        # Map of (job id, taskunit id) to the number of times the taskunit
+        # failed.
+        self.failures = collections.Counter()
+        # Set when taskunits are queued up to be sent again (see
+        # ``requeue``).
+        self.requeued_ready = asyncio.Event()
+        # Map of code (and blob) digests to the set of slaves that already
+        # have it.
+        self.holders = collections.defaultdict(set)
+        self.code = coderegistry.CodeRegistry()
+        # The data of the large taskunits of the jobs that are running (see
+        # ``drop_blobs``). The data is held by the taskunits (and the jobs'
+        # input) anyway, so there's no limit.
+        self.blobs = blobstore.BlobStore()
+        # Map of blob digests to the number of running jobs that use them.
+        self.blob_jobs = collections.Counter()
+        # How long the processors take to run. Kept across jobs.
+        self.costs = costmodel.CostModel()
+        self.scheduler = schedule.MinMakespan(tolerance=locality_tolerance)
         messenger_type = messenger.ZMQMessenger.TYPE_SERVER
-        self.messenger = messenger.ZMQMessenger(type=messenger_type,
-                                                port=self.config['port'])
+        self.messenger = messenger.AsyncZMQMessenger(type=messenger_type,
+                                                     port=self.config['port'],
+                                                     batch_size=batch_size,
+                                                     codecs=codecs)
         self.messenger.start()
         # A map of job_ids to Jobs.
         self.jobs = {}
 
         return
 
-    def process_job(self, j):
+    async def process_job(self, j):
         '''Process a job received from the user.
 
-        It generates TaskUnits from the Job and sends them off to the Slaves to
-        be processed. It then collects the results and combines them to get the
-        final result. It then writes the results to a file and returns.
+        The job is queued up to be split into TaskUnits which are sent off to
+        the Slaves to be processed as the slaves have credit for them (see
+        ``dispatch``). The results are collected by the worker and combined
+        to get the final result once all of them are back.
         '''
+        if j.id is None:
+            j.id = job.Job.compute_id(
+                j.input_data,
+                inspect.getsource(j.processor),
+                inspect.getsource(j.splitter.split),
+                inspect.getsource(j.combiner.combine))
         self.jobs[j.id] = j
         j.pending_taskunits = 0
-        for tu in j.splitter.split(j.input_data, j.processor):
-            # The split method only fills in the data and the processor.
-            # So we need to manually fill the rest.
-            processor_source = inspect.getsource(tu.processor)
-            taskunit_id = taskunit.TaskUnit.compute_id(tu.data,
-                                                       processor_source)
-            tu.id = taskunit_id
-            tu.job_id = j.id
-            tu.job_size = 1
+        # The ids of the taskunits that came back without a result (e.g. they
+        # ran out of retries).
+        j.failed_taskunits = []
+        # Number of copies of each taskunit (i.e. taskunits with the same
+        # data) whose results are needed. Any other results for a taskunit
+        # (e.g. of a straggler that was sent again) are dropped.
+        j.taskunit_copies = collections.Counter()
+        # The latest latencies (from being sent to the result coming back)
+        # of the job's taskunits.
+        j.latencies = collections.deque(maxlen=self.LATENCY_SAMPLES)
+        j.split_done = False
+        # The split is a generator; it is only advanced when there's a slave
+        # to send the next taskunit to (unless the job is planned).
+        j.split_iter = iter(j.splitter.split(j.input_data, j.processor))
+        # plan[i] is a queue of the taskunits scheduled on slave i, if the
+        # job is planned.
+        j.plan = None
+        # The results of a job with a reduce are shuffled into a partition for
+        # each slave until all of them are back (see ``start_reduce``).
+        if j.reduce is not None:
+            j.shuffle = [[] for _ in range(max(1, len(self.slave_nodes)))]
+        else:
+            j.shuffle = None
+        # The accumulate method is sent to the slaves like the processor if
+        # the job is pushed down.
+        if j.pushdown and j.combiner.incremental and j.shuffle is None:
+            j.combiner_digest = self.code.add(
+                j.combiner.serialize_method(j.combiner.accumulate))
+        else:
+            j.combiner_digest = None
+        # The work (estimated run time) of the taskunits of the job sent out
+        # so far, for its weight.
+        j.virtual_time = 0
+        # When the job is due (on the master's clock), if it has a deadline.
+        if j.deadline is not None:
+            j.due = time.monotonic() + j.deadline
+        else:
+            j.due = None
+        # The taskunits of the job to be sent out again (e.g. the ones the
+        # slaves gave back).
+        j.requeued = collections.deque()
+        # The digests of the blobs of the job's taskunits.
+        j.blob_digests = set()
+        if (j.splitter.known and not j.splitter.chunk_time and
+                self.slave_nodes):
+            self.plan_job(j)
+        self.add_pending_job(j)
+        await self.dispatch()
+        if j in self.pending_jobs:
+            # There is no room for the job on the slaves.
+            self.preempt(j)
+
+        return
+
+    async def dispatch(self):
+        '''Send out TaskUnits for as long as the slaves have credit for them.
+
+        Each slave can have at most ``max_inflight`` taskunits in flight.
+        Credit is given back when the result for a taskunit comes back, so the
+        number of taskunits held by the master (and queued on the slaves)
+        doesn't grow with the size of the input. In pull mode, the credit is
+        what the slaves asked for instead.
+        '''
+        while self.pending_jobs and self.available_slaves:
+            j = self.next_job()
+            try:
+                tu, machine = self.next_taskunit(j)
+            except StopIteration:
+                self.pending_jobs.remove(j)
+                if not j.split_done:
+                    j.split_done = True
+                    del j.split_iter
+                    j.plan = None
+                    self.check_job_done(j)
+                continue
+            await self.assign_taskunit(j, tu, machines=self.retry_slaves(j, tu),
+                                       machine=machine)
+            self.virtual_time = j.virtual_time
+            j.virtual_time += tu.job_size / j.weight
+
+        if self.config['pull'] and self.available_slaves:
+            # There's nothing left to send to the slaves that want work.
+            self.steal()
+
+        return
+
+    def plan_job(self, j):
+        '''Split the job and schedule all of its taskunits at once.
+
+        If the job has more than MAX_PLANNED_TASKUNITS taskunits, it's left
+        to be scheduled as it is split.
+        '''
+        taskunits = list(itertools.islice(j.split_iter,
+                                          self.MAX_PLANNED_TASKUNITS + 1))
+        if len(taskunits) > self.MAX_PLANNED_TASKUNITS:
+            j.split_iter = itertools.chain(taskunits, j.split_iter)
+            return
+
+        for tu in taskunits:
+            self.add_taskunit(j, tu)
+        machines = self.scheduler.schedule_batch(taskunits)
+        j.plan = [collections.deque() for _ in self.slave_nodes]
+        # The largest taskunits were scheduled first, so they go first.
+        for i in sorted(range(len(taskunits)),
+                        key=lambda i: taskunits[i].job_size, reverse=True):
+            j.plan[machines[i]].append(taskunits[i])
+        print("MASTER: Planned %d taskunits." % len(taskunits))
+
+        return
+
+    def next_taskunit(self, j):
+        '''Get the next taskunit of the job to send out.
+
+        For a planned job, that's the next taskunit planned for one of the
+        available slaves. If there are none, the last taskunit planned for
+        the slave with the most left is scheduled again (as if the job
+        wasn't planned).
+
+        The taskunits to be sent out again go first.
+
+        :returns: The taskunit and the slave it is planned for (or None).
+        Raises StopIteration if there are no more taskunits.
+        '''
+        while j.requeued:
+            tu = j.requeued.popleft()
+            if self.needed(j, tu.id):
+                return tu, None
+        if j.split_done:
+            raise StopIteration
+        if j.plan is None:
+            tu = next(j.split_iter)
+            self.add_taskunit(j, tu)
+            return tu, None
+
+        for machine in self.available_slaves:
+            if machine < len(j.plan) and j.plan[machine]:
+                return j.plan[machine].popleft(), machine
+        machine = max(range(len(j.plan)), key=lambda i: len(j.plan[i]))
+        if not j.plan[machine]:
+            raise StopIteration
+        tu = j.plan[machine].pop()
+        self.scheduler.cancel_job(tu, machine)
+
+        return tu, None
+
+    def add_pending_job(self, j):
+        '''Queue up the job to have its taskunits sent out.
+
+        The job doesn't get to make up for the time it wasn't pending, i.e.
+        it starts at the virtual time of the job that was served last.
+        '''
+        j.virtual_time = max(j.virtual_time, self.virtual_time)
+        self.pending_jobs.append(j)
+
+        return
+
+    def next_job(self):
+        '''Get the pending job to send out a taskunit of next.
+
+        That is, of the jobs with the highest priority, the one with the
+        earliest deadline or, if none of them have a deadline, the one with
+        the least virtual time. Ties go to the job that became pending first.
+        '''
+        return min(self.pending_jobs,
+                   key=lambda j: self.urgency(j) + (j.virtual_time,))
+
+    @staticmethod
+    def urgency(j):
+        '''Get a key to sort jobs by, most urgent first.
+        '''
+        return (-j.priority, math.inf if j.due is None else j.due)
+
+    def preempt(self, j):
+        '''Ask the slaves to give back the taskunits of the jobs that are less
+        urgent than the job that they haven't started running yet.
+
+        They are sent out again after the job's taskunits.
+        '''
+        urgency = self.urgency(j)
+        jobs = set(job_id for job_id, other in self.jobs.items()
+                   if other.pending_taskunits and
+                   self.urgency(other) > urgency)
+        if not jobs:
+            return
+
+        # The number of taskunits of those jobs in flight on each slave.
+        counts = collections.Counter()
+        for (job_id, _), copies in self.dispatched.items():
+            if job_id in jobs:
+                for machine, _, _ in copies:
+                    counts[machine] += 1
+        for machine, count in counts.items():
+            address = self.slave_nodes[machine].address
+            print("MASTER: Preempting up to %d taskunits on %s:%d" %
+                  ((count,) + address))
+            self.stealing.add(machine)
+            self.messenger.send_serialized({'class': 'STEAL', 'count': count,
+                                            'jobs': sorted(jobs)}, address)
+
+        return
+
+    def steal(self):
+        '''Ask the busiest slave to give back some of its queued taskunits.
+
+        The taskunits it gives back (see ``release_taskunits``) are sent to the
+        slaves that asked for work.
+        '''
+        wanted = sum(self.requested[m] for m in self.available_slaves)
+        victims = [m for m in range(len(self.slave_nodes))
+                   if m not in self.available_slaves and
+                   m not in self.stealing and self.inflight[m] > 1]
+        if not victims:
+            return
+
+        victim = max(victims, key=lambda m: self.inflight[m])
+        count = min(wanted, self.inflight[victim] // 2)
+        self.stealing.add(victim)
+        print("MASTER: Stealing %d taskunits from %s:%d" %
+              ((count,) + self.slave_nodes[victim].address))
+        self.messenger.send_serialized({'class': 'STEAL', 'count': count},
+                                       self.slave_nodes[victim].address)
+
+        return
+
+    def release_taskunits(self, address, taskunits):
+        '''The slave at address gave back taskunits it didn't start running.
+
+        The slave gets credit for them back, like for results.
+
+        :param taskunits: A list of [job id, taskunit id] pairs.
+        '''
+        machine = self.slave_index[address]
+        self.stealing.discard(machine)
+        for job_id, taskunit_id in taskunits:
+            j = self.jobs[job_id]
+            self.return_credit(address)
+            tu = self.untrack(j, taskunit_id, address, done=False)
+            if tu is not None and self.needed(j, taskunit_id):
+                self.requeue(j, tu)
+
+        return
+
+    def needed(self, j, taskunit_id):
+        '''Whether the taskunit needs another copy of it to be sent out.
+
+        That is, whether fewer copies are in flight than results are needed.
+        '''
+        in_flight = len(self.dispatched.get((j.id, taskunit_id), ()))
+
+        return j.taskunit_copies[taskunit_id] > in_flight
+
+    def untrack(self, j, taskunit_id, address, done=True, failed=False):
+        '''A copy of the taskunit is no longer in flight on the slave.
+
+        Its work is taken off the load of the slave in the scheduler.
+
+        :param done: Whether the slave ran it (as opposed to giving it back).
+        :param failed: Whether it failed on the slave.
+        :returns: The taskunit if a copy of it was in flight on the slave.
+        '''
+        key = (j.id, taskunit_id)
+        machine = self.slave_index.get(address)
+        copies = self.dispatched.get(key, [])
+        for copy in copies:
+            if copy[0] == machine:
+                break
+        else:
+            return None
+
+        copies.remove(copy)
+        if not copies:
+            del self.dispatched[key]
+            self.speculated.discard(key)
+        _, sent, tu = copy
+        if not done:
+            self.scheduler.cancel_job(tu, machine)
+        elif failed:
+            self.scheduler.fail_job(tu, machine)
+        else:
+            j.latencies.append(time.monotonic() - sent)
+            self.scheduler.complete_job(tu, machine)
+
+        return tu
+
+    def retry(self, j, taskunit_id, address):
+        '''Send the taskunit that failed on the slave again after a backoff.
+
+        :returns: Whether it is retried, i.e. whether it had retries left.
+        '''
+        tu = j.taskunits[taskunit_id]
+        if tu.retries <= 0:
+            return False
+
+        tu.retries -= 1
+        key = (j.id, taskunit_id)
+        self.failed_on.setdefault(key, set()).add(self.slave_index[address])
+        self.failures[key] += 1
+        delay = self.retry_delay(self.failures[key])
+        print("MASTER: Taskunit failed on %s:%d. Retrying in %.2fs." %
+              (address + (delay,)))
+        loop = asyncio.get_running_loop()
+        loop.call_later(delay, self.requeue, j, tu)
+
+        return True
+
+    def retry_delay(self, failures):
+        '''Get how long to wait before sending a taskunit again after it
+        failed for the failures-th time.
+
+        The delay doubles with each failure (up to MAX_RETRY_DELAY), whether
+        or not it failed on the same slave, and is jittered.
+        '''
+        delay = min(self.MAX_RETRY_DELAY,
+                    self.RETRY_DELAY * 2 ** (failures - 1))
+
+        return delay * random.uniform(1 - self.RETRY_JITTER,
+                                      1 + self.RETRY_JITTER)
+
+    def requeue(self, j, tu):
+        '''Queue up the taskunit of the job to be sent again.
+        '''
+        j.requeued.append(tu)
+        if j not in self.pending_jobs:
+            self.add_pending_job(j)
+        self.requeued_ready.set()
+
+        return
+
+    def retry_slaves(self, j, tu):
+        '''Get the available slaves to send the taskunit to again.
+
+        :returns: The available slaves it didn't fail on, or None (for all
+        of them) if it failed on all of them.
+        '''
+        failed_on = self.failed_on.get((j.id, tu.id))
+        if failed_on:
+            machines = self.available_slaves - failed_on
+            if machines:
+                return machines
+
+        return None
+
+    async def speculate(self):
+        '''Send the stragglers to another slave as well.
+
+        Each straggler is only sent again once and only to a slave with
+        credit for it. The taskunits of jobs that are pushed down aren't sent
+        again since their results can't be dropped once they are combined on
+        a slave.
+        '''
+        now = time.monotonic()
+        straggler_times = {}
+        for key in list(self.dispatched):
+            if not self.available_slaves:
+                break
+            # Results that came in while a straggler was being sent may have
+            # taken other taskunits out of dispatched.
+            copies = self.dispatched.get(key)
+            if not copies or key in self.speculated or len(copies) > 1:
+                continue
+            job_id, taskunit_id = key
+            j = self.jobs[job_id]
+            if job_id not in straggler_times:
+                straggler_times[job_id] = self.straggler_time(j)
+            straggler_time = straggler_times[job_id]
+            machine, sent, tu = copies[0]
+            if straggler_time is None or now - sent < straggler_time:
+                continue
+            machines = self.available_slaves - {machine}
+            if not machines:
+                continue
+            self.speculated.add(key)
+            print("MASTER: Sending a straggler on %s:%d again." %
+                  self.slave_nodes[machine].address)
+            await self.assign_taskunit(j, tu, machines=machines)
+
+        return
+
+    def straggler_time(self, j):
+        '''Get how long a taskunit of the job can be in flight for before it
+        is taken to be a straggler.
+
+        :returns: The time in seconds, or None if the job's stragglers aren't
+        to be sent again (yet).
+        '''
+        if (not j.split_done or j.combiner_digest is not None or
+                len(j.latencies) < self.MIN_LATENCIES):
+            return None
+
+        latencies = sorted(j.latencies)
+        p90 = latencies[int(0.9 * (len(latencies) - 1))]
+
+        return max(self.MIN_SPECULATION_TIME, self.SPECULATION_FACTOR * p90)
+
+    def add_taskunit(self, j, tu):
+        '''Add a new TaskUnit of the job (to be sent out).
+        '''
+        # The split method only fills in the data and the processor.
+        # So we need to manually fill the rest.
+        tu.retries = max(tu.retries, j.retries)
+        processor_source = tu.serialize_method(tu.processor)
+        taskunit_id = taskunit.TaskUnit.compute_id(tu.data,
+                                                   processor_source)
+        tu.id = taskunit_id
+        tu.job_id = j.id
+        tu.processor_digest = self.code.add(processor_source)
+        # The scheduler balances the slaves by the estimated run times.
+        tu.input_size = self.costs.input_size(tu.data)
+        tu.job_size = self.costs.estimate(tu.processor_digest, tu.input_size)
+        if (tu.input_size >= self.config['blob_threshold'] and
+                blobstore.BlobStore.is_blob(tu.data)):
+            tu.blob_digest = self.blobs.put(tu.data)
+            if tu.blob_digest not in j.blob_digests:
+                j.blob_digests.add(tu.blob_digest)
+                self.blob_jobs[tu.blob_digest] += 1
+
+        # Store this taskunit in the job's taskunit map.
+        j.taskunits[tu.id] = tu
+        j.taskunit_copies[tu.id] += 1
+        j.pending_taskunits += 1
 
-            # Store this taskunit in the job's taskunit map.
-            j.taskunits[tu.id] = tu
-            j.pending_taskunits += 1
+        return
+
+    async def assign_taskunit(self, j, tu, machines=None, machine=None):
+        '''Schedule the TaskUnit on one of the available slaves and send it.
+
+        :param machines: The slaves to choose from. Defaults to all the
+        available slaves.
+        :param machine: The slave the TaskUnit is already scheduled on, if
+        it is (see ``plan_job``).
+        '''
+        if machines is None:
+            machines = self.available_slaves
+        if machine is not None:
+            next_slave = machine
+        else:
+            next_slave = self.scheduler.schedule_job(
+                tu, machines=machines, preferred=self.warm_slaves(j, tu))
+        slave_address = self.slave_nodes[next_slave].address
+        self.dispatched.setdefault((j.id, tu.id), []).append(
+            [next_slave, time.monotonic(), tu])
+        self.inflight[next_slave] += 1
+        if self.config['pull']:
+            self.requested[next_slave] -= 1
+            if self.requested[next_slave] <= 0:
+                self.available_slaves.discard(next_slave)
+        elif self.inflight[next_slave] >= self.config['max_inflight']:
+            self.available_slaves.discard(next_slave)
+
+        # The processor itself is sent to each slave only once. The taskunits
+        # refer to it by its digest.
+        self.send_code(next_slave, tu.processor_digest)
+        if j.combiner_digest is not None:
+            tu.combiner_digest = j.combiner_digest
+            self.send_code(next_slave, tu.combiner_digest)
+
+        # Attributes to send to the slave. Large data is sent (once) as a
+        # blob instead.
+        attrs = ['id', 'job_id', 'retries', 'processor_digest']
+        if tu.blob_digest is not None:
+            self.send_blob(next_slave, tu.blob_digest)
+            attrs.append('blob_digest')
+        else:
+            attrs.append('data')
+        if tu.batched:
+            attrs.append('batched')
+        if tu.keyed:
+            attrs.append('keyed')
+        if tu.combiner_digest is not None:
+            attrs.append('combiner_digest')
+        if j.accepts_memoryview:
+            tu.accepts_memoryview = True
+            attrs.append('accepts_memoryview')
+        await self.messenger.send_taskunit(tu, slave_address, attrs=attrs)
+
+        return
+
+    def warm_slaves(self, j, tu):
+        '''Get the slaves that already have the data (if it's a blob) or
+        else the code for the taskunit.
+        '''
+        if tu.blob_digest is not None:
+            # The data is what's expensive to send.
+            return self.holders.get(tu.blob_digest)
+        warm = self.holders.get(tu.processor_digest)
+        if warm and j.combiner_digest is not None:
+            warm = warm & self.holders.get(j.combiner_digest, set())
+
+        return warm
+
+    def send_code(self, machine, digest):
+        '''Send the code for digest to the slave unless it already has it.
+        '''
+        if machine in self.holders[digest]:
+            return
+        slave_address = self.slave_nodes[machine].address
+        self.messenger.send_code(digest, self.code.get_source(digest),
+                                 slave_address)
+        self.holders[digest].add(machine)
+
+        return
+
+    def send_blob(self, machine, digest):
+        '''Send the blob for digest to the slave unless it already has it.
+        '''
+        if machine in self.holders[digest]:
+            return
+        slave_address = self.slave_nodes[machine].address
+        self.messenger.send_blob(digest, self.blobs.get(digest),
+                                 slave_address)
+        self.holders[digest].add(machine)
+
+        return
+
+    def fetch_blobs(self, address, digests):
+        '''Send the slave at address the blobs it asked for.
+
+        The slave doesn't have them (any more), even if it was sent them
+        before.
+        '''
+        machine = self.slave_index[address]
+        for digest in digests:
+            if digest not in self.blobs:
+                print('MASTER: Unknown blob %s' % digest)
+                continue
+            self.holders[digest].discard(machine)
+            self.send_blob(machine, digest)
+
+        return
+
+    def add_cached(self, address, digests):
+        '''Note the code (and blobs) the slave at address says it already
+        has.
+        '''
+        machine = self.slave_index[address]
+        for digest in digests:
+            self.holders[digest].add(machine)
+
+        return
+
+    def add_slave(self, address):
+        '''Add a new slave at address and give it credit for taskunits.
 
-            # Now schedule this task unit.
-            next_slave = self.scheduler.schedule_job(tu)
-            slave_address = self.slave_nodes[next_slave].address
+        In pull mode, the slave is told to ask for taskunits instead.
+        '''
+        self.slave_index[address] = len(self.slave_nodes)
+        if self.config['pull']:
+            self.messenger.send_serialized({'class': 'PULL'}, address)
+        else:
+            self.available_slaves.add(len(self.slave_nodes))
+        self.slave_nodes.append(node.RemoteNode(None, address))
+        self.inflight.append(0)
+        self.requested.append(0)
+        self.scheduler.add_machine()
+
+        return
 
-            # Attributes to send to the slave.
-            attrs = ['id', 'data', 'retries', 'processor']
-            self.messenger.send_taskunit(tu, slave_address, attrs=attrs)
+    def reset_slave(self, address):
+        '''The slave at address was restarted and lost its code, its blobs
+        and the taskunits it had.
+
+        Those taskunits are sent out again and the slave gets all of its
+        credit back. It says what it still has in a CACHED message.
+        '''
+        machine = self.slave_index[address]
+        for machines in self.holders.values():
+            machines.discard(machine)
+        for (job_id, taskunit_id), copies in list(self.dispatched.items()):
+            if not any(copy[0] == machine for copy in copies):
+                continue
+            j = self.jobs[job_id]
+            tu = self.untrack(j, taskunit_id, address, done=False)
+            if tu is not None and self.needed(j, taskunit_id):
+                self.requeue(j, tu)
+        self.inflight[machine] = 0
+        self.stealing.discard(machine)
+        if self.config['pull']:
+            self.requested[machine] = 0
+            self.available_slaves.discard(machine)
+            self.messenger.send_serialized({'class': 'PULL'}, address)
+        else:
+            self.available_slaves.add(machine)
+
+        return
+
+    def return_credit(self, address):
+        '''A taskunit came back from the slave at address. Give it credit.
+        '''
+        try:
+            machine = self.slave_index[address]
+        except KeyError:
+            return
+        self.inflight[machine] -= 1
+        if not self.config['pull']:
+            self.available_slaves.add(machine)
+
+        return
+
+    def add_result(self, j, result):
+        '''Add the result of a taskunit of the job that came back.
+
+        With an incremental combiner, the result is accumulated right away and
+        the taskunit is dropped, so the master only holds on to the taskunits
+        that are in flight.
+
+        Only the results of taskunits that completed are accumulated (or
+        shuffled). The others (e.g. that ran out of retries) are noted in the
+        job's failed_taskunits.
+
+        :param result: The (deserialized) taskunit sent back by the slave.
+        '''
+        tu = j.taskunits[result.id]
+        tu.result = result.result
+        tu.state = result.state
+        if tu.state != 'COMPLETED':
+            print("MASTER: Taskunit %s of job %s %s." %
+                  (tu.id, j.id, tu.state.lower()))
+            j.failed_taskunits.append(tu.id)
+        elif j.shuffle is not None:
+            self.shuffle(j, tu)
+        elif j.combiner.incremental:
+            for item_result in tu.results():
+                j.combiner.accumulate(item_result)
+        self.finish_taskunit(j, tu, result.run_time)
+
+        return
+
+    def shuffle(self, j, tu):
+        '''Partition the (key, value) pairs in the results by key.
+        '''
+        partitions = j.shuffle
+        for item_result in tu.results():
+            # Items that have no pairs.
+            if not item_result:
+                continue
+            for key, value in item_result:
+                partitions[hash(key) % len(partitions)].append([key, value])
+
+        return
+
+    def start_reduce(self, j):
+        '''Queue up a keyed taskunit to reduce each partition of the job.
+        '''
+        partitions = j.shuffle
+        j.shuffle = None
+        j.split_done = False
+        j.split_iter = (taskunit.TaskUnit(data=partition, processor=j.reduce,
+                                          keyed=True)
+                        for partition in partitions if partition)
+        self.add_pending_job(j)
+
+        return
+
+    def add_partial(self, j, partial, address):
+        '''Add a partial result of the job sent back by a slave.
+
+        The results of the taskunits in the partial are already combined by
+        the slave, so the partial result is just merged into the job's
+        combiner.
+
+        :param partial: The message the slave sent (see ``job.Partial``).
+        :param address: The address of the slave.
+        '''
+        for taskunit_id, run_time in zip(partial['ids'],
+                                         partial['run_times']):
+            self.untrack(j, taskunit_id, address)
+            tu = j.taskunits[taskunit_id]
+            tu.state = 'COMPLETED'
+            self.finish_taskunit(j, tu, run_time)
+        j.combiner.merge(partial['result'])
+
+        return
+
+    def finish_taskunit(self, j, tu, run_time):
+        '''Account for a taskunit of the job whose result is back.
+
+        The taskunit's run time is fed to the cost model.
+
+        With an incremental combiner (or while shuffling), the taskunit is
+        dropped since its result is already combined (or partitioned), so the
+        master only holds on to the taskunits that are in flight.
+        '''
+        self.costs.record(tu.processor_digest, tu.input_size, run_time)
+        if tu.batched:
+            # Lets the splitter size the next taskunits of the job.
+            j.splitter.record_run_time(len(tu.data), run_time)
+        j.pending_taskunits -= 1
+
+        j.taskunit_copies[tu.id] -= 1
+        if not j.taskunit_copies[tu.id]:
+            del j.taskunit_copies[tu.id]
+            self.failed_on.pop((j.id, tu.id), None)
+            self.failures.pop((j.id, tu.id), None)
+            if j.combiner.incremental or j.shuffle is not None:
+                del j.taskunits[tu.id]
+
+        return
+
+    def check_job_done(self, j):
+        '''Combine the results of the job if all of them are back.
+
+        If the job has a reduce and its results were being shuffled, the
+        reduce is started instead.
+
+        The combine (or finalize) runs on a thread so that it doesn't hold up
+        the event loop (and with it the other jobs).
+        '''
+        if not (j.split_done and j.pending_taskunits == 0):
+            return
+
+        self.drop_blobs(j)
+        if j.shuffle is not None:
+            self.start_reduce(j)
+        else:
+            if j.due is not None and time.monotonic() > j.due:
+                print("MASTER: Job %s missed its deadline by %.2fs." %
+                      (j.id, time.monotonic() - j.due))
+                self.missed_deadlines.append(j.id)
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(None, self.combine, j)
+            future.add_done_callback(functools.partial(self.combine_done, j))
+
+        return
+
+    def drop_blobs(self, j):
+        '''Drop the blobs of the job's taskunits now that all of them are
+        back, unless another running job uses them too.
+
+        The slaves that have the blobs are still preferred for taskunits with
+        the same data, which is put in the store again.
+        '''
+        for digest in j.blob_digests:
+            self.blob_jobs[digest] -= 1
+            if not self.blob_jobs[digest]:
+                del self.blob_jobs[digest]
+                self.blobs.discard(digest)
+        j.blob_digests.clear()
+
+        return
+
+    def combine_done(self, j, future):
+        '''The combine of the job (see ``combine``) is done.
+
+        If it raised (e.g. in the job's finalize), the job is counted as
+        failed instead of completed.
+        '''
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            self.completed_jobs.append(j.id)
+            return
+
+        print("MASTER: Combining the results of job %s failed." % j.id)
+        traceback.print_exception(error)
+        self.failed_jobs.append(j.id)
+
+        return
+
+    def combine(self, j):
+        '''Combine the results of the job.
+        '''
+        if j.combiner.incremental:
+            j.combiner.finalize()
+        else:
+            j.combiner.add_taskunits(j.taskunits.values())
+            j.combiner.combine()
 
         return
 
     def worker(self):
-        '''This method keeps running for the life of the Slave.
+        '''The main worker loop. Runs ``run`` on an asyncio event loop.
+        '''
+        asyncio.run(self.run())
 
-        It asks for new messages from this Slave's messenger. It then
-        appropriately handles the message.
+    async def run(self):
+        '''The main coroutine. This keeps running for the life of the Master.
 
+        It handles the messages from this Master's messenger as they come.
         Messages could be new jobs, processed task units from slaves, status
         updates from slaves etc.
+
+        The messenger's ``sender`` and ``flusher`` run alongside it to write
+        the messages out and send out the batches of taskunits that are due.
+        '''
+        tasks = [asyncio.create_task(self.messenger.sender()),
+                 asyncio.create_task(self.messenger.flusher()),
+                 self.start_task(self.speculator),
+                 self.start_task(self.retrier)]
+
+        async for address, msg in self.messenger.receive():
+            try:
+                await self.handle_message(address, msg)
+            except Exception:
+                # One bad message mustn't take the master (and all of its
+                # jobs) down with it.
+                print("MASTER: Failed to handle a %s message from %s:%d." %
+                      ((msg.get('class'),) + address))
+                traceback.print_exc()
+
+    async def speculator(self):
+        '''Look for stragglers to send again every SPECULATION_INTERVAL.
         '''
-        for address, msg in self.messenger.receive(deserialize=False):
-
-            if msg == 'PING':
-                self.messenger.pong(address)
-                # Ping from port 0 is most probably create_job.py message.
-                # Don't add it to our slaves list in that case.
-                # FIXME: In the future, find a better, more reliable way of
-                # determining this.
-                if address[1] == 0:
-                    continue
-                print("MASTER: PING from %s:%d" % address)
-                self.slave_nodes.append(node.RemoteNode(None, address))
-                self.scheduler.add_machine()
-                self.messenger.register_destination('slave1', address)
-            elif msg['class'] == 'job.Job':
-                print("MASTER: Got a new job.")
-                #object_dict = msg.msg_payload.decode('utf-8')
-                j = job.Job.deserialize(msg)
-                self.process_job(j)
-            elif msg['class'] == 'taskunit.TaskUnit':
-                # TODO: MA Handle failed tasks.
-                print("MASTER: Got a taskunit result back.")
-                #object_dict = msg.msg_payload.decode('utf-8')
-                tu = taskunit.TaskUnit.deserialize(msg)
-                job_id = tu.job_id
-                j = self.jobs[job_id]
-                taskunit_id = tu.id
-                j.taskunits[taskunit_id].result = tu.result
-                j.taskunits[taskunit_id].state = tu.state
-                j.pending_taskunits -= 1
-                if j.pending_taskunits == 0:
-                    j.combiner.add_taskunits(j.taskunits.values())
-                    j.combiner.combine()
+        while True:
+            await asyncio.sleep(self.SPECULATION_INTERVAL)
+            await self.speculate()
+
+    async def retrier(self):
+        '''Send the taskunits that are queued up again (e.g. the ones that
+        failed, once they are due). Forever.
+        '''
+        while True:
+            await self.requeued_ready.wait()
+            self.requeued_ready.clear()
+            await self.dispatch()
+
+    async def handle_message(self, address, msg):
+        '''Handle a (not yet deserialized) message from address.
+        '''
+        if msg['class'] == 'PING':
+            self.messenger.pong(address)
+            # Ping from port 0 is most probably create_job.py message.
+            # Don't add it to our slaves list in that case.
+            # FIXME: In the future, find a better, more reliable way of
+            # determining this.
+            if address[1] == 0:
+                return
+            print("MASTER: PING from %s:%d" % address)
+            if address in self.slave_index:
+                # The slave must have been restarted.
+                self.reset_slave(address)
+                await self.dispatch()
+                return
+            self.add_slave(address)
+            self.messenger.register_destination('slave1', address)
+            await self.dispatch()
+        elif msg['class'] == 'job.Job':
+            print("MASTER: Got a new job.")
+            j = job.Job.deserialize(msg)
+            await self.process_job(j)
+        elif msg['class'] == 'taskunit.TaskUnit':
+            print("MASTER: Got a taskunit result back.")
+            tu = taskunit.TaskUnit.deserialize(msg)
+            j = self.jobs[tu.job_id]
+            self.return_credit(address)
+            # Only a completed copy closes the taskunit. One that bailed is
+            # as good as failed while another copy can still complete.
+            failed = tu.state != 'COMPLETED'
+            self.untrack(j, tu.id, address, failed=failed)
+            if not j.taskunit_copies[tu.id]:
+                # Another copy of the taskunit came back first.
+                print("MASTER: Dropped a duplicate result.")
+            elif failed and not self.needed(j, tu.id):
+                # Another copy of the taskunit is still in flight.
+                pass
+            elif not (failed and self.retry(j, tu.id, address)):
+                self.add_result(j, tu)
+                self.check_job_done(j)
+            await self.dispatch()
+        elif msg['class'] == job.Partial.CLASS:
+            print("MASTER: Got a partial result back.")
+            j = self.jobs[msg['job_id']]
+            self.add_partial(j, msg, address)
+            for _ in msg['ids']:
+                self.return_credit(address)
+            self.check_job_done(j)
+            await self.dispatch()
+        elif msg['class'] == 'WORK' and self.config['pull']:
+            machine = self.slave_index[address]
+            self.requested[machine] += msg['count']
+            if self.requested[machine] > 0:
+                self.available_slaves.add(machine)
+            await self.dispatch()
+        elif msg['class'] == 'CACHED':
+            self.add_cached(address, msg['digests'])
+        elif msg['class'] == 'FETCH':
+            self.fetch_blobs(address, msg['digests'])
+            await self.messenger.drain()
+        elif msg['class'] == 'RELEASE':
+            self.release_taskunits(address, msg['taskunits'])
+            await self.dispatch()
+
+        return
@@ -227,3 +227,44 @@ class ZMQMessage:
 
     def __eq__(self, other):
         return other == self.json_decoded
+
+
+class ZMQBatch:
+    '''Represents a batch of encoded messages sent as one ZMQ message.
+
+    The items are kept encoded (see ``codec``) so that the size of the batch
+    is known as it's being filled and packing it is cheap. For JSON, a batch
+    is sent as a JSON object with a ``class`` of ``CLASS`` and the batched
+    messages as its ``items``.
+    '''
+    CLASS = 'message.ZMQBatch'
+
+    def __init__(self, created, codec):
+        '''
+        :param created: The time the batch was started at.
+        :param codec: The codec the items are encoded with.
+        '''
+        self.created = created
+        self.codec = codec
+        self.items = []
+        self.nbytes = 0
+
+    def add(self, encoded):
+        '''Add an encoded message to the batch.
+        '''
+        self.items.append(encoded)
+        self.nbytes += len(encoded)
+
+    def __len__(self):
+        return len(self.items)
+
+    def pack(self):
+        '''Get the payload for the whole batch.
+        '''
+        return self.codec.pack_batch(self.items)
+
+    @staticmethod
+    def is_batch(msg):
+        '''Whether the decoded (JSON) msg is a batch.
+        '''
+        return isinstance(msg, dict) and msg.get('class') == ZMQBatch.CLASS
@@ -1,12 +1,17 @@
 # Standard imports
+import asyncio
 import collections
-import json
 import select
 import socket
 import threading
+import time
 import zmq
+import zmq.asyncio
 
 # Custom imports
+import blobstore
+import codec
+import coderegistry
 import job
 import message
 import taskunit
@@ -16,11 +21,19 @@ import utils.logger
 class Messenger:
     '''A class representing a messenger that handles all communication.
     '''
-    def __init__(self):
+    def __init__(self, codecs=codec.DEFAULT_CODECS):
+        '''
+        :param codecs: The names of the codecs (see ``codec``) this messenger
+        supports, in order of preference.
+        '''
         # identity <--> address maps.
         self.identity_to_address = {}
         self.address_to_identity = {}
 
+        self.codecs = codecs
+        # Map of addresses to the codec negotiated with them.
+        self.address_codecs = {}
+
         # Both inbound_queue and outbound_queue contain tuples of
         # (address, message) that are received or need to be sent out.
         self.inbound_queue = collections.deque()
@@ -57,6 +70,13 @@ class Messenger:
 
         return
 
+    def get_codec(self, address):
+        '''Get the codec to encode messages to address with.
+
+        JSON is used unless another codec has been negotiated with address.
+        '''
+        return self.address_codecs.get(address, codec.JSON)
+
     def send(self, msg, address):
         '''Send the msg to the address.
         '''
@@ -202,7 +222,7 @@ class UDPMessenger(Messenger):
         If track is True, then this method returns a MessageTracker object
         which can be used to check the state of the message sending.
         '''
-        serialized_job = job.serialize(json_encode=True)
+        serialized_job = self.get_codec(address).encode(job.serialize())
         msg_id, messages = message.Message.packed_fragments(
             message.Message.MSG_JOB,
             serialized_job,
@@ -222,8 +242,8 @@ class UDPMessenger(Messenger):
         If track is True, then this method returns a MessageTracker object
         which can be used to check the state of the message sending.
         '''
-        serialized_taskunit = tu.serialize(include_attrs=attrs,
-                                           json_encode=True)
+        serialized_taskunit = self.get_codec(address).encode(
+            tu.serialize(include_attrs=attrs))
         msg_id, messages = message.Message.packed_fragments(
             message.Message.MSG_TASKUNIT,
             serialized_taskunit,
@@ -239,7 +259,8 @@ class UDPMessenger(Messenger):
         '''
         Send the result of running taskunit.
         '''
-        serialized_result = tu.serialize(include_attrs=attrs, json_encode=True)
+        serialized_result = self.get_codec(address).encode(
+            tu.serialize(include_attrs=attrs))
         msg_id, messages = message.Message.packed_fragments(
             message.Message.MSG_TASKUNIT_RESULT,
             serialized_result,
@@ -361,23 +382,46 @@ class ZMQMessenger(Messenger):
     DEFAULT_PORT = 33310
     NUM_TRIES = 3
 
+    # Batching defaults. A batch of taskunits or results is sent once it has
+    # DEFAULT_BATCH_SIZE messages or DEFAULT_BATCH_BYTES bytes in it or it is
+    # DEFAULT_BATCH_DELAY seconds old, whichever comes first.
+    DEFAULT_BATCH_SIZE = 32
+    DEFAULT_BATCH_BYTES = 1 << 20
+    DEFAULT_BATCH_DELAY = 0.005
+
     # Messenger types
     TYPE_SERVER = 0  # Listener socket. Accepts connections.
     TYPE_CLIENT = 1  # Client socket. Connects to server.
     VALID_TYPES = [TYPE_SERVER, TYPE_CLIENT]
 
-    def __init__(self, type, ip=None, port=DEFAULT_PORT):
+    def __init__(self, type, ip=None, port=DEFAULT_PORT, batch_size=1,
+                 batch_bytes=DEFAULT_BATCH_BYTES,
+                 batch_delay=DEFAULT_BATCH_DELAY,
+                 codecs=codec.DEFAULT_CODECS):
         '''
         :param type: The type of Messenger. Can be SERVER or CLIENT messenger.
         :param ip: The ip of the interface the socket should use.
         :param port: The port the socket should use.
+        :param batch_size: The max number of taskunits or results to send in
+        one batch. 1 disables batching.
+        :param batch_bytes: Send a batch once it is at least this big.
+        :param batch_delay: Send a batch once it is this many seconds old. The
+        owner of the messenger must call ``flush_expired`` regularly.
+        :param codecs: The names of the codecs (see ``codec``) to offer to
+        peers, in order of preference.
         '''
-        super().__init__()
+        super().__init__(codecs=codecs)
 
         self.type = type
         self.ip = ip
         self.port = port
 
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_delay = batch_delay
+        # Map of addresses to the ZMQBatch being filled for them.
+        self.batches = {}
+
         self.context = zmq.Context()
 
         return
@@ -401,6 +445,10 @@ class ZMQMessenger(Messenger):
     def connect(self, address):
         '''Connect to address and PING NUM_TRIES times till PONG received.
 
+        The PING offers our codecs and the PONG says which one the peer picked
+        (see ``codec.negotiate``). Messages to address are encoded with that
+        codec from then on.
+
         Raises ConnectionError if failed to connect after NUM_TRIES tries. None
         otherwise.
         '''
@@ -409,7 +457,7 @@ class ZMQMessenger(Messenger):
             self.ping(address)
             try:
                 msg_address, msg = next(self.receive(block=False, timeout=0.2))
-                if msg_address == address and msg == 'PONG':
+                if msg_address == address and msg['class'] == 'PONG':
                     return
             except:
                 pass
@@ -417,35 +465,53 @@ class ZMQMessenger(Messenger):
             raise ConnectionError("Failed to connect.")
 
     def ping(self, address):
-        self.send(json.dumps('PING'), address)
+        # PING and PONG are always sent as JSON since no codec has been agreed
+        # on yet.
+        self.send({'class': 'PING', 'codecs': self.codecs}, address,
+                  msg_codec=codec.JSON)
 
         return
 
     def pong(self, address):
-        self.send(json.dumps('PONG'), address)
+        self.send({'class': 'PONG', 'codec': self.get_codec(address).NAME},
+                  address, msg_codec=codec.JSON)
+
+        return
+
+    def handle_handshake(self, msg, address):
+        '''Pick up the codec for address from a PING or a PONG.
+        '''
+        if msg['class'] == 'PING':
+            self.address_codecs[address] = codec.negotiate(
+                self.codecs, msg.get('codecs', []))
+        elif msg['class'] == 'PONG':
+            try:
+                self.address_codecs[address] = codec.get(msg['codec'])
+            except KeyError:
+                self.address_codecs[address] = codec.JSON
 
         return
 
     def receive(self, deserialize=False, block=True, timeout=0):
+        '''Yield (address, message) tuples as messages are received.
+
+        :param block: Whether to block waiting for a message.
+        :param timeout: If positive, raise TimeoutError if nothing is
+        received within ``timeout`` seconds.
+        '''
         while True:
             flags = 0 if block else zmq.NOBLOCK
             if timeout > 0.0:
                 if self.socket.poll(timeout=timeout*1000) == 0:
                     raise TimeoutError()
-            address = self.socket.recv_string(flags=flags)
-            assert self.socket.recv() == b""  # Empty delimiter
-            msg = self.socket.recv_json()
-
-            # FIXME(mtahmed): This would probably fail for IPV6.
-            address = address.split(':')[1:]
-            address[0] = address[0][2:]
-            address[1] = int(address[1])
-            address = tuple(address)
-
-            # FIXME(mtahmed): The PING-PONG should be taken care of in Messenger.
+            # The frames aren't copied so that large out-of-band buffers
+            # can be handed out as memoryviews of the received frames.
+            frames = self.socket.recv_multipart(flags=flags, copy=False)
+            address, msgs = self.decode_frames(frames)
 
             if not deserialize:
-                yield (address, msg)
+                for msg in msgs:
+                    yield (address, msg)
                 continue
 
             # FIXME
@@ -460,19 +526,144 @@ class ZMQMessenger(Messenger):
             elif msg_type == message.Message.MSG_JOB:
                 yield (address, job.Job.deserialize(decoded_msg))
 
-    def send(self, msg, address):
+    def decode_frames(self, frames):
+        '''Decode the (uncopied) frames of a received ZMQ message.
+
+        PINGs and PONGs are also used to pick the codec for the sender.
+
+        :returns: (address, list of messages)
+        :rtype: tuple
+        '''
+        address = frames[0].bytes.decode('UTF-8')
+        assert frames[1].bytes == b""  # Empty delimiter
+        # <address><delimiter><codec name><payload>[<buffer>...]. Messages
+        # without a codec name are JSON.
+        if len(frames) > 3:
+            msg_codec = codec.get(frames[2].bytes.decode('UTF-8'))
+            buffers = [frame.buffer for frame in frames[4:]]
+            msgs = msg_codec.decode(frames[3].buffer, buffers)
+        else:
+            msgs = codec.JSON.decode(frames[2].bytes)
+
+        # FIXME(mtahmed): This would probably fail for IPV6.
+        address = address.split(':')[1:]
+        address[0] = address[0][2:]
+        address[1] = int(address[1])
+        address = tuple(address)
+
+        # FIXME(mtahmed): The PING-PONG should be taken care of in Messenger.
+        for msg in msgs:
+            if msg['class'] in ('PING', 'PONG'):
+                self.handle_handshake(msg, address)
+
+        return (address, msgs)
+
+    def send(self, msg, address, msg_codec=None):
+        '''Send the msg to the address right away.
+
+        :param msg: The (serialized) message to send.
+        :param msg_codec: The codec to encode msg with. Defaults to the codec
+        negotiated with address.
+        '''
+        # Anything batched for address so far must go out first.
+        if address in self.batches:
+            self.flush(address)
+        if msg_codec is None:
+            msg_codec = self.get_codec(address)
+        payload, buffers = msg_codec.encode_frames(msg)
+        self.send_now(payload, msg_codec, address, buffers)
+
+        return
+
+    def send_now(self, payload, msg_codec, address, buffers=()):
+        '''Send the payload encoded with msg_codec to the address.
+
+        :param buffers: Out-of-band buffers to send after the payload. These
+        are sent without being copied, so they must not be modified until
+        they are sent.
+        '''
+        frames = self.encode_frames(payload, msg_codec, address, buffers)
+        self.socket.send_multipart(frames, copy=False)
+
+        return
+
+    @staticmethod
+    def encode_frames(payload, msg_codec, address, buffers=()):
+        '''Get the ZMQ frames to send the payload to the address with.
+        '''
         address = 'tcp://%s:%d' % address
-        self.socket.send_string(address, zmq.SNDMORE)
-        self.socket.send_string("", zmq.SNDMORE)
-        self.socket.send_string(msg)
+        frames = [address.encode('UTF-8'),
+                  b'',
+                  msg_codec.NAME.encode('UTF-8'),
+                  payload]
+        frames.extend(buffers)
+
+        return frames
+
+    def send_batched(self, msg, address):
+        '''Add the msg to the batch for address.
+
+        The batch is sent when it reaches the size thresholds. If batching is
+        disabled or msg has large buffers to be sent out-of-band, the msg is
+        sent right away.
+        '''
+        if self.batch_size <= 1:
+            self.send(msg, address)
+            return
+        msg_codec = self.get_codec(address)
+        payload, buffers = msg_codec.encode_frames(msg)
+        if buffers:
+            if address in self.batches:
+                self.flush(address)
+            self.send_now(payload, msg_codec, address, buffers)
+            return
+        batch = self.batches.get(address)
+        if batch is not None and batch.codec is not msg_codec:
+            self.flush(address)
+            batch = None
+        if batch is None:
+            batch = self.batches[address] = message.ZMQBatch(time.time(),
+                                                             msg_codec)
+        batch.add(payload)
+        if len(batch) >= self.batch_size or batch.nbytes >= self.batch_bytes:
+            self.flush(address)
+
+        return
+
+    def flush(self, address=None):
+        '''Send out the batch for address (or all the batches if None).
+        '''
+        if address is None:
+            addresses = list(self.batches.keys())
+        else:
+            addresses = [address]
+        for address in addresses:
+            batch = self.batches.pop(address, None)
+            if batch is None:
+                continue
+            if len(batch) == 1:
+                self.send_now(batch.items[0], batch.codec, address)
+            else:
+                self.send_now(batch.pack(), batch.codec, address)
+
+        return
+
+    def flush_expired(self):
+        '''Send out the batches that are older than batch_delay.
+        '''
+        if not self.batches:
+            return
+        expired = time.time() - self.batch_delay
+        for address, batch in list(self.batches.items()):
+            if batch.created <= expired:
+                self.flush(address)
 
         return
 
     def send_job(self, job, address):
         '''Send a job to a remote node.
         '''
-        serialized_job = job.serialize(json_encode=True)
-        self.send(serialized_job, address)
+        self.send(job.serialize(), address)
 
         return
 
@@ -481,9 +672,7 @@ class ZMQMessenger(Messenger):
                              'result']):
         '''Send a taskunit to a remote node.
         '''
-        serialized_taskunit = tu.serialize(include_attrs=attrs,
-                                           json_encode=True)
-        self.send(serialized_taskunit, address)
+        self.send_batched(tu.serialize(include_attrs=attrs), address)
 
         return
 
@@ -491,8 +680,30 @@ class ZMQMessenger(Messenger):
                              attrs=['id', 'job_id', 'state', 'result']):
         '''Send the result of running taskunit.
         '''
-        serialized_result = tu.serialize(include_attrs=attrs, json_encode=True)
-        self.send(serialized_result, address)
+        self.send_batched(tu.serialize(include_attrs=attrs), address)
+
+        return
+
+    def send_code(self, digest, source, address):
+        '''Send the source of a function (e.g. a processor) to a remote node.
+        '''
+        self.send_serialized(coderegistry.CodeRegistry.message(digest, source),
+                             address)
+
+        return
+
+    def send_blob(self, digest, data, address):
+        '''Send a blob (e.g. the data of a large TaskUnit) to a remote node.
+        '''
+        self.send_serialized(blobstore.BlobStore.message(digest, data),
+                             address)
+
+        return
+
+    def send_serialized(self, serialized, address):
+        '''Send an already serialized object (e.g. a TaskUnit result).
+        '''
+        self.send_batched(serialized, address)
 
         return
 
@@ -510,3 +721,141 @@ class ZMQMessenger(Messenger):
         s.close()
 
         return addr
+
+
+class AsyncZMQMessenger(ZMQMessenger):
+    '''A ZMQMessenger for use from an asyncio event loop.
+
+    Built on ``zmq.asyncio``. ``receive`` is an asynchronous generator and
+    ``connect``, ``send_job``, ``send_taskunit`` and ``send_taskunit_result``
+    are coroutines.
+
+    Everything that is sent (including batches) is put on an outbox which is
+    written to the socket by the ``sender`` coroutine, so the batching and
+    encoding of ZMQMessenger is shared as is. The coroutine send methods wait
+    for the outbox to drain when it has more than OUTBOX_HIGH_WATER messages
+    in it, which pushes back on whoever is producing the messages.
+    '''
+    OUTBOX_HIGH_WATER = 1024
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.context = zmq.asyncio.Context()
+
+        # ZMQ frames waiting to be sent by the sender coroutine.
+        self.outbox = collections.deque()
+        self.outbox_ready = asyncio.Event()
+        self.outbox_drained = asyncio.Event()
+        # Map of addresses to the futures ``connect`` waits on for their PONG.
+        self.pongs = {}
+
+        return
+
+    async def connect(self, address):
+        '''Connect to address and PING NUM_TRIES times till PONG received.
+
+        See ``ZMQMessenger.connect``. The sender coroutine must be running
+        and the messages must be received (with ``receive``) meanwhile: the
+        PONG is picked up along the way (see ``handle_handshake``), so no
+        other message is lost while waiting for it.
+        '''
+        self.socket.connect('tcp://%s:%d' % address)
+        pong = asyncio.get_running_loop().create_future()
+        self.pongs[address] = pong
+        try:
+            for _ in range(self.NUM_TRIES):
+                self.ping(address)
+                try:
+                    await asyncio.wait_for(asyncio.shield(pong), timeout=0.2)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            del self.pongs[address]
+
+        raise ConnectionError("Failed to connect.")
+
+    def handle_handshake(self, msg, address):
+        '''Pick up the codec for address from a PING or a PONG.
+
+        A PONG also lets ``connect`` know that address is connected.
+        '''
+        super().handle_handshake(msg, address)
+        pong = self.pongs.get(address)
+        if msg['class'] == 'PONG' and pong is not None and not pong.done():
+            pong.set_result(None)
+
+        return
+
+    async def receive(self):
+        '''Yield (address, message) tuples as messages are received.
+        '''
+        while True:
+            frames = await self.socket.recv_multipart(copy=False)
+            address, msgs = self.decode_frames(frames)
+            for msg in msgs:
+                yield (address, msg)
+
+    def send_now(self, payload, msg_codec, address, buffers=()):
+        '''Put the payload encoded with msg_codec on the outbox.
+        '''
+        self.outbox.append(self.encode_frames(payload, msg_codec, address,
+                                              buffers))
+        self.outbox_ready.set()
+
+        return
+
+    async def sender(self):
+        '''Write the messages on the outbox to the socket. Forever.
+        '''
+        while True:
+            await self.outbox_ready.wait()
+            self.outbox_ready.clear()
+            while self.outbox:
+                await self.socket.send_multipart(self.outbox.popleft(),
+                                                 copy=False)
+            self.outbox_drained.set()
+
+    async def flusher(self):
+        '''Send out the batches that are due. Forever.
+        '''
+        while True:
+            await asyncio.sleep(self.batch_delay)
+            self.flush_expired()
+
+    async def drain(self):
+        '''Wait for the outbox to drain if it's over the high water mark.
+        '''
+        while len(self.outbox) > self.OUTBOX_HIGH_WATER:
+            self.outbox_drained.clear()
+            await self.outbox_drained.wait()
+
+        return
+
+    async def send_job(self, job, address):
+        '''Send a job to a remote node.
+        '''
+        super().send_job(job, address)
+        await self.drain()
+
+        return
+
+    async def send_taskunit(self, tu, address,
+                            attrs=['id', 'job_id', 'data', 'retries', 'state',
+                                   'result']):
+        '''Send a taskunit to a remote node.
+        '''
+        super().send_taskunit(tu, address, attrs=attrs)
+        await self.drain()
+
+        return
+
+    async def send_taskunit_result(self, tu, address,
+                                   attrs=['id', 'job_id', 'state', 'result']):
+        '''Send the result of running taskunit.
+        '''
+        super().send_taskunit_result(tu, address, attrs=attrs)
+        await self.drain()
+
+        return
@@ -1,5 +1,8 @@
+import asyncio
+import functools
 import json
 import socket
+import traceback
 
 
 class Node(object):
@@ -80,9 +83,38 @@ class LocalNode(Node):
         super().__init__(hostname, ip)
 
         self.config = dict()
+        # The tasks started with ``start_task``.
+        self.tasks = set()
         if config_path:
             try:
                 with open(config_path) as config_path_handler:
                     self.config = json.load(config_path_handler)
             except IOError:
                 raise Exception("Failed to load config file " + config_path)
+
+    def start_task(self, coroutine_function):
+        '''Run the coroutine function as a task for the life of the node.
+
+        These coroutines are meant to run forever, so if one raises, the
+        error is printed and the coroutine is started again (instead of it
+        dying silently).
+        '''
+        task = asyncio.create_task(coroutine_function())
+        self.tasks.add(task)
+        task.add_done_callback(functools.partial(self.restart_task,
+                                                 coroutine_function))
+
+        return task
+
+    def restart_task(self, coroutine_function, task):
+        '''Done callback of the tasks started with ``start_task``.
+        '''
+        self.tasks.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+
+        print("%s failed. Restarting it." % coroutine_function.__qualname__)
+        traceback.print_exception(task.exception())
+        self.start_task(coroutine_function)
+
+        return
@@ -11,8 +11,11 @@ If the list of speeds is empty, it is assumed that the machines are identical.
 NOTE: This file uses the scheduling terminology, not consistent with the rest
       of the system.
 '''
+# Standard imports
+import time
+
 # Custom imports
-from utils.heap import Heap
+from utils.heap import IndexedHeap
 
 
 class MinMakespan():
@@ -22,12 +25,45 @@ class MinMakespan():
     on parallel related machines, usually represented using the familiar
     scheduling problem notation Q||C_max. It is a 2-approximation list
     scheduling algorithm for the problem.
+
+    A job is scheduled on the machine that would be done with the jobs it
+    already has the earliest, i.e. the machine with the least load for its
+    speed. The work of a job is taken off its machine's load once it's done
+    (see ``complete_job``).
+
+    The speeds of the machines are learned from how much work they get done:
+    every SPEED_WINDOW seconds a machine is busy, its speed is moved towards
+    the work it completed per second in that time. Machines whose speed
+    hasn't been learned yet are taken to be as fast as the average machine
+    whose speed has been.
+
+    The work of the jobs that fail on a machine is held against it (see
+    ``fail_job``), so a machine that keeps failing jobs gets fewer of them.
+
+    A job can prefer some machines (e.g. the ones that already have what it
+    needs). It is scheduled on the least loaded of them, as long as that is
+    at most ``tolerance`` more load (for its speed) than the least loaded
+    machine.
+
+    If all of the jobs are known up front, they can be scheduled at once
+    with ``schedule_batch`` instead, which gets a better makespan.
     '''
-    def __init__(self, machines=0, speeds=[], jobs=[]):
+    # How long (in seconds) to measure the work done by a machine for before
+    # updating its speed.
+    SPEED_WINDOW = 1.0
+    # Weight of the latest measurement in the moving average of the speed.
+    SPEED_WEIGHT = 0.3
+    # The fraction of a machine's penalty for failed jobs that is forgiven
+    # each time it gets a job done.
+    PENALTY_DECAY = 0.5
+
+    def __init__(self, machines=0, speeds=[], jobs=[], tolerance=0):
         '''
         :param machines: The number of machines.
         :param speeds: The speeds for each of the machines.
         :param jobs: The (initial) set of jobs to be scheduled.
+        :param tolerance: How much more load (for its speed) a preferred
+        machine can have than the least loaded one and still get the job.
 
         NOTE: Each job in jobs must have a job_size attribute.
         '''
@@ -37,36 +73,272 @@ class MinMakespan():
             raise ValueError("speeds should be the same length as machines or"
                              "empty")
         else:
-            self.speeds = speeds
+            self.speeds = list(speeds)
         self.machines = machines
+        self.tolerance = tolerance
 
         # assignments[machine] = list of jobs assigned to machine
         self.assignments = [[] for _ in range(machines)]
-        # A min-heap of the loads on the machines.
-        self.loads_heap = Heap([(i, 0) for i in range(machines)],
-                               key=lambda x: x[1])
+        # loads[machine] = the total size of the jobs on machine
+        self.loads = [0 for _ in range(machines)]
+        # learned[machine] = whether the speed of machine is learned
+        self.learned = [False for _ in range(machines)]
+        # The number and the sum of the learned speeds.
+        self.num_learned = 0
+        self.learned_total = 0
+        # The work completed by each machine since window_start[machine].
+        self.completed = [0 for _ in range(machines)]
+        self.window_start = [None for _ in range(machines)]
+        # penalties[machine] = the size of the jobs that failed on machine
+        # (less what was forgiven), counted as part of its load
+        self.penalties = [0 for _ in range(machines)]
+        # A min-heap of the machines by their load / speed.
+        self.loads_heap = IndexedHeap()
+        # handles[machine] = the handle to machine in loads_heap
+        self.handles = [self.loads_heap.push(i, 0) for i in range(machines)]
 
         # Now schedule the jobs.
         for job in jobs:
             self.schedule_job(job)
 
-    def schedule_job(self, job):
+    def speed(self, machine):
+        '''Get the speed of the machine.
+
+        :rtype: float
+        '''
+        if self.learned[machine]:
+            return self.speeds[machine]
+        if self.num_learned:
+            return self.learned_total / self.num_learned
+
+        return self.speeds[machine]
+
+    def load(self, machine):
+        '''Get the machine's load for its speed.
+
+        :rtype: float
+        '''
+        load = self.loads[machine] + self.penalties[machine]
+
+        return load / self.speed(machine)
+
+    def update_load(self, machine):
+        '''Update the machine's load (for its speed) in the heap.
+        '''
+        self.handles[machine] = self.loads_heap.update(self.handles[machine],
+                                                       self.load(machine))
+
+        return
+
+    def schedule_job(self, job, machines=None, now=None, preferred=None):
         '''Schedule the job according to the current loads.
 
         :param job: The job to be scheduled.
+        :param machines: If given, a set of machines to restrict the choice
+        to (e.g. the machines that have room for more jobs).
+        :param now: The current time. Defaults to ``time.monotonic()``.
+        :param preferred: If given, a set of machines to prefer within the
+        ``tolerance``.
         :returns: The machine the job get's scheduled on.
         :rtype: int representing the machine
         '''
+        if self.machines == 0 or machines is not None and not machines:
+            raise Exception("No machine available")
+        machine, _ = self.loads_heap.peek()
+        if machines is not None and machine not in machines:
+            # Set aside the least loaded machines that can't be used.
+            skipped = []
+            while machine not in machines:
+                skipped.append(self.loads_heap.pop())
+                machine, _ = self.loads_heap.peek()
+            for item, priority in skipped:
+                self.handles[item] = self.loads_heap.push(item, priority)
+        if preferred and machine not in preferred:
+            if machines is not None:
+                preferred = preferred & machines
+            best = min(preferred, key=self.load, default=None)
+            if (best is not None and
+                    self.load(best) <= self.load(machine) + self.tolerance):
+                machine = best
+        self.assign(job, machine, now)
+
+        return machine
+
+    def schedule_batch(self, jobs, now=None):
+        '''Schedule all of the jobs at once, largest first (LPT).
+
+        Each job goes to the machine that would be done with it first, i.e.
+        with the least (load + job size) / speed. Taking the jobs largest
+        first leaves the small ones to even out the loads at the end. This
+        takes O(n log n) for the sort and O(m) for each job.
+
+        :param jobs: The jobs to be scheduled.
+        :param now: The current time. Defaults to ``time.monotonic()``.
+        :returns: The machine each of the jobs gets scheduled on.
+        :rtype: list of machines in the order of jobs
+        '''
         if self.machines == 0:
             raise Exception("No machine available")
-        machine, load = self.loads_heap.pop()
+        machines = [None for _ in jobs]
+        for i in sorted(range(len(jobs)), key=lambda i: jobs[i].job_size,
+                        reverse=True):
+            job = jobs[i]
+            machine = min(range(self.machines),
+                          key=lambda m: (self.load(m) +
+                                         job.job_size / self.speed(m)))
+            self.assign(job, machine, now)
+            machines[i] = machine
+
+        return machines
+
+    def assign(self, job, machine, now=None):
+        '''Put the job on the machine's load.
+        '''
+        if self.loads[machine] == 0:
+            # The machine was idle. Start measuring the work it gets done.
+            self.completed[machine] = 0
+            self.window_start[machine] = (time.monotonic() if now is None
+                                          else now)
         self.assignments[machine].append(job)
-        self.loads_heap.push((machine, load + job.job_size))
+        self.loads[machine] += job.job_size
+        self.update_load(machine)
 
-        return machine
+        return
+
+    def complete_job(self, job, machine, now=None):
+        '''Take the job that's done off the machine's load.
+
+        :param job: The job that was scheduled on the machine.
+        :param machine: The machine the job was done on.
+        :param now: The current time. Defaults to ``time.monotonic()``.
+        '''
+        now = time.monotonic() if now is None else now
+        try:
+            self.assignments[machine].remove(job)
+        except ValueError:
+            pass
+        self.loads[machine] = max(0, self.loads[machine] - job.job_size)
+        self.completed[machine] += job.job_size
+        self.penalties[machine] *= 1 - self.PENALTY_DECAY
+
+        elapsed = now - self.window_start[machine]
+        if elapsed >= self.SPEED_WINDOW:
+            self.learn_speed(machine, self.completed[machine] / elapsed)
+            self.completed[machine] = 0
+            self.window_start[machine] = now
+        elif self.loads[machine] == 0:
+            # The machine is idle now. Too little was measured to go by.
+            self.completed[machine] = 0
+            self.window_start[machine] = now
+        self.update_load(machine)
+
+        return
+
+    def cancel_job(self, job, machine):
+        '''Take the job off the machine without it being done.
+
+        :param job: The job that was scheduled on the machine.
+        :param machine: The machine the job was scheduled on.
+        '''
+        try:
+            self.assignments[machine].remove(job)
+        except ValueError:
+            pass
+        self.loads[machine] = max(0, self.loads[machine] - job.job_size)
+        self.update_load(machine)
+
+        return
+
+    def fail_job(self, job, machine):
+        '''Take the job that failed off the machine and hold it against it.
+
+        :param job: The job that was scheduled on the machine.
+        :param machine: The machine the job failed on.
+        '''
+        try:
+            self.assignments[machine].remove(job)
+        except ValueError:
+            pass
+        self.loads[machine] = max(0, self.loads[machine] - job.job_size)
+        self.penalties[machine] += job.job_size
+        self.update_load(machine)
+
+        return
+
+    def learn_speed(self, machine, speed):
+        '''Move the speed of the machine towards the measured speed.
+
+        The machines whose speed isn't learned yet go by the average of the
+        learned speeds, so their loads (for their speed) change too.
+        '''
+        if self.learned[machine]:
+            change = self.SPEED_WEIGHT * (speed - self.speeds[machine])
+        else:
+            change = speed
+            self.speeds[machine] = 0
+            self.learned[machine] = True
+            self.num_learned += 1
+        self.speeds[machine] += change
+        self.learned_total += change
+        for other in range(self.machines):
+            if other == machine or not self.learned[other]:
+                self.update_load(other)
+
+        return
 
     def add_machine(self, speed=1):
         self.speeds.append(speed)
         self.assignments.append([])
-        self.loads_heap.push((self.machines, 0))
+        self.loads.append(0)
+        self.learned.append(False)
+        self.completed.append(0)
+        self.window_start.append(None)
+        self.penalties.append(0)
+        self.handles.append(self.loads_heap.push(self.machines, 0))
+        self.machines += 1
+
+
+class RoundRobin():
+    '''A scheduler that deals the jobs out to the machines in turn.
+
+    It doesn't look at the loads or the speeds of the machines at all, which
+    makes it a baseline to compare the other schedulers against (see
+    ``simulate``).
+    '''
+    def __init__(self, machines=0):
+        '''
+        :param machines: The number of machines.
+        '''
+        self.machines = machines
+        # The machine to try first for the next job.
+        self.next_machine = 0
+
+    def schedule_job(self, job, machines=None, now=None, preferred=None):
+        '''Schedule the job on the next machine (out of machines) in turn.
+
+        :returns: The machine the job get's scheduled on.
+        '''
+        for _ in range(self.machines):
+            machine = self.next_machine
+            self.next_machine = (self.next_machine + 1) % self.machines
+            if machines is None or machine in machines:
+                return machine
+
+        raise Exception("No machine available")
+
+    def schedule_batch(self, jobs, now=None):
+        '''Schedule the jobs in turn.
+        '''
+        return [self.schedule_job(job, now=now) for job in jobs]
+
+    def complete_job(self, job, machine, now=None):
+        return
+
+    def cancel_job(self, job, machine):
+        return
+
+    def fail_job(self, job, machine):
+        return
+
+    def add_machine(self, speed=1):
         self.machines += 1
@@ -1,12 +1,37 @@
 # Standard imports
+import builtins
+import collections
 import hashlib
+import importlib
 import inspect
 import json
+import linecache
 import os
+import threading
 import types
+import weakref
 
 
-class Serializable:
+# Map of schema keys (see ``Serializable.get_schema``) to schemas.
+_schemas = {}
+# Map of code objects to the normalized source of their function. Entries go
+# away with the functions, so it doesn't grow with every job ever run.
+_sources = weakref.WeakKeyDictionary()
+
+
+class SerializableType(type):
+    '''The metaclass of Serializable.
+
+    Assigning to a class attribute (e.g. ``Splitter.set_split_method``) can
+    change which attributes are methods, so it invalidates the cached
+    schemas.
+    '''
+    def __setattr__(cls, name, value):
+        super().__setattr__(name, value)
+        _schemas.clear()
+
+
+class Serializable(metaclass=SerializableType):
     '''
     This is a base class which provides the basic serialization methods to be
     used from within the class derived from this class.
@@ -15,10 +40,11 @@ class Serializable:
                  noserialize=['__init__', 'noserialize', 'serialize_method',
                               'serialize', 'deserialize', 'get_vars',
                               'get_methods', 'get_serializables', '__class__',
-                              'recursive_serialize'],
+                              'recursive_serialize', 'get_schema'],
                  recursive_serialize=False):
         # List of methods that are not to be serialized.
-        self.noserialize = noserialize
+        # NOTE: This is a copy because subclasses extend it with +=.
+        self.noserialize = list(noserialize)
         # Whether to recursively serialize
         self.recursive_serialize = recursive_serialize
         return
@@ -75,6 +101,16 @@ class Serializable:
         :returns: A string for the source code of the ``method``.
         :rtype: str
         '''
+        # Functions loaded by load_function carry their (normalized) source.
+        source = getattr(method, 'source', None)
+        if isinstance(source, str):
+            return source
+        # Otherwise the source is only read and normalized once per function.
+        code = getattr(method, '__code__', None)
+        try:
+            return _sources[code]
+        except KeyError:
+            pass
         source = inspect.getsource(method)
         # Now remove all white space at the start of each line such that
         # the indentation of the code is maintained and there's no whitespace
@@ -82,9 +118,64 @@ class Serializable:
         whitespace = source.find('def')
         source = '\n'.join([line[whitespace:] for line in source.split('\n')])
         source = source.strip()
+        if code is not None:
+            _sources[code] = source
 
         return source
 
+    def get_schema(self, include_attrs=(), exclude_attrs=()):
+        '''Get the names of the attributes to serialize.
+
+        The schema is computed (see ``get_vars``, ``get_methods`` and
+        ``get_serializables``) once for each class, set of instance attributes
+        and include/exclude lists and cached after that.
+
+        NOTE: This assumes that an instance attribute doesn't change from
+        being a method or a Serializable to being a plain value (or the other
+        way around) once the object has been serialized.
+
+        :returns: A tuple of lists of names of (vars, methods, serializables).
+        :rtype: tuple
+        '''
+        key = (self.__class__, tuple(self.noserialize),
+               self.recursive_serialize, frozenset(self.__dict__),
+               tuple(include_attrs), tuple(exclude_attrs))
+        try:
+            return _schemas[key]
+        except KeyError:
+            pass
+
+        if include_attrs:
+            wanted = lambda name: name in include_attrs
+        elif exclude_attrs:
+            wanted = lambda name: name not in exclude_attrs
+        else:
+            wanted = lambda name: True
+        var_names = [var for var in self.get_vars() if wanted(var)]
+        method_names = []
+        for name, method in self.get_methods().items():
+            if not wanted(name):
+                continue
+            # Only keep the methods whose source can be found.
+            # XXX(mtahmed): This is needed for it to work with pypy
+            # FIXME(mtahmed): Find a better way to do get around this.
+            try:
+                self.serialize_method(method)
+            except:
+                continue
+            method_names.append(name)
+        if self.recursive_serialize:
+            serializable_names = [var for var in dir(self)
+                                  if isinstance(getattr(self, var),
+                                                Serializable) and
+                                  var != '__class__']
+        else:
+            serializable_names = []
+        schema = (var_names, method_names, serializable_names)
+        _schemas[key] = schema
+
+        return schema
+
     def serialize(self, include_attrs=[], exclude_attrs=[], json_encode=False):
         '''Serialize this object.
 
@@ -105,41 +196,17 @@ class Serializable:
         :returns: A serialized representation of this object.
         :rtype: str
         '''
-        all_vars = self.get_vars()
-        all_methods = self.get_methods()
-        if not include_attrs and not exclude_attrs:
-            serialize_vars = all_vars
-            serialize_methods = all_methods
-        elif include_attrs:
-            serialize_vars = {var: value for
-                              var, value in all_vars.items()
-                              if var in include_attrs}
-            serialize_methods = {name: method for
-                                 name, method in all_methods.items()
-                                 if name in include_attrs}
-        elif exclude_attrs:
-            serialize_vars = {var: value for
-                              var, value in all_vars.items()
-                              if var not in exclude_attrs}
-            serialize_methods = {name: method for
-                                 name, method in all_methods.items()
-                                 if name not in exclude_attrs}
+        var_names, method_names, serializable_names = self.get_schema(
+            include_attrs, exclude_attrs)
 
         # Attribute dictionary.
         attr_dict = {}
-        for var, value in serialize_vars.items():
-            attr_dict[var] = value
-        for name, method in serialize_methods.items():
-            # Try to serialize the method. If it fails, ignore it.
-            # XXX(mtahmed): This is needed for it to work with pypy
-            # FIXME(mtahmed): Find a better way to do get around this.
-            try:
-                attr_dict[name] = self.serialize_method(method)
-            except:
-                pass
-        if self.recursive_serialize:
-            for var, value in self.get_serializables().items():
-                attr_dict[var] = value
+        for var in var_names:
+            attr_dict[var] = getattr(self, var)
+        for name in method_names:
+            attr_dict[name] = self.serialize_method(getattr(self, name))
+        for var in serializable_names:
+            attr_dict[var] = getattr(self, var).serialize()
 
         serialized = {'class': self.__module__ + '.' + self.__class__.__name__,
                       'attrs': attr_dict}
@@ -168,7 +235,6 @@ class Serializable:
         :returns: An instance of ``cls`` representing the ``serialized`` string
         :rtype: instance of ``cls``
         '''
-        cls_name = cls.__name__
         if isinstance(serialized, str):
             serialized = json.loads(serialized)
         serialized_attrs = serialized['attrs']
@@ -187,31 +253,22 @@ class Serializable:
                 val = globals()[subclass].deserialize(val)
                 serialized_attrs[key] = val
         # Get the list of arguments to init.
-        argspec = inspect.getargspec(cls.__init__)
+        argspec = inspect.getfullargspec(cls.__init__)
         args = argspec.args
         args_defaults = argspec.defaults
         len_args = 0 if args is None else len(args)
         len_args_defaults = 0 if args_defaults is None else len(args_defaults)
         num_mandatory_args = len_args - len_args_defaults
         serialized_attrs_keys = serialized_attrs.keys()
-        # Execute any functions so that they are defined in local scope.
+        # Compile any functions so that they are defined in local scope.
         # All functions/methods start with 'def ' string.
-        # Also "cache" all the functions. This allows us to implement proper
-        # caching (TODO) and also allows us to get the source for functions.
+        # The functions see the globals of cls's module (so e.g. the default
+        # Splitter.split can still use taskunit) and are cached in memory so
+        # that each source is only compiled once.
         for key, val in serialized_attrs.items():
             if isinstance(val, str) and val.startswith('def '):
-                # The filename for the cached source is:
-                # <cls_name>_<method_name>_<source_md5_hash>.py
-                m = hashlib.md5()
-                m.update(val.encode('utf-8'))
-                md5_hash = m.hexdigest()
-                fname = '%s_%s_%s.py' % (cls_name.lower(), key, md5_hash)
-                f = open(os.path.join('cache_store', fname), mode='w')
-                f.write(val)
-                f.close()
-                pkg = __import__('cache_store', globals(), locals(),
-                                 [fname[:-3]], 0)
-                serialized_attrs[key] = getattr(getattr(pkg, fname[:-3]), key)
+                serialized_attrs[key] = load_function(key, val,
+                                                      module=cls.__module__)
         mandatory_args = []
         for index in range(1, num_mandatory_args):
             mandatory_args.append(serialized_attrs[args[index]])
@@ -236,3 +293,122 @@ class Serializable:
             setattr(deserialized, key, val)
 
         return deserialized
+
+
+
+class FunctionCache:
+    '''An LRU cache of functions compiled from their source.
+
+    Functions are compiled in memory and kept keyed by the digest of their
+    source (and the module whose globals they see). Once the cache holds
+    ``max_size`` functions, the least recently used one is evicted.
+
+    If ``dump_dir`` is set, the source of every compiled function is also
+    written to a file in ``dump_dir`` so that it shows up in tracebacks etc.
+    This is only meant for debugging.
+    '''
+    DEFAULT_MAX_SIZE = 256
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, dump_dir=None):
+        '''
+        :param max_size: The max number of functions to keep.
+        :param dump_dir: If not None, the directory to write sources to.
+        '''
+        self.max_size = max_size
+        self.dump_dir = dump_dir
+        # Map of (module, name, digest) to functions. Most recently used last.
+        self.functions = collections.OrderedDict()
+        # The slave's executor may load functions from several threads.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.functions)
+
+    def load(self, name, source, module=None, digest=None):
+        '''Get the function called name defined by source.
+
+        The function is compiled the first time and taken from the cache after
+        that. The source of the function is kept as its ``source`` attribute
+        (see ``Serializable.serialize_method``).
+
+        :param name: The name of the function defined in source.
+        :param source: The (normalized) source code of the function.
+        :param module: The name of the module whose globals the function
+        should see. The function gets an empty namespace if None.
+        :param digest: The MD5 hex digest of the source, if already known.
+        :returns: The function.
+        '''
+        if digest is None:
+            m = hashlib.md5()
+            m.update(source.encode('utf-8'))
+            digest = m.hexdigest()
+        key = (module, name, digest)
+        with self.lock:
+            try:
+                self.functions.move_to_end(key)
+                return self.functions[key]
+            except KeyError:
+                pass
+
+            function = self.compile(name, source, module, digest)
+            self.functions[key] = function
+            while len(self.functions) > self.max_size:
+                self.functions.popitem(last=False)
+
+        return function
+
+    def compile(self, name, source, module, digest):
+        '''Compile source and return the function called name from it.
+        '''
+        fname = '%s_%s_%s.py' % ((module or 'function').replace('.', '_'),
+                                 name, digest)
+        if self.dump_dir is not None:
+            filename = os.path.join(self.dump_dir, fname)
+            # Several processes may be writing the same source at once, so
+            # write to a temporary file and move it in place atomically.
+            tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+            with open(tmp_filename, mode='w') as f:
+                f.write(source)
+            os.replace(tmp_filename, filename)
+        else:
+            filename = '<antnest %s>' % fname
+
+        if module is None:
+            namespace = {'__name__': 'cache_store',
+                         '__builtins__': builtins}
+        else:
+            namespace = dict(importlib.import_module(module).__dict__)
+        code = compile(source, filename, 'exec')
+        exec(code, namespace)
+        function = namespace[name]
+        function.source = source
+
+        # Register the source with linecache for tracebacks and inspect. An
+        # evicted function may still be in use (e.g. as a job's processor),
+        # so the source is only dropped once the function itself is gone.
+        lines = source.splitlines(keepends=True)
+        entry = (len(source), None, lines, filename)
+        linecache.cache[filename] = entry
+        weakref.finalize(function, _forget_source, filename, entry)
+
+        return function
+
+
+def _forget_source(filename, entry):
+    '''Drop the source registered with linecache for a function that is gone,
+    unless it was registered again (for a newer function) since.
+    '''
+    if linecache.cache.get(filename) is entry:
+        del linecache.cache[filename]
+
+
+# The cache used to load all the deserialized functions in this process.
+function_cache = FunctionCache()
+
+
+def load_function(name, source, module=None, digest=None):
+    '''Load the function called name from its source.
+
+    See ``FunctionCache.load``.
+    '''
+    return function_cache.load(name, source, module=module, digest=digest)
@@ -0,0 +1,391 @@
+'''
+A discrete-event simulator for the schedulers in schedule.py.
+
+A workload (the taskunits, how much work each of them is and when it comes
+in) is replayed on a simulated cluster (slaves of different speeds, some of
+which fail taskunits now and then) the way the master would run it: the
+taskunits are sent to the slaves as they have credit for them, each slave
+runs its taskunits one at a time in the order it got them, and a taskunit
+that fails is sent again to another slave.
+
+A scheduler is used through the same calls the master makes on MinMakespan:
+
+    schedule_job(job, machines=None, now=None) -> machine
+    complete_job(job, machine, now=None)
+    fail_job(job, machine)
+    add_machine(speed=1)
+
+and, to schedule a workload whose taskunits all come in at the start at once,
+
+    schedule_batch(jobs, now=None) -> [machine for each job]
+
+See benchmarks/bench_schedule.py for the command line.
+'''
+# Standard imports
+import collections
+import heapq
+import itertools
+import json
+import math
+import random
+import time
+
+
+class Unit:
+    '''A simulated taskunit.
+    '''
+    def __init__(self, id, size, arrival=0, estimate=None):
+        '''
+        :param id: The number of the unit in its workload.
+        :param size: The work in the unit, i.e. how long it runs for on a
+        machine of speed 1.
+        :param arrival: When the unit comes in (in seconds).
+        :param estimate: The size the scheduler is told. Defaults to size.
+        '''
+        self.id = id
+        self.size = size
+        self.arrival = arrival
+        # The schedulers go by the job_size (see ``CostModel.estimate``).
+        self.job_size = size if estimate is None else estimate
+        # The number of times the unit failed and the machines it failed on.
+        self.failures = 0
+        self.failed_on = set()
+        # When the unit was done (or failed for the last time).
+        self.done = None
+
+
+class Workload:
+    '''The taskunits to simulate.
+    '''
+    SIZES = ('uniform', 'pareto')
+    ARRIVALS = ('batch', 'poisson')
+
+    def __init__(self, units):
+        '''
+        :param units: A list of (size, arrival, estimate) tuples.
+        '''
+        self.units = list(units)
+
+    def __len__(self):
+        return len(self.units)
+
+    def known(self):
+        '''Whether all of the units come in at the start.
+        '''
+        return all(arrival == 0 for _, arrival, _ in self.units)
+
+    def make_units(self):
+        '''Get a fresh Unit for each of the units.
+        '''
+        return [Unit(i, size, arrival, estimate)
+                for i, (size, arrival, estimate) in enumerate(self.units)]
+
+    @staticmethod
+    def estimates(sizes, estimate_error, rand):
+        '''Get estimates of the sizes that are off by a random factor.
+
+        :param estimate_error: The standard deviation of the log of the
+        factor. 0 gives the sizes themselves.
+        '''
+        if not estimate_error:
+            return list(sizes)
+
+        return [size * rand.lognormvariate(0, estimate_error)
+                for size in sizes]
+
+    @classmethod
+    def synthetic(cls, units, sizes='uniform', arrivals='batch', rate=None,
+                  estimate_error=0, seed=0):
+        '''Make up a workload.
+
+        :param units: The number of units.
+        :param sizes: 'uniform' for sizes between 0.5 and 1.5 or 'pareto' for
+        a few very large units among many small ones (mean of about 1).
+        :param arrivals: 'batch' for all the units to come in at the start
+        or 'poisson' for them to come in at random at the given rate (units
+        per second).
+        :param estimate_error: How far off the sizes the scheduler is told
+        are (see ``estimates``).
+        :param seed: The seed for the random numbers.
+        '''
+        rand = random.Random(seed)
+        if sizes == 'uniform':
+            unit_sizes = [rand.uniform(0.5, 1.5) for _ in range(units)]
+        elif sizes == 'pareto':
+            unit_sizes = [rand.paretovariate(1.5) / 3 for _ in range(units)]
+        else:
+            raise ValueError('Unknown sizes: %s' % sizes)
+        if arrivals == 'batch':
+            times = [0 for _ in range(units)]
+        elif arrivals == 'poisson':
+            if not rate:
+                raise ValueError('Poisson arrivals need a rate.')
+            times = list(itertools.accumulate(rand.expovariate(rate)
+                                              for _ in range(units)))
+        else:
+            raise ValueError('Unknown arrivals: %s' % arrivals)
+        estimates = cls.estimates(unit_sizes, estimate_error, rand)
+
+        return cls(zip(unit_sizes, times, estimates))
+
+    @classmethod
+    def load(cls, path, estimate_error=0, seed=0):
+        '''Load a recorded workload.
+
+        The file has a JSON object for each unit on its own line, with the
+        unit's "size" and, optionally, its "arrival" and "estimate".
+        '''
+        rand = random.Random(seed)
+        units = []
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                unit = json.loads(line)
+                size = unit['size']
+                estimate = unit.get('estimate')
+                if estimate is None:
+                    estimate = cls.estimates([size], estimate_error, rand)[0]
+                units.append((size, unit.get('arrival', 0), estimate))
+
+        return cls(units)
+
+
+class Cluster:
+    '''The simulated slaves.
+    '''
+    def __init__(self, speeds, failure_rates=(), max_inflight=64, seed=0):
+        '''
+        :param speeds: The speed of each slave.
+        :param failure_rates: The chance of each slave failing a unit it
+        runs (after running it). Defaults to 0 for all of them.
+        :param max_inflight: The number of units each slave can have in
+        flight at any time (see ``Master``).
+        :param seed: The seed for the random numbers.
+        '''
+        self.speeds = list(speeds)
+        self.failure_rates = list(failure_rates) or [0 for _ in self.speeds]
+        if len(self.failure_rates) != len(self.speeds):
+            raise ValueError("failure_rates should be the same length as "
+                             "speeds or empty")
+        self.max_inflight = max_inflight
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.speeds)
+
+
+class Result:
+    '''What came of simulating a workload.
+    '''
+    def __init__(self, units, busy, decisions, scheduler_time, failures):
+        '''
+        :param units: The units, all done.
+        :param busy: How long each machine was busy for.
+        :param decisions: How many times a unit was scheduled.
+        :param scheduler_time: The CPU time (in seconds) spent in the
+        scheduler.
+        :param failures: How many times a unit failed.
+        '''
+        self.makespan = max((unit.done for unit in units), default=0)
+        self.latencies = sorted(unit.done - unit.arrival for unit in units)
+        self.busy = busy
+        self.decisions = decisions
+        self.scheduler_time = scheduler_time
+        self.failures = failures
+
+    def mean_latency(self):
+        if not self.latencies:
+            return 0
+
+        return sum(self.latencies) / len(self.latencies)
+
+    def percentile_latency(self, percentile):
+        '''Get the latency that percentile percent of the units are done in.
+        '''
+        if not self.latencies:
+            return 0
+        index = math.ceil(percentile / 100 * len(self.latencies)) - 1
+
+        return self.latencies[max(0, index)]
+
+    def utilization(self):
+        '''Get the fraction of the time the machines were busy for.
+        '''
+        if not self.makespan:
+            return 0
+
+        return sum(self.busy) / (len(self.busy) * self.makespan)
+
+    def time_per_decision(self):
+        '''Get the CPU time (in seconds) spent in the scheduler for each unit
+        scheduled.
+        '''
+        if not self.decisions:
+            return 0
+
+        return self.scheduler_time / self.decisions
+
+    def summary(self):
+        return {'makespan': self.makespan,
+                'mean_latency': self.mean_latency(),
+                'p99_latency': self.percentile_latency(99),
+                'utilization': self.utilization(),
+                'time_per_decision': self.time_per_decision(),
+                'failures': self.failures}
+
+
+class Simulator:
+    '''Runs a workload on a cluster with a scheduler.
+    '''
+    # Kinds of events.
+    ARRIVAL = 0
+    DONE = 1
+
+    def __init__(self, workload, cluster, scheduler, batch=False,
+                 max_retries=3):
+        '''
+        :param workload: The Workload to run.
+        :param cluster: The Cluster to run it on.
+        :param scheduler: A scheduler with no machines.
+        :param batch: Whether to schedule the units that come in at the start
+        all at once (with ``schedule_batch``).
+        :param max_retries: How many times a unit is sent again after it
+        fails.
+        '''
+        self.workload = workload
+        self.cluster = cluster
+        self.scheduler = scheduler
+        self.batch = batch
+        self.max_retries = max_retries
+
+    def run(self):
+        '''Run the simulation.
+
+        :rtype: Result
+        '''
+        cluster = self.cluster
+        machines = len(cluster)
+        for speed in cluster.speeds:
+            self.scheduler.add_machine(speed)
+        self.rand = random.Random(cluster.seed)
+        self.events = []
+        self.count = 0
+        self.now = 0
+        # queues[i] = the units sent to machine i that it hasn't started
+        self.queues = [collections.deque() for _ in range(machines)]
+        self.running = [None for _ in range(machines)]
+        self.inflight = [0 for _ in range(machines)]
+        self.available = set(range(machines))
+        self.busy = [0 for _ in range(machines)]
+        self.pending = collections.deque()
+        self.decisions = 0
+        self.scheduler_time = 0
+        self.failures = 0
+        self.done_units = []
+
+        units = self.workload.make_units()
+        if self.batch:
+            planned = [unit for unit in units if unit.arrival == 0]
+            self.plan(planned)
+            units = [unit for unit in units if unit.arrival != 0]
+        for unit in units:
+            self.push(unit.arrival, self.ARRIVAL, unit)
+        while self.events:
+            self.now, _, kind, item = heapq.heappop(self.events)
+            if kind == self.ARRIVAL:
+                self.pending.append(item)
+            else:
+                self.finish(item)
+            self.dispatch()
+
+        return Result(self.done_units, self.busy, self.decisions,
+                      self.scheduler_time, self.failures)
+
+    def push(self, when, kind, item):
+        '''Add an event.
+        '''
+        heapq.heappush(self.events, (when, self.count, kind, item))
+        self.count += 1
+
+    def plan(self, units):
+        '''Schedule the units all at once and queue them on their machines.
+
+        The units planned for a machine are sent to it as it has credit for
+        them in the master, so they are just queued up here.
+        '''
+        if not units:
+            return
+        start = time.perf_counter()
+        machines = self.scheduler.schedule_batch(units, now=self.now)
+        self.scheduler_time += time.perf_counter() - start
+        self.decisions += len(units)
+        for i in sorted(range(len(units)), key=lambda i: units[i].job_size,
+                        reverse=True):
+            self.queues[machines[i]].append(units[i])
+        for machine in range(len(self.queues)):
+            self.start_next(machine)
+
+        return
+
+    def dispatch(self):
+        '''Send the pending units to the machines that have credit for them.
+        '''
+        while self.pending and self.available:
+            unit = self.pending.popleft()
+            # A unit that failed goes to a machine it didn't fail on, if
+            # there's one.
+            machines = self.available - unit.failed_on or self.available
+            start = time.perf_counter()
+            machine = self.scheduler.schedule_job(unit, machines=machines,
+                                                  now=self.now)
+            self.scheduler_time += time.perf_counter() - start
+            self.decisions += 1
+            self.inflight[machine] += 1
+            if self.inflight[machine] >= self.cluster.max_inflight:
+                self.available.discard(machine)
+            self.queues[machine].append(unit)
+            self.start_next(machine)
+
+        return
+
+    def start_next(self, machine):
+        '''Start the next unit queued on the machine, if it's idle.
+        '''
+        if self.running[machine] is not None or not self.queues[machine]:
+            return
+        unit = self.queues[machine].popleft()
+        self.running[machine] = unit
+        run_time = unit.size / self.cluster.speeds[machine]
+        self.busy[machine] += run_time
+        self.push(self.now + run_time, self.DONE, machine)
+
+        return
+
+    def finish(self, machine):
+        '''The unit running on the machine is done (or failed).
+        '''
+        unit = self.running[machine]
+        self.running[machine] = None
+        if self.inflight[machine]:
+            self.inflight[machine] -= 1
+            self.available.add(machine)
+        failed = self.rand.random() < self.cluster.failure_rates[machine]
+        start = time.perf_counter()
+        if failed:
+            self.scheduler.fail_job(unit, machine)
+        else:
+            self.scheduler.complete_job(unit, machine, now=self.now)
+        self.scheduler_time += time.perf_counter() - start
+        if failed:
+            self.failures += 1
+            unit.failures += 1
+            unit.failed_on.add(machine)
+        if failed and unit.failures <= self.max_retries:
+            self.pending.appendleft(unit)
+        else:
+            unit.done = self.now
+            self.done_units.append(unit)
+        self.start_next(machine)
+
+        return
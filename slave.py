@@ -1,13 +1,22 @@
 # Standard imports
+import asyncio
+import collections
 import os
 import socket
+import tempfile
 import time
+import traceback
 
 # Custom imports
+import blobstore
+import codec
+import coderegistry
+import executor
+import job
 import messenger
 import message
 import node
-import taskunit
+import serialize
 
 
 class Slave(node.LocalNode):
@@ -15,23 +24,81 @@ class Slave(node.LocalNode):
 
     A slave node can accept work units from a master and process and send the
     results back.
+
+    The results of the TaskUnits of jobs that are pushed down are combined on
+    the slave (see ``job.Partial``). A partial result is sent back once it
+    has ``partial_size`` results in it, once it is ``partial_delay`` seconds
+    old, or once the slave runs out of TaskUnits to run.
+
+    Masters in pull mode tell the slave (with a PULL message) to ask them for
+    TaskUnits. The slave asks for more (with a WORK message) whenever it has
+    less than half of ``prefetch`` TaskUnits queued, running or asked for.
+    Such a master can also ask the slave to give back queued TaskUnits (with
+    a STEAL message) so that they can be run on an idle slave.
+
+    The data of large TaskUnits is sent separately, as a blob, and kept in a
+    BlobStore of up to ``blob_cache_bytes`` bytes in memory, with the rest
+    spilled to ``blob_spill_dir``. A TaskUnit whose blob isn't there (any
+    more) waits for it while the slave asks the master for it again (with a
+    FETCH message).
     '''
-    def __init__(self, port, ip=None):
+    DEFAULT_PARTIAL_SIZE = 32
+    DEFAULT_PARTIAL_DELAY = 0.05
+    DEFAULT_BLOB_CACHE_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, port, ip=None, workers=None):
         '''
         :param port: port number to run this slave on.
+        :param workers: number of processes to run TaskUnits on. Overrides the
+        ``workers`` config value. Defaults to the number of cores.
         '''
         config_filename = '%s-slave-config.json' % socket.gethostname()
         config_path = os.path.join('config', config_filename)
 
         super().__init__(config_path=config_path)
 
-        self.task_q = []
+        # Queue of (address, serialized TaskUnit) waiting to be run.
+        self.task_q = collections.deque()
+        # The code (processors etc.) the masters have sent to this slave.
+        self.code = coderegistry.CodeRegistry()
+        # Map of blob digests to the (address, serialized TaskUnit) waiting
+        # for the blob to be fetched from the master.
+        self.fetching = {}
+        # Map of (master address, job id) to the job's Partial.
+        self.partials = {}
+        # Masters in pull mode and the number of TaskUnits asked from each.
+        self.pull_masters = set()
+        self.requested = collections.Counter()
         self.master_nodes = []
         self.config['port'] = port
+        if workers:
+            self.config['workers'] = workers
+        serialize.function_cache.max_size = self.config.get(
+            'code_cache_size', serialize.FunctionCache.DEFAULT_MAX_SIZE)
+        self.config.setdefault('partial_size', self.DEFAULT_PARTIAL_SIZE)
+        self.config.setdefault('partial_delay', self.DEFAULT_PARTIAL_DELAY)
+        self.config.setdefault('blob_cache_bytes',
+                               self.DEFAULT_BLOB_CACHE_BYTES)
+        self.config.setdefault('blob_spill_dir', os.path.join(
+            tempfile.gettempdir(), 'antnest-blobs-%d' % port))
+        # The blobs (data of large TaskUnits) the masters have sent.
+        self.blobs = blobstore.BlobStore(
+            max_bytes=self.config['blob_cache_bytes'],
+            spill_dir=self.config['blob_spill_dir'])
+
+        self.executor = executor.TaskUnitExecutor(
+            workers=self.config.get('workers'))
+        self.config.setdefault('prefetch', 2 * self.executor.max_pending)
 
         messenger_type = messenger.ZMQMessenger.TYPE_CLIENT
-        self.messenger = messenger.ZMQMessenger(type=messenger_type,
-                                                port=self.config['port'])
+        self.messenger = messenger.AsyncZMQMessenger(
+            type=messenger_type,
+            port=self.config['port'],
+            batch_size=self.config.get(
+                'batch_size', messenger.ZMQMessenger.DEFAULT_BATCH_SIZE),
+            batch_delay=self.config.get(
+                'batch_delay', messenger.ZMQMessenger.DEFAULT_BATCH_DELAY),
+            codecs=self.config.get('codecs', codec.DEFAULT_CODECS))
         self.messenger.start()
 
         for master in self.config['masters']:
@@ -52,41 +119,246 @@ class Slave(node.LocalNode):
             self.messenger.register_destination(master_hostname,
                                                 (master_ip, master_port))
 
-        # When everything is setup, associate with the master(s).
-        self.associate()
-
         return
 
-    def associate(self):
+    async def associate(self):
         '''Associate with the master(s).
 
         This involves sending a status update to the master.
         '''
         for master in self.master_nodes:
-            self.messenger.connect(master.address)
+            await self.messenger.connect(master.address)
             print("Connected to %s:%s" % master.address)
+            # Let the master know what code it doesn't need to send (e.g.
+            # if it was restarted or already sent it for another master).
+            digests = list(self.code.sources) + self.blobs.digests()
+            self.messenger.send_serialized(
+                {'class': 'CACHED', 'digests': digests}, master.address)
 
         return
 
     def worker(self):
-        '''The main worker loop.
+        '''The main worker loop. Runs ``run`` on an asyncio event loop.
+        '''
+        asyncio.run(self.run())
+
+    async def run(self):
+        '''The main coroutine.
 
-        This method keeps running for the life of Slave. It asks for new
-        messages from this Slave's messenger. It then appropriately handles the
-        message. Some of the messages are TaskUnits that need to be run.
+        This keeps running for the life of Slave. It associates with the
+        master(s) while the ``receiver`` handles the messages from this
+        Slave's messenger as they come (including the PONGs of the masters).
 
-        If the message happens to be a TaskUnit, then this method
-        executes the run() method of the TaskUnit and waits for it to complete.
-        It then sets the status of the TaskUnit appropriately and sends the it
-        back to the master through the messenger.
+        TaskUnits on the task queue are run on the executor's pool of
+        processes. The ``results`` coroutine sends their results back to the
+        master as soon as they finish.
         '''
-        for address, msg in self.messenger.receive(deserialize=False):
+        loop = asyncio.get_running_loop()
+        self.results_ready = asyncio.Event()
+        self.executor.on_done = (
+            lambda future: loop.call_soon_threadsafe(self.results_ready.set))
+        receiver = asyncio.create_task(self.receiver())
+        tasks = [asyncio.create_task(self.messenger.sender()),
+                 asyncio.create_task(self.messenger.flusher()),
+                 self.start_task(self.results),
+                 self.start_task(self.partial_flusher)]
+
+        # When everything is setup, associate with the master(s).
+        await self.associate()
+        await receiver
 
-            if msg == 'PONG':
+    async def receiver(self):
+        '''Handle the messages from the masters as they come. Forever.
+
+        Some of the messages are TaskUnits that need to be run. They are put
+        on the task queue.
+        '''
+        async for address, msg in self.messenger.receive():
+            if msg['class'] == 'PONG':
                 print("SLAVE: PONG from %s:%d" % address)
+            elif msg['class'] == coderegistry.CodeRegistry.CLASS:
+                self.code.add(msg['source'], msg['digest'])
+            elif msg['class'] == blobstore.BlobStore.CLASS:
+                self.add_blob(msg['attrs']['digest'], msg['attrs']['data'])
             elif msg['class'] == 'taskunit.TaskUnit':
-                #object_dict = msg.msg_payload.decode('utf-8')
-                tu = taskunit.TaskUnit.deserialize(msg)
-                # TODO(mtahmed): Run this in a new thread? Maybe? Investigate.
-                tu.run()
-                self.messenger.send_taskunit_result(tu, address)
+                if self.requested[address] > 0:
+                    self.requested[address] -= 1
+                self.task_q.append((address, msg))
+                self.run_taskunits()
+            elif msg['class'] == 'PULL':
+                self.pull_masters.add(address)
+                self.requested[address] = 0
+                self.request_work()
+            elif msg['class'] == 'STEAL':
+                self.release_taskunits(address, msg['count'], msg.get('jobs'))
+
+    async def results(self):
+        '''Send back the results of the TaskUnits as they finish. Forever.
+        '''
+        while True:
+            await self.results_ready.wait()
+            self.results_ready.clear()
+            for address, result in self.executor.completed():
+                if not self.add_to_partial(address, result):
+                    self.messenger.send_serialized(result, address)
+            # There is room on the executor for more now.
+            self.run_taskunits()
+            self.request_work()
+            if not self.task_q and not self.executor.running:
+                # Nothing more is coming for now. Don't sit on the partials.
+                self.flush_partials()
+            await self.messenger.drain()
+
+    def request_work(self):
+        '''Ask the masters in pull mode for more TaskUnits if running low.
+        '''
+        prefetch = self.config['prefetch']
+        for address in self.pull_masters:
+            queued = (len(self.task_q) + len(self.executor.running) +
+                      sum(self.requested.values()))
+            if queued > prefetch // 2:
+                return
+            count = prefetch - queued
+            self.requested[address] += count
+            self.messenger.send_serialized({'class': 'WORK', 'count': count},
+                                           address)
+
+        return
+
+    def release_taskunits(self, address, count, jobs=None):
+        '''Give back up to count of the queued TaskUnits of the master.
+
+        The TaskUnits are taken from the back of the queue, i.e. the ones
+        that would have been run last.
+
+        :param jobs: If given, only the TaskUnits of these jobs (ids) are
+        given back (see ``Master.preempt``).
+        '''
+        if jobs is not None:
+            jobs = set(jobs)
+        released = []
+        kept = collections.deque()
+        while self.task_q and len(released) < count:
+            item = self.task_q.pop()
+            item_address, serialized = item
+            attrs = serialized['attrs']
+            if item_address == address and (jobs is None or
+                                            attrs['job_id'] in jobs):
+                released.append([attrs['job_id'], attrs['id']])
+            else:
+                kept.appendleft(item)
+        self.task_q.extend(kept)
+        self.messenger.send_serialized({'class': 'RELEASE',
+                                        'taskunits': released}, address)
+
+        return
+
+    async def partial_flusher(self):
+        '''Send back the partials that are due. Forever.
+        '''
+        while True:
+            await asyncio.sleep(self.config['partial_delay'])
+            self.flush_partials(max_age=self.config['partial_delay'])
+
+    def add_to_partial(self, address, result):
+        '''Combine the result into its job's partial if the job is pushed down.
+
+        :param address: The address of the master the result is for.
+        :param result: The serialized TaskUnit that finished running.
+        :returns: Whether the result was added to a partial. If not, it needs
+        to be sent back to the master as is.
+        :rtype: bool
+        '''
+        attrs = result['attrs']
+        digest = attrs.get('combiner_digest')
+        # Only completed results are combined. The master needs to know about
+        # the others.
+        if attrs['state'] != 'COMPLETED' or digest not in self.code:
+            return False
+
+        key = (address, attrs['job_id'])
+        try:
+            try:
+                partial = self.partials[key]
+            except KeyError:
+                partial = job.Partial(attrs['job_id'],
+                                      self.code.get_function(digest))
+            partial.add(result)
+        except Exception:
+            # The master couldn't combine the result either. It's sent back
+            # as BAILED so that the job still finishes.
+            print("SLAVE: Failed to combine a result of job %s." %
+                  attrs['job_id'])
+            traceback.print_exc()
+            attrs['state'] = 'BAILED'
+            attrs['result'] = None
+            return False
+        self.partials[key] = partial
+        if len(partial) >= self.config['partial_size']:
+            self.send_partial(key)
+
+        return True
+
+    def send_partial(self, key):
+        '''Send the partial for key back to the master and start a new one.
+        '''
+        address, _ = key
+        partial = self.partials.pop(key)
+        self.messenger.send_serialized(partial.message(), address)
+
+        return
+
+    def flush_partials(self, max_age=0):
+        '''Send back the partials that are at least max_age seconds old.
+        '''
+        now = time.time()
+        for key, partial in list(self.partials.items()):
+            if now - partial.created >= max_age:
+                self.send_partial(key)
+
+        return
+
+    def run_taskunits(self):
+        '''Hand queued TaskUnits to the executor while it has capacity.
+        '''
+        while self.task_q and self.executor.has_capacity():
+            address, serialized = self.task_q.popleft()
+            blob_digest = serialized['attrs'].get('blob_digest')
+            if blob_digest is not None:
+                try:
+                    serialized['attrs']['data'] = self.blobs.get(blob_digest)
+                except KeyError:
+                    self.fetch_blob(address, serialized, blob_digest)
+                    continue
+            digest = serialized['attrs'].get('processor_digest')
+            # If the processor is unknown, the executor reports the taskunit
+            # as BAILED.
+            processor_source = self.code.sources.get(digest)
+            self.executor.submit(serialized, address, processor_source)
+
+        return
+
+    def fetch_blob(self, address, serialized, digest):
+        '''Park the TaskUnit until its blob comes in and ask the master for
+        the blob if no other TaskUnit is already waiting for it.
+        '''
+        waiting = self.fetching.setdefault(digest, [])
+        waiting.append((address, serialized))
+        if len(waiting) == 1:
+            print('SLAVE: Fetching blob %s' % digest)
+            self.messenger.send_serialized(
+                {'class': 'FETCH', 'digests': [digest]}, address)
+
+        return
+
+    def add_blob(self, digest, data):
+        '''Keep a blob the master sent and queue up the TaskUnits waiting
+        for it.
+        '''
+        self.blobs.put(data, digest)
+        waiting = self.fetching.pop(digest, [])
+        self.task_q.extendleft(reversed(waiting))
+        if waiting:
+            self.run_taskunits()
+
+        return
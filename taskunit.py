@@ -1,7 +1,9 @@
 # Standard imports
+import array
 import hashlib
 import inspect
 import serialize
+import time
 import types
 
 
@@ -23,9 +25,20 @@ class TaskUnit(serialize.Serializable):
         - tuple of either of the above
         - dictionary with key/values of either of the above type
         - byte array
+      Large buffers (bytes, bytearray, array) are sent without being copied
+      and arrive on the slave as memoryviews (see ``codec.PickleCodec``).
+      They are copied back into bytes (or an array) before being passed to
+      the processor unless accepts_memoryview is True.
     # processor: A method that takes Data (see previous) and processes it in
       some way to produce the result e.g. the processor could be a method which
       factorizes a number and produces a list of factors.
+    # batched: If True, data is a list of items (e.g. lines of the input) and
+      the processor is run on each of them. The result is then the list of
+      their results. See ``unbatch``.
+    # keyed: If True, data is a list of (key, value) pairs and the processor
+      is a reduce. It's run as processor(key, values) for each key with the
+      values for that key. The result is then the list of (key, reduced
+      value) pairs.
     # run: This method calls the processor(see #2) with with the data(see #1).
       It then returns the result which is then put into the task unit's
       result(see #4) attribute.
@@ -63,7 +76,7 @@ class TaskUnit(serialize.Serializable):
               'COMPLETED')
 
     def __init__(self, id=None, job_id=None, data=None, processor=None,
-                 retries=0, state='DEFINED'):
+                 retries=0, state='DEFINED', batched=False, keyed=False):
         '''
         :param id: The TaskUnit id. (see ``compute_id`` method)
         :param job_id: The id of the Job this TaskUnit is part of.
@@ -71,13 +84,32 @@ class TaskUnit(serialize.Serializable):
         :param processor: Processes data to produce the required results.
         :param retries: Number of retries after failures allowed.
         :param state: The state of the TaskUnit. (see ``STATES``)
+        :param batched: Whether data is a list of items to run the processor
+        on one at a time.
+        :param keyed: Whether data is a list of (key, value) pairs to reduce
+        with the processor.
         '''
         super().__init__()
         self.noserialize += ['STATES', 'set_processor', 'setstate', 'run',
-                             'retries', 'compute_id']
+                             'compute_id', 'unbatch', 'results']
         self.id = id
         self.job_id = job_id
         self.data = data
+        self.batched = batched
+        self.keyed = keyed
+        # How long (in seconds) running the processor took on the slave.
+        self.run_time = None
+        # The digest of the processor's source (see ``CodeRegistry``). Sent to
+        # the slaves instead of the processor itself.
+        self.processor_digest = None
+        # The digest of the accumulate method of the job's combiner if the
+        # slave is to combine the result itself (see ``job.Partial``).
+        self.combiner_digest = None
+        # Whether the processor can take a memoryview as its data.
+        self.accepts_memoryview = False
+        # The digest of the data if it is sent to the slaves as a blob
+        # instead (see ``BlobStore``).
+        self.blob_digest = None
         if processor:
             self.set_processor(processor)
         if retries >= 0:
@@ -110,8 +142,21 @@ class TaskUnit(serialize.Serializable):
         get the desired results into the task unit.
         '''
         self.setstate('RUNNING')
+        data = self.data
+        if isinstance(data, memoryview) and not self.accepts_memoryview:
+            data = TaskUnit.copy_buffer(data)
+        start = time.perf_counter()
         try:
-            result = self.processor(self.data)
+            if self.batched:
+                result = [self.processor(item) for item in data]
+            elif self.keyed:
+                groups = {}
+                for key, value in data:
+                    groups.setdefault(key, []).append(value)
+                result = [[key, self.processor(key, values)]
+                          for key, values in groups.items()]
+            else:
+                result = self.processor(data)
             self.result = result
             self.setstate('COMPLETED')
         except Exception:
@@ -120,12 +165,69 @@ class TaskUnit(serialize.Serializable):
             else:
                 self.state = 'FAILED'
                 self.retries -= 1
+        self.run_time = time.perf_counter() - start
+
+    def unbatch(self):
+        '''Get a TaskUnit for each item of this batched TaskUnit.
+
+        The TaskUnits have the item as their data and its result as their
+        result. They all have the state of this TaskUnit. For a keyed
+        TaskUnit, there's a TaskUnit for each key with the key as its data and
+        the reduced value as its result.
+
+        :rtype: list
+        '''
+        if self.keyed:
+            taskunits = []
+            for key, value in self.results():
+                tu = TaskUnit(job_id=self.job_id, data=key, state=self.state)
+                tu.result = value
+                taskunits.append(tu)
+            return taskunits
+        if not self.batched:
+            return [self]
+
+        taskunits = []
+        for item, result in zip(self.data, self.results()):
+            tu = TaskUnit(job_id=self.job_id, data=item, state=self.state)
+            tu.result = result
+            taskunits.append(tu)
+
+        return taskunits
+
+    def results(self):
+        '''Get the list of results of the items of this TaskUnit.
+
+        That is just [result] unless the TaskUnit is batched. The results of
+        the items of a batched TaskUnit that didn't complete are None. The
+        results of a keyed TaskUnit are its (key, reduced value) pairs, if it
+        completed.
+
+        :rtype: list
+        '''
+        if self.keyed:
+            return self.result if self.state == 'COMPLETED' else []
+        if not self.batched:
+            return [self.result]
+        if self.state == 'COMPLETED':
+            return self.result
+
+        return [None] * len(self.data)
 
     def processor(self):
         '''The function that is applied to the data to produce results.
         '''
         pass
 
+    @staticmethod
+    def copy_buffer(view):
+        '''Copy the memoryview into bytes (or an array for typed views).
+        '''
+        if view.format == 'B':
+            return view.tobytes()
+
+        return array.array(view.format, view)
+
     @staticmethod
     def compute_id(data, processor_code):
         '''Compute the taskunit_id.
@@ -134,18 +236,18 @@ class TaskUnit(serialize.Serializable):
         data and the processor_code.
         '''
         m = hashlib.md5()
-        if isinstance(data, bytes):
-            data_bytes = data
+        # Buffers are hashed in place to avoid copying large data.
+        if isinstance(data, (bytes, bytearray, memoryview, array.array)):
+            m.update(data)
+        elif isinstance(data, str):
+            m.update(bytes(data, 'UTF-8'))
         else:
-            data_bytes = bytes(data, 'UTF-8')
+            # E.g. the list of lines of a batched TaskUnit.
+            m.update(bytes(repr(data), 'UTF-8'))
 
         if isinstance(processor_code, bytes):
-            processor_code_bytes = processor_code
+            m.update(processor_code)
         else:
-            processor_code_bytes = bytes(processor_code, 'UTF-8')
-
-        hashable = (data_bytes +
-                    processor_code_bytes)
-        m.update(hashable)
+            m.update(bytes(processor_code, 'UTF-8'))
 
         return m.hexdigest()
@@ -0,0 +1,67 @@
+import array
+
+import blobstore
+
+
+def test_put_get():
+    store = blobstore.BlobStore()
+    digest = store.put(b'x' * 100)
+    assert digest == blobstore.BlobStore.compute_digest(b'x' * 100)
+    assert digest in store
+    assert store.get(digest) == b'x' * 100
+    assert store.put(b'x' * 100) == digest
+    assert len(store) == 1
+
+
+def test_digests():
+    compute_digest = blobstore.BlobStore.compute_digest
+    assert compute_digest('abc') != compute_digest(b'abc')
+    assert compute_digest(b'abc') == compute_digest(memoryview(b'abc'))
+    assert compute_digest(array.array('i', [1])) != compute_digest(
+        array.array('I', [1]))
+
+
+def test_get_missing():
+    store = blobstore.BlobStore()
+    try:
+        store.get('missing')
+    except KeyError:
+        pass
+    else:
+        assert False
+
+
+def test_evict():
+    store = blobstore.BlobStore(max_bytes=250)
+    first = store.put(b'a' * 100)
+    second = store.put(b'b' * 100)
+    store.get(first)
+    third = store.put(b'c' * 100)
+    # The least recently used blob is dropped.
+    assert second not in store
+    assert first in store and third in store
+    assert store.nbytes == 200
+
+
+def test_spill(tmp_path):
+    store = blobstore.BlobStore(max_bytes=150, spill_dir=str(tmp_path))
+    first = store.put(memoryview(b'a' * 100))
+    second = store.put('b' * 100)
+    assert first in store.spilled
+    assert sorted(store.digests()) == sorted([first, second])
+    # It's read back in (and the other one spilled) when it's used again.
+    assert store.get(first) == b'a' * 100
+    assert second in store.spilled
+    assert store.get(second) == 'b' * 100
+
+
+def test_discard(tmp_path):
+    store = blobstore.BlobStore(max_bytes=150, spill_dir=str(tmp_path))
+    first = store.put(b'a' * 100)
+    second = store.put(b'b' * 100)
+    store.discard(first)
+    store.discard(second)
+    store.discard('missing')
+    assert len(store) == 0
+    assert store.nbytes == 0
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,64 @@
+import array
+
+import pytest
+
+import codec
+
+
+MSG = {'class': 'taskunit.TaskUnit',
+       'attrs': {'id': 'abc', 'data': [1, 2.5, 'three'], 'result': None}}
+
+
+@pytest.mark.parametrize('c', [codec.JSON, codec.PICKLE])
+def test_roundtrip(c):
+    assert c.decode(c.encode(MSG)) == [MSG]
+
+
+@pytest.mark.parametrize('c', [codec.JSON, codec.PICKLE])
+def test_batch(c):
+    msgs = [MSG, {'class': 'PING'}, MSG]
+    payload = c.pack_batch([c.encode(msg) for msg in msgs])
+    assert c.decode(payload) == msgs
+
+
+def test_pickle_bytes():
+    msg = {'class': 'taskunit.TaskUnit', 'attrs': {'data': b'\x00\xff'}}
+    assert codec.PICKLE.decode(codec.PICKLE.encode(msg)) == [msg]
+
+
+def test_negotiate():
+    assert codec.negotiate(['pickle5', 'json'], ['json', 'pickle5']) is (
+        codec.PICKLE)
+    assert codec.negotiate(['json', 'pickle5'], ['pickle5', 'json']) is (
+        codec.JSON)
+    assert codec.negotiate(['pickle5'], ['msgpack']) is codec.JSON
+
+
+def test_out_of_band():
+    data = b'x' * codec.PickleCodec.OUT_OF_BAND_THRESHOLD
+    msg = {'class': 'taskunit.TaskUnit', 'attrs': {'id': 'a', 'data': data}}
+    payload, buffers = codec.PICKLE.encode_frames(msg)
+    assert len(buffers) == 1
+    assert len(payload) < len(data)
+    [decoded] = codec.PICKLE.decode(payload, [memoryview(b) for b in buffers])
+    assert isinstance(decoded['attrs']['data'], memoryview)
+    assert decoded['attrs']['data'] == data
+    # The original message is left alone.
+    assert msg['attrs']['data'] is data
+
+
+def test_out_of_band_array():
+    data = array.array('d', range(codec.PickleCodec.OUT_OF_BAND_THRESHOLD))
+    msg = {'class': 'taskunit.TaskUnit', 'attrs': {'data': data}}
+    payload, buffers = codec.PICKLE.encode_frames(msg)
+    [decoded] = codec.PICKLE.decode(payload, [memoryview(b) for b in buffers])
+    view = decoded['attrs']['data']
+    assert view.format == 'd'
+    assert view.tolist() == data.tolist()
+
+
+def test_small_memoryview():
+    msg = {'class': 'taskunit.TaskUnit', 'attrs': {'data': memoryview(b'ab')}}
+    payload, buffers = codec.PICKLE.encode_frames(msg)
+    assert buffers == []
+    assert codec.PICKLE.decode(payload)[0]['attrs']['data'] == b'ab'
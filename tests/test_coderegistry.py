@@ -0,0 +1,40 @@
+import coderegistry
+
+
+SOURCE = 'def double(self, x):\n    return 2 * x'
+
+
+def test_add_and_get():
+    code = coderegistry.CodeRegistry()
+    digest = code.add(SOURCE)
+    assert digest == coderegistry.CodeRegistry.compute_digest(SOURCE)
+    assert digest in code
+    assert code.get_source(digest) == SOURCE
+    assert code.get_function(digest)(None, 21) == 42
+    assert 'other' not in code
+
+
+def test_add_keeps_source():
+    code = coderegistry.CodeRegistry()
+    digest = code.add(SOURCE)
+    assert code.add('def other(self):\n    pass', digest) == digest
+    assert code.get_source(digest) == SOURCE
+
+
+def test_add_replaces_missing_source():
+    code = coderegistry.CodeRegistry()
+    digest = coderegistry.CodeRegistry.compute_digest(SOURCE)
+    code.add(None, digest)
+    code.add(SOURCE, digest)
+    assert code.get_source(digest) == SOURCE
+
+
+def test_function_name():
+    assert coderegistry.CodeRegistry.function_name(SOURCE) == 'double'
+
+
+def test_message():
+    digest = coderegistry.CodeRegistry.compute_digest(SOURCE)
+    assert coderegistry.CodeRegistry.message(digest, SOURCE) == {
+        'class': coderegistry.CodeRegistry.CLASS, 'digest': digest,
+        'source': SOURCE}
@@ -0,0 +1,29 @@
+import array
+
+import costmodel
+
+
+def test_input_size():
+    size = costmodel.CostModel.input_size
+    assert size('abcd') == 4
+    assert size(b'ab') == 2
+    assert size(memoryview(b'abc')) == 3
+    assert size(bytearray(5)) == 5
+    assert size(array.array('d', range(100000))) == 800000
+    assert size(memoryview(array.array('i', range(10)))) == 40
+    assert size(['ab', 'cde']) == 5
+    assert size('') == 1
+    assert size(42) == 1
+
+
+def test_estimate():
+    costs = costmodel.CostModel()
+    assert costs.estimate('a', 100) == 1
+    costs.record('a', 100, 1.0)
+    assert costs.estimate('a', 50) == 0.5
+    # Unknown processors are estimated at the average cost.
+    costs.record('b', 10, 1.0)
+    assert costs.estimate('c', 10) == (0.01 + 0.1) / 2 * 10
+    # Run times move the cost by WEIGHT.
+    costs.record('a', 100, 2.0)
+    assert costs.estimate('a', 100) == 1.0 + costmodel.CostModel.WEIGHT
@@ -0,0 +1,144 @@
+import time
+
+import coderegistry
+import executor
+import taskunit
+
+
+def processor(self, data):
+    return data[::-1]
+
+
+def failing_processor(self, data):
+    raise ValueError(data)
+
+
+def make_taskunit(tu_id, data, processor, retries=0):
+    '''Get a TaskUnit serialized the way the master sends it and the source
+    of its processor.
+    '''
+    tu = taskunit.TaskUnit(id=tu_id, job_id='j', data=data,
+                           processor=processor, retries=retries)
+    source = tu.serialize_method(processor)
+    tu.processor_digest = coderegistry.CodeRegistry.compute_digest(source)
+    serialized = tu.serialize(include_attrs=['id', 'job_id', 'data',
+                                             'retries', 'processor_digest'])
+
+    return serialized, source
+
+
+def collect(pool, count, timeout=10):
+    '''Collect count results from the executor.
+    '''
+    results = []
+    deadline = time.monotonic() + timeout
+    while len(results) < count and time.monotonic() < deadline:
+        results.extend(pool.completed())
+        time.sleep(0.01)
+
+    return results
+
+
+def test_submit_and_complete():
+    pool = executor.TaskUnitExecutor(workers=1)
+    try:
+        for i, data in enumerate(['abc', 'de']):
+            serialized, source = make_taskunit(str(i), data, processor)
+            pool.submit(serialized, ('127.0.0.1', 1), source)
+        assert not pool.has_capacity()
+        results = collect(pool, 2)
+    finally:
+        pool.shutdown()
+
+    assert pool.has_capacity()
+    by_id = {result['attrs']['id']: (address, result['attrs'])
+             for address, result in results}
+    assert by_id['0'][0] == ('127.0.0.1', 1)
+    assert by_id['0'][1]['state'] == 'COMPLETED'
+    assert by_id['0'][1]['result'] == 'cba'
+    assert by_id['1'][1]['result'] == 'ed'
+    assert by_id['1'][1]['run_time'] is not None
+
+
+def test_failing_processor():
+    pool = executor.TaskUnitExecutor(workers=1)
+    try:
+        serialized, source = make_taskunit('0', 'abc', failing_processor,
+                                           retries=1)
+        pool.submit(serialized, ('127.0.0.1', 1), source)
+        serialized, source = make_taskunit('1', 'abc', failing_processor)
+        pool.submit(serialized, ('127.0.0.1', 1), source)
+        results = collect(pool, 2)
+    finally:
+        pool.shutdown()
+
+    states = {result['attrs']['id']: result['attrs']['state']
+              for _, result in results}
+    assert states == {'0': 'FAILED', '1': 'BAILED'}
+
+
+def test_bailed_when_run_raises():
+    # The processor's source never made it to the slave, so the TaskUnit
+    # can't be run at all. The result is made up as BAILED.
+    pool = executor.TaskUnitExecutor(workers=1)
+    try:
+        serialized, _ = make_taskunit('0', 'abc', processor)
+        pool.submit(serialized, ('127.0.0.1', 1), None)
+        results = collect(pool, 1)
+    finally:
+        pool.shutdown()
+
+    [(address, result)] = results
+    assert result['class'] == 'taskunit.TaskUnit'
+    assert result['attrs'] == {'id': '0', 'job_id': 'j', 'state': 'BAILED',
+                               'result': None}
+
+
+def test_source_arrives_later():
+    # A TaskUnit that bailed for want of its processor's source doesn't keep
+    # the worker from running the next ones once the source is there.
+    pool = executor.TaskUnitExecutor(workers=1)
+    try:
+        serialized, source = make_taskunit('0', 'abc', processor)
+        pool.submit(serialized, ('127.0.0.1', 1), None)
+        collect(pool, 1)
+        serialized, source = make_taskunit('1', 'abc', processor)
+        pool.submit(serialized, ('127.0.0.1', 1), source)
+        results = collect(pool, 1)
+        serialized, source = make_taskunit('2', 'de', processor)
+        pool.submit(serialized, ('127.0.0.1', 1), None)
+        results += collect(pool, 1)
+    finally:
+        pool.shutdown()
+
+    results = {result['attrs']['id']: result['attrs'] for _, result in results}
+    assert results['1']['result'] == 'cba'
+    # The worker kept the source it was given.
+    assert results['2']['result'] == 'ed'
+
+
+def test_source_sent_once(monkeypatch):
+    # The source only goes to the worker with the first TaskUnit.
+    sources = []
+    pool = executor.TaskUnitExecutor(workers=1)
+    pool.pool, pool_submit = pool.threads, pool.threads.submit
+
+    def submit(fn, serialized, attrs, processor_source):
+        sources.append(processor_source)
+        return pool_submit(fn, serialized, attrs, processor_source)
+    monkeypatch.setattr(pool.threads, 'submit', submit)
+    monkeypatch.setattr(executor, 'code', coderegistry.CodeRegistry())
+    try:
+        serialized, source = make_taskunit('0', 'abc', processor)
+        pool.submit(serialized, ('127.0.0.1', 1), source)
+        results = collect(pool, 1)
+        serialized, source = make_taskunit('1', 'de', processor)
+        pool.submit(serialized, ('127.0.0.1', 1), source)
+        results += collect(pool, 1)
+    finally:
+        pool.shutdown()
+
+    assert [result['attrs']['result'] for _, result in results] == ['cba',
+                                                                     'ed']
+    # Tried without the source, then with it. After that, without.
+    assert sources == [None, source, None]
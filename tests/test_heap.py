@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+from utils.heap import IndexedHeap
+
+
+def test_push_pop():
+    heap = IndexedHeap([('c', 3), ('a', 1)])
+    heap.push('b', 2)
+    assert len(heap) == 3
+    assert [heap.pop() for _ in range(3)] == [('a', 1), ('b', 2), ('c', 3)]
+    with pytest.raises(IndexError):
+        heap.pop()
+
+
+def test_ties_in_push_order():
+    heap = IndexedHeap()
+    for item in 'abc':
+        heap.push(item, 0)
+    assert [heap.pop()[0] for _ in range(3)] == ['a', 'b', 'c']
+
+
+def test_update_and_remove():
+    heap = IndexedHeap()
+    handles = {item: heap.push(item, priority)
+               for item, priority in [('a', 1), ('b', 2), ('c', 3)]}
+    handles['a'] = heap.update(handles['a'], 4)
+    handles['c'] = heap.update(handles['c'], 0)
+    assert heap.peek() == ('c', 0)
+    heap.remove(handles['b'])
+    with pytest.raises(KeyError):
+        heap.remove(handles['b'])
+    assert len(heap) == 2
+    assert [heap.pop() for _ in range(2)] == [('c', 0), ('a', 4)]
+
+
+def test_random_updates():
+    rand = random.Random(0)
+    heap = IndexedHeap()
+    priorities = {i: rand.random() for i in range(100)}
+    handles = {i: heap.push(i, p) for i, p in priorities.items()}
+    for _ in range(1000):
+        i = rand.randrange(100)
+        priorities[i] = rand.random()
+        handles[i] = heap.update(handles[i], priorities[i])
+    assert len(heap.entries) <= 2 * len(heap) + 1
+    popped = [heap.pop() for _ in range(100)]
+    assert popped == sorted(priorities.items(), key=lambda x: x[1])
@@ -0,0 +1,103 @@
+import job
+import taskunit
+
+
+def processor(self, line):
+    return len(line)
+
+
+def test_split_one_per_line():
+    splitter = job.Splitter()
+    tus = list(splitter.split('a\nbb\nccc', processor))
+    assert [tu.data for tu in tus] == ['a', 'bb', 'ccc']
+    assert not any(tu.batched for tu in tus)
+
+
+def test_split_chunk_bytes():
+    splitter = job.Splitter(chunk_bytes=6)
+    tus = list(splitter.split('a\nbb\nccc\ndddd\ne', processor))
+    assert [tu.data for tu in tus] == [['a', 'bb', 'ccc'], ['dddd', 'e']]
+    assert all(tu.batched for tu in tus)
+
+
+def test_split_chunk_time():
+    splitter = job.Splitter(chunk_time=0.1)
+    assert splitter.chunk_lines() == job.Splitter.INITIAL_CHUNK_LINES
+    splitter.record_run_time(10, 0.01)
+    assert splitter.chunk_lines() == 100
+    # Slower lines make for smaller chunks.
+    splitter.record_run_time(10, 0.05)
+    assert splitter.chunk_lines() < 100
+
+    input_data = '\n'.join(str(i) for i in range(250))
+    tus = list(splitter.split(input_data, processor))
+    lines = [line for tu in tus for line in tu.data]
+    assert lines == input_data.split('\n')
+
+
+def test_batched_run_and_unbatch():
+    tu = taskunit.TaskUnit(job_id='j', data=['a', 'bb'], processor=processor,
+                           batched=True)
+    tu.run()
+    assert tu.state == 'COMPLETED'
+    assert tu.result == [1, 2]
+    assert tu.run_time is not None
+
+    combiner = job.Combiner()
+    combiner.add_taskunits([tu])
+    assert [(t.data, t.result) for t in combiner.taskunits] == [('a', 1),
+                                                               ('bb', 2)]
+
+
+def test_incremental_combine(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    combiner = job.Combiner()
+    assert combiner.incremental
+    for result in [1, 2, 3]:
+        combiner.accumulate(result)
+    combiner.finalize()
+    [result_file] = tmp_path.iterdir()
+    assert result_file.read_text() == '6'
+
+
+def test_combiner_roundtrip():
+    combiner = job.Combiner(incremental=False)
+    deserialized = job.Combiner.deserialize(combiner.serialize())
+    assert not deserialized.incremental
+    assert deserialized.result == 0
+
+
+def test_partial():
+    partial = job.Partial('j', job.Combiner.accumulate)
+    partial.add({'attrs': {'id': 'a', 'result': 2, 'run_time': 0.5}})
+    partial.add({'attrs': {'id': 'b', 'result': [3, 4], 'batched': True,
+                           'run_time': 0.25}})
+    assert len(partial) == 2
+    msg = partial.message()
+    assert msg['class'] == job.Partial.CLASS
+    assert msg['ids'] == ['a', 'b']
+    assert msg['run_times'] == [0.5, 0.25]
+    assert msg['result'] == 9
+
+    combiner = job.Combiner()
+    combiner.accumulate(1)
+    combiner.merge(msg['result'])
+    assert combiner.result == 10
+
+
+def reduce(self, key, values):
+    return sum(values)
+
+
+def test_keyed_run():
+    tu = taskunit.TaskUnit(job_id='j', data=[['a', 1], ['b', 2], ['a', 3]],
+                           processor=reduce, keyed=True)
+    tu.run()
+    assert tu.state == 'COMPLETED'
+    assert tu.result == [['a', 4], ['b', 2]]
+    assert [(t.data, t.result) for t in tu.unbatch()] == [('a', 4), ('b', 2)]
+
+    combiner = job.Combiner(keyed=True)
+    for result in tu.results():
+        combiner.accumulate(result)
+    assert combiner.result == {'a': 4, 'b': 2}
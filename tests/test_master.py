@@ -0,0 +1,722 @@
+import asyncio
+
+import blobstore
+import job
+import master
+import messenger
+import taskunit
+
+
+class StubMessenger:
+    '''Stands in for the master's AsyncZMQMessenger and records what is sent
+    instead of sending it.
+    '''
+    def __init__(self, *args, **kwargs):
+        # (address, serialized taskunit) for each taskunit sent.
+        self.sent = []
+        # (address, message) for each other message sent.
+        self.messages = []
+        # (address, digest) for each piece of code or blob sent.
+        self.code = []
+        self.blobs = []
+        # Called with each taskunit sent, if set.
+        self.on_send = None
+        # (address, message) for each message to be received.
+        self.incoming = []
+
+    def start(self):
+        pass
+
+    async def receive(self):
+        for address, msg in self.incoming:
+            yield address, msg
+
+    async def sender(self):
+        await asyncio.Event().wait()
+
+    async def flusher(self):
+        await asyncio.Event().wait()
+
+    async def send_taskunit(self, tu, address, attrs):
+        self.sent.append((address, tu.serialize(include_attrs=attrs)))
+        if self.on_send is not None:
+            self.on_send(tu, address)
+
+    def send_code(self, digest, source, address):
+        self.code.append((address, digest))
+
+    def send_blob(self, digest, data, address):
+        self.blobs.append((address, digest))
+
+    def send_serialized(self, serialized, address):
+        self.messages.append((address, serialized))
+
+    def pong(self, address):
+        pass
+
+    def register_destination(self, name, address):
+        pass
+
+    async def drain(self):
+        pass
+
+
+class Recorder(job.Combiner):
+    '''A combiner that keeps the results it is given.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.results = []
+        self.finalized = False
+
+    def accumulate(self, result):
+        self.results.append(result)
+
+    def finalize(self):
+        self.finalized = True
+
+
+def processor(self, line):
+    return len(line)
+
+
+def make_master(monkeypatch, **kwargs):
+    monkeypatch.setattr(messenger, 'AsyncZMQMessenger', StubMessenger)
+    return master.Master(34400, **kwargs)
+
+
+def make_job(job_id, lines, **kwargs):
+    '''Get a job with a taskunit for each of lines.
+    '''
+    return job.Job(id=job_id, input_data='\n'.join(lines),
+                   processor=processor, combiner=Recorder(), **kwargs)
+
+
+async def add_slaves(m, count):
+    '''Connect count slaves to the master.
+
+    :returns: Their addresses.
+    '''
+    addresses = [('127.0.0.1', 40000 + i) for i in range(count)]
+    for address in addresses:
+        await m.handle_message(address, {'class': 'PING'})
+
+    return addresses
+
+
+def result(serialized, state='COMPLETED', value=None):
+    '''Get the message a slave sends back for a taskunit it ran.
+    '''
+    attrs = serialized['attrs']
+    return {'class': 'taskunit.TaskUnit',
+            'attrs': {'id': attrs['id'], 'job_id': attrs['job_id'],
+                      'state': state, 'result': value, 'run_time': 0.01}}
+
+
+def test_credit_window(monkeypatch):
+    m = make_master(monkeypatch, max_inflight=2)
+
+    async def run():
+        [address] = await add_slaves(m, 1)
+        await m.process_job(make_job('j', ['a', 'bb', 'ccc', 'dddd', 'e']))
+        # The slave has no credit for more than max_inflight taskunits.
+        assert len(m.messenger.sent) == 2
+        assert m.available_slaves == set()
+        await m.dispatch()
+        assert len(m.messenger.sent) == 2
+
+        # A result gives a credit back.
+        _, first = m.messenger.sent[0]
+        await m.handle_message(address, result(first, value=1))
+        assert len(m.messenger.sent) == 3
+        assert m.inflight == [2]
+
+        # So does a taskunit the slave gives back. It is sent again first.
+        _, second = m.messenger.sent[1]
+        await m.handle_message(address, {
+            'class': 'RELEASE',
+            'taskunits': [['j', second['attrs']['id']]]})
+        assert len(m.messenger.sent) == 4
+        assert m.messenger.sent[3][1]['attrs']['id'] == second['attrs']['id']
+        assert m.inflight == [2]
+
+    asyncio.run(run())
+
+
+def test_partial_returns_credit(monkeypatch):
+    m = make_master(monkeypatch, max_inflight=2)
+
+    async def run():
+        [address] = await add_slaves(m, 1)
+        await m.process_job(make_job('j', ['a', 'bb', 'ccc', 'dddd'],
+                                     pushdown=True))
+        assert len(m.messenger.sent) == 2
+        ids = [serialized['attrs']['id'] for _, serialized in
+               m.messenger.sent]
+        await m.handle_message(address, {
+            'class': job.Partial.CLASS, 'job_id': 'j', 'ids': ids,
+            'run_times': [0.01, 0.01], 'result': 3})
+        # Both credits came back with the partial.
+        assert len(m.messenger.sent) == 4
+        assert m.inflight == [2]
+        assert m.jobs['j'].combiner.results == [3]
+
+    asyncio.run(run())
+
+
+def test_code_sent_once(monkeypatch):
+    m = make_master(monkeypatch)
+
+    async def run():
+        first, second = await add_slaves(m, 2)
+        await m.process_job(make_job('j', ['a', 'bb', 'ccc', 'dddd']))
+        assert len(m.messenger.sent) == 4
+        # Each slave gets the processor once, and the taskunits only refer
+        # to it by its digest.
+        [digest] = set(serialized['attrs']['processor_digest']
+                       for _, serialized in m.messenger.sent)
+        assert sorted(m.messenger.code) == [(first, digest),
+                                            (second, digest)]
+        assert not any('processor' in serialized['attrs']
+                       for _, serialized in m.messenger.sent)
+
+        # A slave that says it has the code isn't sent it.
+        third = ('127.0.0.1', 40002)
+        await m.handle_message(third, {'class': 'PING'})
+        await m.handle_message(third, {'class': 'CACHED',
+                                       'digests': [digest]})
+        await m.process_job(make_job('k', ['e', 'ff', 'ggg']))
+        assert third in [address for address, _ in m.messenger.sent]
+        assert (third, digest) not in m.messenger.code
+
+        # A slave that was restarted is sent it again.
+        await m.handle_message(first, {'class': 'PING'})
+        assert first not in m.holders[digest]
+        await m.process_job(make_job('l', [str(i) for i in range(12)]))
+        assert m.messenger.code.count((first, digest)) == 2
+
+    asyncio.run(run())
+
+
+class FailingRecorder(Recorder):
+    def finalize(self):
+        raise ValueError('finalize failed')
+
+
+async def combined(m):
+    '''Wait for the combine of a job to be done.
+    '''
+    while not (m.completed_jobs or m.failed_jobs):
+        await asyncio.sleep(0.01)
+
+
+def test_job_completed(monkeypatch):
+    m = make_master(monkeypatch)
+
+    async def run():
+        [address] = await add_slaves(m, 1)
+        await m.process_job(make_job('j', ['a', 'bb']))
+        for _, serialized in list(m.messenger.sent):
+            await m.handle_message(address, result(serialized, value=1))
+        await combined(m)
+
+    asyncio.run(run())
+    assert m.completed_jobs == ['j']
+    assert m.failed_jobs == []
+    assert m.jobs['j'].combiner.finalized
+
+
+def test_job_failed_to_combine(monkeypatch):
+    m = make_master(monkeypatch)
+
+    async def run():
+        [address] = await add_slaves(m, 1)
+        j = make_job('j', ['a', 'bb'])
+        j.combiner = FailingRecorder()
+        await m.process_job(j)
+        for _, serialized in list(m.messenger.sent):
+            await m.handle_message(address, result(serialized, value=1))
+        await combined(m)
+
+    asyncio.run(run())
+    assert m.completed_jobs == []
+    assert m.failed_jobs == ['j']
+
+
+def test_straggler_time(monkeypatch):
+    m = make_master(monkeypatch)
+    j = make_job('j', ['a'])
+    j.split_done = False
+    j.combiner_digest = None
+    j.latencies = [0.1] * (m.MIN_LATENCIES - 1)
+    # Not until the job is split.
+    assert m.straggler_time(j) is None
+    j.split_done = True
+    # Nor with too few latencies to go by.
+    assert m.straggler_time(j) is None
+    j.latencies = [0.1] * 9 + [10.0] * (m.MIN_LATENCIES - 9)
+    assert m.straggler_time(j) == m.MIN_SPECULATION_TIME
+    j.latencies = [float(i) for i in range(1, 101)]
+    # The 90th percentile of the latencies is 90.
+    assert m.straggler_time(j) == m.SPECULATION_FACTOR * 90
+    # Never for a job that is pushed down.
+    j.combiner_digest = 'digest'
+    assert m.straggler_time(j) is None
+
+
+async def start_stragglers(m, j):
+    '''Send out the job's taskunits and make all of them stragglers.
+    '''
+    await m.process_job(j)
+    j.latencies.extend([0.01] * m.MIN_LATENCIES)
+    for copies in m.dispatched.values():
+        copies[0][1] -= 2 * m.MIN_SPECULATION_TIME
+
+
+def test_speculate_once(monkeypatch):
+    m = make_master(monkeypatch)
+
+    async def run():
+        await add_slaves(m, 2)
+        await start_stragglers(m, make_job('j', ['a', 'bb']))
+        assert len(m.messenger.sent) == 2
+        await m.speculate()
+        await m.speculate()
+
+    asyncio.run(run())
+    # Each straggler was sent again once, to the other slave.
+    assert len(m.messenger.sent) == 4
+    for copies in m.dispatched.values():
+        assert len(copies) == 2
+        assert copies[0][0] != copies[1][0]
+
+
+def test_speculate_pushed_down(monkeypatch):
+    m = make_master(monkeypatch)
+
+    async def run():
+        await add_slaves(m, 2)
+        await start_stragglers(m, make_job('j', ['a', 'bb'], pushdown=True))
+        await m.speculate()
+
+    asyncio.run(run())
+    assert len(m.messenger.sent) == 2
+
+
+def test_speculate_result_meanwhile(monkeypatch):
+    m = make_master(monkeypatch)
+
+    async def run():
+        addresses = await add_slaves(m, 2)
+        await start_stragglers(m, make_job('j', ['a', 'bb']))
+        sent = list(m.messenger.sent)
+
+        # The result of the other straggler comes in while the first one is
+        # being sent again.
+        def on_send(tu, address):
+            m.messenger.on_send = None
+            for other_address, serialized in sent:
+                if serialized['attrs']['id'] != tu.id:
+                    m.untrack(m.jobs['j'], serialized['attrs']['id'],
+                              other_address)
+        m.messenger.on_send = on_send
+        await m.speculate()
+
+    asyncio.run(run())
+    assert len(m.messenger.sent) == 3
+    [copies] = m.dispatched.values()
+    assert len(copies) == 2
+
+
+class Summer(job.Combiner):
+    '''The default combiner, without the result file.
+    '''
+    def finalize(self):
+        self.finalized = True
+
+
+def test_taskunit_out_of_retries(monkeypatch):
+    m = make_master(monkeypatch)
+
+    async def run():
+        retrier = asyncio.create_task(m.retrier())
+        [address] = await add_slaves(m, 1)
+        j = make_job('j', ['a', 'bb'], retries=1)
+        j.combiner = Summer()
+        await m.process_job(j)
+        first, second = [serialized for _, serialized in m.messenger.sent]
+        await m.handle_message(address, result(first, value=1))
+        # The other one fails, is sent again and fails for good.
+        await m.handle_message(address, result(second, state='FAILED'))
+        while len(m.messenger.sent) < 3:
+            await asyncio.sleep(0.01)
+        _, resent = m.messenger.sent[2]
+        assert resent['attrs']['id'] == second['attrs']['id']
+        await m.handle_message(address, result(resent, state='BAILED'))
+        await combined(m)
+        retrier.cancel()
+        return second['attrs']['id']
+
+    failed = asyncio.run(run())
+    j = m.jobs['j']
+    assert j.failed_taskunits == [failed]
+    assert j.combiner.result == 1
+    assert m.completed_jobs == ['j']
+
+
+def test_bad_message(monkeypatch):
+    m = make_master(monkeypatch)
+    m.messenger.incoming = [
+        (('127.0.0.1', 40000), {'class': 'PING'}),
+        # A result for a job the master doesn't know.
+        (('127.0.0.1', 40000), {'class': 'taskunit.TaskUnit',
+                                'attrs': {'id': 't', 'job_id': 'x',
+                                          'state': 'COMPLETED'}}),
+        (('127.0.0.1', 40001), {'class': 'PING'})]
+
+    asyncio.run(m.run())
+    assert len(m.slave_nodes) == 2
+
+
+def test_retry_delay(monkeypatch):
+    m = make_master(monkeypatch)
+    monkeypatch.setattr(m, 'RETRY_JITTER', 0)
+    delays = [m.retry_delay(failures) for failures in range(1, 10)]
+    assert delays[:4] == [m.RETRY_DELAY * 2 ** i for i in range(4)]
+    assert delays[-1] == m.MAX_RETRY_DELAY
+
+    monkeypatch.setattr(m, 'RETRY_JITTER', 0.5)
+    for _ in range(100):
+        assert 0.5 * m.RETRY_DELAY <= m.retry_delay(1) <= 1.5 * m.RETRY_DELAY
+
+
+def test_retry_same_slave_backs_off(monkeypatch):
+    m = make_master(monkeypatch)
+    delays = []
+    monkeypatch.setattr(m, 'retry_delay',
+                        lambda failures: delays.append(failures) or 100)
+
+    async def run():
+        [address] = await add_slaves(m, 1)
+        await m.process_job(make_job('j', ['a'], retries=3))
+        _, serialized = m.messenger.sent[0]
+        for _ in range(3):
+            await m.handle_message(address,
+                                   result(serialized, state='FAILED'))
+
+    asyncio.run(run())
+    # Each attempt on the one slave backs off further.
+    assert delays == [1, 2, 3]
+
+
+def test_retry_slaves(monkeypatch):
+    m = make_master(monkeypatch)
+
+    async def run():
+        first, second, third = await add_slaves(m, 3)
+        await m.process_job(make_job('j', ['a'], retries=2))
+        j = m.jobs['j']
+        [(address, serialized)] = m.messenger.sent
+        tu = j.taskunits[serialized['attrs']['id']]
+        assert m.retry_slaves(j, tu) is None
+        machine = m.slave_index[address]
+        await m.handle_message(address, result(serialized, state='FAILED'))
+        # Not the slave it failed on.
+        assert m.retry_slaves(j, tu) == {0, 1, 2} - {machine}
+        # Unless it failed on all of the available ones.
+        m.failed_on[(j.id, tu.id)] = {0, 1, 2}
+        assert m.retry_slaves(j, tu) is None
+
+    asyncio.run(run())
+
+
+def test_slave_restarted(monkeypatch):
+    m = make_master(monkeypatch, max_inflight=2)
+
+    async def run():
+        [address] = await add_slaves(m, 1)
+        await m.process_job(make_job('j', ['a', 'bb', 'ccc']))
+        lost = [serialized['attrs']['id']
+                for _, serialized in m.messenger.sent]
+        assert m.inflight == [2]
+        await m.handle_message(address, {'class': 'PING'})
+        # The taskunits the slave lost are sent to it again first, and it
+        # has its full credit.
+        resent = [serialized['attrs']['id']
+                  for _, serialized in m.messenger.sent[2:]]
+        assert resent == lost
+        assert m.inflight == [2]
+        assert len(m.dispatched) == 2
+
+    asyncio.run(run())
+
+
+def test_task_restarted(monkeypatch, capsys):
+    m = make_master(monkeypatch)
+    calls = []
+
+    async def flaky():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            raise ValueError('first run')
+        await asyncio.Event().wait()
+
+    async def run():
+        m.start_task(flaky)
+        while len(calls) < 2:
+            await asyncio.sleep(0.01)
+        # The restarted task is kept until it's done.
+        [task] = m.tasks
+        task.cancel()
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert calls == [0, 1]
+    assert m.tasks == set()
+    assert 'flaky failed. Restarting it.' in capsys.readouterr().out
+
+
+def test_speculated_copy_bailed(monkeypatch):
+    m = make_master(monkeypatch)
+
+    async def run():
+        await add_slaves(m, 2)
+        await start_stragglers(m, make_job('j', ['a']))
+        await m.speculate()
+        [(address, serialized), (other, _)] = m.messenger.sent
+        # The first copy bails, but the other one is still in flight.
+        await m.handle_message(address, result(serialized, state='BAILED'))
+        assert m.jobs['j'].failed_taskunits == []
+        await m.handle_message(other, result(serialized, value=1))
+        await combined(m)
+
+    asyncio.run(run())
+    j = m.jobs['j']
+    assert j.combiner.results == [1]
+    assert j.failed_taskunits == []
+    assert m.completed_jobs == ['j']
+
+
+def sent_jobs(m, start=0):
+    '''Get the job ids of the taskunits sent, in order.
+    '''
+    return [serialized['attrs']['job_id']
+            for _, serialized in m.messenger.sent[start:]]
+
+
+def test_weights(monkeypatch):
+    m = make_master(monkeypatch, max_inflight=9)
+
+    async def run():
+        # Both jobs are pending by the time there's a slave.
+        await m.process_job(make_job('a', ['a%02d' % i for i in range(12)]))
+        await m.process_job(make_job('b', ['b%02d' % i for i in range(12)],
+                                     weight=2))
+        await add_slaves(m, 1)
+
+    asyncio.run(run())
+    # Job b gets twice the share of job a.
+    assert sent_jobs(m) == ['a', 'b', 'b'] * 3
+
+
+def test_new_job_does_not_starve(monkeypatch):
+    m = make_master(monkeypatch, max_inflight=1)
+
+    async def run():
+        [address] = await add_slaves(m, 1)
+        await m.process_job(make_job('a', ['a%02d' % i for i in range(20)]))
+        for _ in range(10):
+            _, serialized = m.messenger.sent[-1]
+            await m.handle_message(address, result(serialized, value=1))
+        # Job b doesn't get to make up for the time before it came in.
+        await m.process_job(make_job('b', ['b%02d' % i for i in range(20)]))
+        for _ in range(4):
+            _, serialized = m.messenger.sent[-1]
+            await m.handle_message(address, result(serialized, value=1))
+
+    asyncio.run(run())
+    assert sent_jobs(m, 11) == ['b', 'a', 'b', 'a']
+
+
+def test_urgency(monkeypatch):
+    m = make_master(monkeypatch)
+
+    async def run():
+        for job_id, kwargs in [('late', {'deadline': 60}),
+                               ('none', {}),
+                               ('soon', {'deadline': 30}),
+                               ('high', {'priority': 1})]:
+            await m.process_job(make_job(job_id, ['a'], **kwargs))
+
+    asyncio.run(run())
+    jobs = sorted(m.jobs.values(), key=m.urgency)
+    # The priority goes first, then the earliest deadline.
+    assert [j.id for j in jobs] == ['high', 'soon', 'late', 'none']
+    assert m.next_job().id == 'high'
+
+
+def test_preempt(monkeypatch):
+    m = make_master(monkeypatch, max_inflight=2)
+
+    async def run():
+        [address] = await add_slaves(m, 1)
+        await m.process_job(make_job('a', ['a0', 'a1', 'a2']))
+        await m.process_job(make_job('b', ['b0', 'b1'], priority=1))
+        # Only job a is asked back, and no more than the slave has.
+        assert m.messenger.messages[-1] == (
+            address, {'class': 'STEAL', 'count': 2, 'jobs': ['a']})
+        await m.handle_message(address, {
+            'class': 'RELEASE',
+            'taskunits': [['a', serialized['attrs']['id']]
+                          for _, serialized in m.messenger.sent]})
+        # The job that preempted them goes first.
+        assert sent_jobs(m, 2) == ['b', 'b']
+        # A less urgent job doesn't preempt anything.
+        await m.process_job(make_job('c', ['c0']))
+        assert len(m.messenger.messages) == 1
+
+    asyncio.run(run())
+
+
+def test_missed_deadline(monkeypatch):
+    m = make_master(monkeypatch)
+
+    async def run():
+        [address] = await add_slaves(m, 1)
+        await m.process_job(make_job('late', ['a'], deadline=0))
+        await m.process_job(make_job('early', ['b'], deadline=60))
+        for _, serialized in list(m.messenger.sent):
+            await m.handle_message(address, result(serialized, value=1))
+        while len(m.completed_jobs) < 2:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert m.missed_deadlines == ['late']
+
+
+def test_pull(monkeypatch):
+    m = make_master(monkeypatch, pull=True)
+
+    async def run():
+        first, second = await add_slaves(m, 2)
+        # The slaves are told to ask for taskunits and aren't sent any until
+        # they do.
+        assert m.messenger.messages == [(first, {'class': 'PULL'}),
+                                        (second, {'class': 'PULL'})]
+        await m.process_job(make_job('j', ['a', 'b', 'c', 'd', 'e', 'f']))
+        assert m.messenger.sent == []
+
+        # A slave gets no more than it asks for.
+        await m.handle_message(first, {'class': 'WORK', 'count': 4})
+        assert [address for address, _ in m.messenger.sent] == [first] * 4
+        # The other one gets what's left, and the busy one is asked to give
+        # back some of its taskunits for the rest.
+        await m.handle_message(second, {'class': 'WORK', 'count': 4})
+        assert [address for address, _ in m.messenger.sent[4:]] == [
+            second] * 2
+        assert m.messenger.messages[-1] == (first, {'class': 'STEAL',
+                                                    'count': 2})
+
+        # The taskunits it gives back go to the slave that asked for work.
+        released = [serialized['attrs']['id']
+                    for _, serialized in m.messenger.sent[2:4]]
+        await m.handle_message(first, {
+            'class': 'RELEASE',
+            'taskunits': [['j', taskunit_id] for taskunit_id in released]})
+        assert [(address, serialized['attrs']['id'])
+                for address, serialized in m.messenger.sent[6:]] == [
+            (second, taskunit_id) for taskunit_id in released]
+        assert m.inflight == [2, 4]
+        assert m.available_slaves == set()
+
+    asyncio.run(run())
+
+
+def test_warm_slaves(monkeypatch):
+    m = make_master(monkeypatch)
+    digest = m.code.add(taskunit.TaskUnit().serialize_method(processor))
+
+    async def run():
+        first, second = await add_slaves(m, 2)
+        await m.handle_message(second, {'class': 'CACHED',
+                                        'digests': [digest]})
+        await m.process_job(make_job('a', ['a']))
+        # The slave that has the code gets the taskunit.
+        assert [address for address, _ in m.messenger.sent] == [second]
+        assert m.messenger.code == []
+
+    asyncio.run(run())
+
+def test_warm_blob(monkeypatch):
+    m = make_master(monkeypatch, blob_threshold=16)
+    data = 'x' * 32
+    blob_digest = blobstore.BlobStore.compute_digest(data)
+    code_digest = m.code.add(taskunit.TaskUnit().serialize_method(processor))
+
+    async def run():
+        first, second = await add_slaves(m, 2)
+        await m.handle_message(first, {'class': 'CACHED',
+                                       'digests': [code_digest]})
+        await m.handle_message(second, {'class': 'CACHED',
+                                        'digests': [blob_digest]})
+        await m.process_job(make_job('a', [data]))
+        # The slave that has the data gets the taskunit over the one that
+        # has the code.
+        [(address, serialized)] = m.messenger.sent
+        assert address == second
+        assert serialized['attrs']['blob_digest'] == blob_digest
+        assert m.messenger.blobs == []
+
+    asyncio.run(run())
+
+def test_fetch(monkeypatch):
+    m = make_master(monkeypatch, blob_threshold=16)
+    data = 'x' * 32
+
+    async def run():
+        [address] = await add_slaves(m, 1)
+        await m.process_job(make_job('a', [data]))
+        [(_, serialized)] = m.messenger.sent
+        digest = serialized['attrs']['blob_digest']
+        assert 'data' not in serialized['attrs']
+        assert m.messenger.blobs == [(address, digest)]
+
+        # The slave dropped the blob and asks for it again.
+        await m.handle_message(address, {'class': 'FETCH',
+                                         'digests': [digest]})
+        assert m.messenger.blobs == [(address, digest)] * 2
+
+        # The blob is dropped once the job is done with it.
+        await m.handle_message(address, result(serialized, value=1))
+        assert digest not in m.blobs
+        await m.handle_message(address, {'class': 'FETCH',
+                                         'digests': [digest]})
+        assert len(m.messenger.blobs) == 2
+
+        # A job with the same data puts it back, but it isn't sent again.
+        await m.process_job(make_job('b', [data]))
+        assert digest in m.blobs
+        assert len(m.messenger.blobs) == 2
+        assert m.messenger.sent[1][1]['attrs']['blob_digest'] == digest
+
+    asyncio.run(run())
+
+
+def test_blobs_shared_between_jobs(monkeypatch):
+    m = make_master(monkeypatch, blob_threshold=16)
+    data = 'x' * 32
+
+    async def run():
+        [address] = await add_slaves(m, 1)
+        await m.process_job(make_job('a', [data]))
+        await m.process_job(make_job('b', [data]))
+        [(_, first), (_, second)] = m.messenger.sent
+        digest = first['attrs']['blob_digest']
+        await m.handle_message(address, result(first, value=1))
+        # Job b still needs it.
+        assert digest in m.blobs
+        await m.handle_message(address, result(second, value=1))
+        assert digest not in m.blobs
+        assert m.blob_jobs == {}
+
+    asyncio.run(run())
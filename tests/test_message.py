@@ -0,0 +1,21 @@
+import json
+
+import codec
+import message
+
+
+def test_batch_pack():
+    batch = message.ZMQBatch(created=0, codec=codec.JSON)
+    batch.add(codec.JSON.encode({'class': 'taskunit.TaskUnit',
+                                 'attrs': {'id': 1}}))
+    batch.add(codec.JSON.encode({'class': 'PING'}))
+    assert len(batch) == 2
+    decoded = json.loads(batch.pack().decode('utf-8'))
+    assert message.ZMQBatch.is_batch(decoded)
+    assert decoded['items'] == [
+        {'class': 'taskunit.TaskUnit', 'attrs': {'id': 1}}, {'class': 'PING'}]
+
+
+def test_is_batch():
+    assert not message.ZMQBatch.is_batch('PING')
+    assert not message.ZMQBatch.is_batch({'class': 'job.Job'})
@@ -0,0 +1,56 @@
+import asyncio
+
+import messenger
+
+
+def test_async_roundtrip(monkeypatch):
+    monkeypatch.setattr(messenger.ZMQMessenger, 'get_public_ip',
+                        staticmethod(lambda: '127.0.0.1'))
+
+    async def roundtrip():
+        server = messenger.AsyncZMQMessenger(
+            type=messenger.ZMQMessenger.TYPE_SERVER, port=34390,
+            batch_size=4)
+        client = messenger.AsyncZMQMessenger(
+            type=messenger.ZMQMessenger.TYPE_CLIENT, port=34391)
+        server.start()
+        client.start()
+        tasks = [asyncio.create_task(m.sender()) for m in (server, client)]
+        tasks.append(asyncio.create_task(server.flusher()))
+
+        async def pong():
+            async for address, msg in server.receive():
+                if msg['class'] == 'PING':
+                    # Sent before the PONG. The client gets it even though
+                    # it's still waiting for the PONG.
+                    server.send_serialized({'class': 'test', 'i': -1},
+                                           address)
+                    server.pong(address)
+                    return address
+        server_task = asyncio.create_task(pong())
+
+        received = asyncio.Queue()
+
+        async def receive():
+            async for _, msg in client.receive():
+                await received.put(msg)
+        tasks.append(asyncio.create_task(receive()))
+        await client.connect(('127.0.0.1', 34390))
+        address = await server_task
+
+        # Batched on the server and sent out by the flusher.
+        for i in range(3):
+            server.send_batched({'class': 'test', 'i': i}, address)
+        tests = []
+        while len(tests) < 4:
+            msg = await received.get()
+            if msg['class'] == 'test':
+                tests.append(msg['i'])
+
+        for task in tasks:
+            task.cancel()
+        server.socket.close(linger=0)
+        client.socket.close(linger=0)
+        return tests
+
+    assert asyncio.run(asyncio.wait_for(roundtrip(), 5)) == [-1, 0, 1, 2]
@@ -45,3 +45,130 @@ def test_schedule_jobs():
     machines = [machine1, machine2, machine3, machine4]
     machines.sort()
     assert machines == [1, 2, 3, 4]
+
+
+def test_schedule_job_restricted():
+    restricted = schedule.MinMakespan(machines=3)
+    machines = [restricted.schedule_job(FakeJob(), machines={2})
+                for _ in range(3)]
+    assert machines == [2, 2, 2]
+    assert restricted.schedule_job(FakeJob(), machines={0, 2}) == 0
+
+
+def test_complete_job():
+    scheduler = schedule.MinMakespan(machines=2)
+    jobs = [FakeJob() for _ in range(4)]
+    machines = [scheduler.schedule_job(job, now=0) for job in jobs]
+    assert sorted(machines) == [0, 0, 1, 1]
+    for job, machine in zip(jobs, machines):
+        if machine == 0:
+            scheduler.complete_job(job, machine, now=0.5)
+    assert scheduler.loads == [0, 2]
+    assert scheduler.schedule_job(FakeJob(), now=0.5) == 0
+
+
+def test_learn_speeds():
+    scheduler = schedule.MinMakespan(machines=2)
+    # Machine 1 gets twice as much work done in the same time.
+    for machine, done in ((0, 2), (1, 4)):
+        jobs = [FakeJob() for _ in range(done)]
+        for job in jobs:
+            scheduler.schedule_job(job, machines={machine}, now=0)
+        for job in jobs[:-1]:
+            scheduler.complete_job(job, machine, now=0.5)
+        scheduler.complete_job(jobs[-1], machine,
+                               now=schedule.MinMakespan.SPEED_WINDOW)
+    assert scheduler.speeds[1] == 2 * scheduler.speeds[0]
+
+    # Machine 1 gets twice as many of the jobs.
+    machines = [scheduler.schedule_job(FakeJob()) for _ in range(30)]
+    assert machines.count(1) == 2 * machines.count(0)
+
+
+def test_learned_speed_rekeys_machines():
+    scheduler = schedule.MinMakespan(machines=3)
+    scheduler.schedule_job(FakeJob(job_size=2), machines={1}, now=0)
+    scheduler.schedule_job(FakeJob(job_size=8), machines={2}, now=0)
+    # Machine 0 turns out to get 4 of work done a second.
+    jobs = [FakeJob() for _ in range(8)]
+    for job in jobs:
+        scheduler.schedule_job(job, machines={0}, now=0)
+    for job in jobs[:3]:
+        scheduler.complete_job(job, 0, now=0.5)
+    scheduler.complete_job(jobs[3], 0, now=schedule.MinMakespan.SPEED_WINDOW)
+    assert scheduler.speed(0) == 4
+
+    # The other machines are now taken to be as fast, so machine 1 is the
+    # least loaded one.
+    for machine in range(3):
+        assert (scheduler.loads_heap.priority(scheduler.handles[machine]) ==
+                scheduler.load(machine))
+    assert scheduler.schedule_job(FakeJob(), now=1) == 1
+
+
+def test_cancel_job():
+    scheduler = schedule.MinMakespan(machines=2)
+    job = FakeJob(job_size=3)
+    machine = scheduler.schedule_job(job, now=0)
+    scheduler.cancel_job(job, machine)
+    assert scheduler.loads == [0, 0]
+    assert scheduler.assignments[machine] == []
+    assert not any(scheduler.learned)
+
+
+def test_fail_job():
+    scheduler = schedule.MinMakespan(machines=2)
+    job = FakeJob(job_size=3)
+    machine = scheduler.schedule_job(job, now=0)
+    scheduler.fail_job(job, machine)
+    assert scheduler.loads == [0, 0]
+    # The failing machine is passed over while it's idle...
+    other = scheduler.schedule_job(FakeJob(job_size=1), now=0)
+    assert other != machine
+    # ...and is forgiven as it gets jobs done.
+    job = FakeJob(job_size=1)
+    assert scheduler.schedule_job(job, machines={machine}, now=0) == machine
+    scheduler.complete_job(job, machine, now=0.5)
+    assert scheduler.penalties[machine] == 1.5
+
+
+def test_preferred_machines():
+    scheduler = schedule.MinMakespan(machines=3, tolerance=2)
+    scheduler.schedule_job(FakeJob(job_size=2), machines={2}, now=0)
+    # Machine 2 is preferred and within the tolerance...
+    assert scheduler.schedule_job(FakeJob(), now=0, preferred={2}) == 2
+    # ...until it's too far ahead of the others.
+    assert scheduler.schedule_job(FakeJob(), now=0, preferred={2}) != 2
+    # Preferred machines that can't be used are ignored.
+    assert scheduler.schedule_job(FakeJob(), machines={0, 1}, now=0,
+                                  preferred={2}) in (0, 1)
+
+
+def test_schedule_batch():
+    scheduler = schedule.MinMakespan(machines=2)
+    # Online, the small jobs that come first spread out and the large one
+    # ends up on top of them.
+    sizes = [1, 1, 1, 1, 4]
+    for size in sizes:
+        scheduler.schedule_job(FakeJob(job_size=size), now=0)
+    assert max(scheduler.loads) == 6
+    scheduler = schedule.MinMakespan(machines=2)
+    machines = scheduler.schedule_batch([FakeJob(job_size=size)
+                                         for size in sizes], now=0)
+    assert machines.count(machines[-1]) == 1
+    assert scheduler.loads == [4, 4]
+
+
+def test_schedule_batch_speeds():
+    scheduler = schedule.MinMakespan(machines=2, speeds=[1, 2])
+    assert scheduler.schedule_batch([FakeJob(job_size=4)], now=0) == [1]
+
+
+def test_schedule_batch_different_speeds():
+    scheduler = schedule.MinMakespan(machines=3, speeds=[4, 3, 1])
+    # Neither the least loaded machine (the slowest one) nor the fastest one
+    # would be done with the last job first.
+    machines = scheduler.schedule_batch([FakeJob(job_size=12)
+                                         for _ in range(4)], now=0)
+    assert machines == [0, 1, 0, 1]
+    assert scheduler.loads == [24, 24, 0]
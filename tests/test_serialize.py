@@ -0,0 +1,119 @@
+import gc
+import inspect
+import linecache
+import os
+
+import job
+import serialize
+import taskunit
+
+
+def processor(self, string):
+    return string[::-1]
+
+
+def test_taskunit_roundtrip():
+    tu = taskunit.TaskUnit(id='1', data='hello', processor=processor)
+    serialized = tu.serialize(include_attrs=['id', 'data', 'processor'])
+    deserialized = taskunit.TaskUnit.deserialize(serialized)
+    deserialized.run()
+    assert deserialized.id == '1'
+    assert deserialized.result == 'olleh'
+    assert deserialized.state == 'COMPLETED'
+
+
+def test_deserialized_source():
+    tu = taskunit.TaskUnit(data='hello', processor=processor)
+    source = tu.serialize_method(tu.processor)
+    deserialized = taskunit.TaskUnit.deserialize(
+        tu.serialize(include_attrs=['processor']))
+    # The source of the compiled function can still be serialized.
+    assert deserialized.serialize_method(deserialized.processor) == source
+
+
+def test_sources_dropped():
+    cache = serialize.FunctionCache()
+    f = cache.load('f', 'def f(self):\n    return 1')
+    # Make serialize_method read the source instead of using the attribute.
+    del f.source
+    count = len(serialize._sources)
+    source = taskunit.TaskUnit().serialize_method(f)
+    assert source == 'def f(self):\n    return 1'
+    assert len(serialize._sources) == count + 1
+    # The source is only kept as long as the function.
+    del f
+    cache.functions.clear()
+    gc.collect()
+    assert len(serialize._sources) == count
+
+
+def test_function_cache_hit():
+    cache = serialize.FunctionCache()
+    source = 'def f(x):\n    return x + 1'
+    f = cache.load('f', source)
+    assert f(1) == 2
+    assert cache.load('f', source) is f
+    assert len(cache) == 1
+
+
+def test_function_cache_eviction():
+    cache = serialize.FunctionCache(max_size=2)
+    f = cache.load('f', 'def f():\n    return 1')
+    cache.load('g', 'def g():\n    return 2')
+    # Touch f so that g is the least recently used.
+    cache.load('f', 'def f():\n    return 1')
+    cache.load('h', 'def h():\n    return 3')
+    assert len(cache) == 2
+    assert cache.load('f', 'def f():\n    return 1') is f
+    assert [key[1] for key in cache.functions] == ['h', 'f']
+
+
+def test_function_cache_evicted_source():
+    cache = serialize.FunctionCache(max_size=1)
+    f = cache.load('f', 'def f():\n    return 1')
+    cache.load('g', 'def g():\n    return 2')
+    # f was evicted but is still in use, so its source is still there.
+    assert inspect.getsource(f) == 'def f():\n    return 1'
+    filename = f.__code__.co_filename
+    del f
+    gc.collect()
+    assert filename not in linecache.cache
+
+
+def test_function_cache_module_globals():
+    cache = serialize.FunctionCache()
+    f = cache.load('f', 'def f():\n    return taskunit.TaskUnit',
+                   module='job')
+    assert f() is taskunit.TaskUnit
+
+
+def test_function_cache_dump(tmpdir):
+    cache = serialize.FunctionCache(dump_dir=str(tmpdir))
+    cache.load('f', 'def f():\n    return 1')
+    assert len(os.listdir(str(tmpdir))) == 1
+
+
+def test_schema_new_attribute():
+    tu = taskunit.TaskUnit(id='1', data='hello', processor=processor)
+    assert 'extra' not in tu.serialize()['attrs']
+    tu.extra = 1
+    assert tu.serialize()['attrs']['extra'] == 1
+
+
+def test_schema_include_exclude():
+    tu = taskunit.TaskUnit(id='1', data='hello', processor=processor)
+    assert set(tu.serialize(include_attrs=['id', 'data'])['attrs']) == {
+        'id', 'data'}
+    attrs = tu.serialize(exclude_attrs=['processor'])['attrs']
+    assert 'processor' not in attrs
+    assert attrs['data'] == 'hello'
+
+
+def test_job_roundtrip():
+    j = job.Job(input_data='hello\nworld', processor=processor)
+    serialized = j.serialize(json_encode=True)
+    deserialized = job.Job.deserialize(serialized)
+    assert deserialized.input_data == 'hello\nworld'
+    assert isinstance(deserialized.splitter, job.Splitter)
+    assert isinstance(deserialized.combiner, job.Combiner)
+    assert deserialized.serialize(json_encode=True) == serialized
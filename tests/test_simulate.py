@@ -0,0 +1,61 @@
+import schedule
+import simulate
+
+
+def run(workload, speeds, scheduler=None, batch=False, failure_rates=(),
+        max_inflight=64):
+    cluster = simulate.Cluster(speeds, failure_rates,
+                               max_inflight=max_inflight)
+    scheduler = scheduler or schedule.MinMakespan()
+    simulator = simulate.Simulator(workload, cluster, scheduler, batch=batch)
+
+    return simulator.run()
+
+
+def test_run():
+    workload = simulate.Workload.synthetic(200, seed=1)
+    result = run(workload, [1, 2])
+    assert len(result.latencies) == 200
+    total = sum(size for size, _, _ in workload.units)
+    # The machines can't get the work done any faster than together.
+    assert result.makespan >= total / 3
+    assert 0 < result.utilization() <= 1
+    assert result.mean_latency() <= result.percentile_latency(99)
+    assert result.decisions == 200
+
+
+def test_batch():
+    # Online (with little credit), the large unit at the end waits for the
+    # small ones before it.
+    workload = simulate.Workload([(1, 0, 1)] * 4 + [(4, 0, 4)])
+    assert run(workload, [1, 1], max_inflight=1).makespan == 6
+    assert run(workload, [1, 1], batch=True).makespan == 4
+
+
+def test_speeds():
+    workload = simulate.Workload([(1, 0, 1)] * 30)
+    fast = run(workload, [1, 4], max_inflight=1)
+    even = run(workload, [1, 4], scheduler=schedule.RoundRobin(),
+               max_inflight=64)
+    assert fast.makespan < even.makespan
+
+
+def test_failures():
+    workload = simulate.Workload([(1, 0, 1)] * 20)
+    result = run(workload, [1, 1], failure_rates=[1, 0])
+    assert len(result.latencies) == 20
+    assert result.failures > 0
+
+
+def test_poisson():
+    workload = simulate.Workload.synthetic(100, arrivals='poisson', rate=1)
+    assert not workload.known()
+    result = run(workload, [1, 1])
+    assert len(result.latencies) == 100
+
+
+def test_load(tmp_path):
+    path = tmp_path / 'workload.jsonl'
+    path.write_text('{"size": 2}\n{"size": 1, "arrival": 3, "estimate": 2}\n')
+    workload = simulate.Workload.load(str(path))
+    assert workload.units == [(2, 0, 2), (1, 3, 2)]
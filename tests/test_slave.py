@@ -0,0 +1,130 @@
+import json
+import socket
+
+import messenger
+import slave
+from tests.test_master import StubMessenger
+
+
+def make_slave(monkeypatch, tmp_path, **config):
+    '''Get a slave with a StubMessenger and the given config values.
+    '''
+    monkeypatch.setattr(messenger, 'AsyncZMQMessenger', StubMessenger)
+    monkeypatch.setattr(socket, 'gethostname', lambda: 'test')
+    monkeypatch.setattr(socket, 'getfqdn', lambda: 'localhost')
+    config.setdefault('masters', [{'ip': '127.0.0.1', 'hostname': 'master',
+                                   'port': 34410}])
+    (tmp_path / 'config').mkdir()
+    (tmp_path / 'config' / 'test-slave-config.json').write_text(
+        json.dumps(config))
+    monkeypatch.chdir(tmp_path)
+
+    return slave.Slave(34411, workers=1)
+
+
+def test_failed_to_combine(monkeypatch, tmp_path):
+    s = make_slave(monkeypatch, tmp_path)
+    try:
+        digest = s.code.add(
+            'def failing_accumulate(self, result):\n'
+            '    raise ValueError(result)\n')
+        result = {'class': 'taskunit.TaskUnit',
+                  'attrs': {'id': 't', 'job_id': 'j', 'state': 'COMPLETED',
+                            'result': 1, 'combiner_digest': digest}}
+        # Sent back as is, but as BAILED.
+        assert not s.add_to_partial(('127.0.0.1', 34410), result)
+    finally:
+        s.executor.shutdown()
+
+    assert result['attrs']['state'] == 'BAILED'
+    assert result['attrs']['result'] is None
+    assert s.partials == {}
+
+
+def test_release_taskunits_of_jobs(monkeypatch, tmp_path):
+    s = make_slave(monkeypatch, tmp_path)
+    s.executor.shutdown()
+    master, other = ('127.0.0.1', 34410), ('127.0.0.1', 34412)
+    for address, job_id, tu_id in [(master, 'a', '0'), (master, 'b', '1'),
+                                   (other, 'a', '2'), (master, 'a', '3'),
+                                   (master, 'b', '4')]:
+        s.task_q.append((address, {'class': 'taskunit.TaskUnit',
+                                   'attrs': {'id': tu_id, 'job_id': job_id}}))
+
+    s.release_taskunits(master, 3, jobs=['a'])
+    # Only the master's taskunits of job a, the last ones first.
+    assert s.messenger.messages == [
+        (master, {'class': 'RELEASE', 'taskunits': [['a', '3'], ['a', '0']]})]
+    assert [serialized['attrs']['id'] for _, serialized in s.task_q] == [
+        '1', '2', '4']
+
+
+def test_request_work(monkeypatch, tmp_path):
+    s = make_slave(monkeypatch, tmp_path, prefetch=4)
+    s.executor.shutdown()
+    master = ('127.0.0.1', 34410)
+    s.pull_masters.add(master)
+
+    s.request_work()
+    assert s.messenger.messages == [(master, {'class': 'WORK', 'count': 4})]
+    # Not again until fewer than half of prefetch are asked for or queued.
+    s.request_work()
+    assert len(s.messenger.messages) == 1
+    for tu_id in '012':
+        s.requested[master] -= 1
+        s.task_q.append((master, {'class': 'taskunit.TaskUnit',
+                                  'attrs': {'id': tu_id, 'job_id': 'a'}}))
+    s.request_work()
+    assert len(s.messenger.messages) == 1
+    s.task_q.popleft()
+    s.request_work()
+    assert len(s.messenger.messages) == 1
+    s.task_q.popleft()
+    # Topped back up to prefetch.
+    s.request_work()
+    assert s.messenger.messages[-1] == (master, {'class': 'WORK',
+                                                 'count': 2})
+
+
+def test_release_taskunits(monkeypatch, tmp_path):
+    s = make_slave(monkeypatch, tmp_path)
+    s.executor.shutdown()
+    master = ('127.0.0.1', 34410)
+    for tu_id in '012':
+        s.task_q.append((master, {'class': 'taskunit.TaskUnit',
+                                  'attrs': {'id': tu_id, 'job_id': 'a'}}))
+
+    s.release_taskunits(master, 2)
+    # The ones that would have been run last.
+    assert s.messenger.messages == [
+        (master, {'class': 'RELEASE', 'taskunits': [['a', '2'], ['a', '1']]})]
+    assert [serialized['attrs']['id'] for _, serialized in s.task_q] == ['0']
+
+
+def test_fetch_blob(monkeypatch, tmp_path):
+    s = make_slave(monkeypatch, tmp_path, blob_cache_bytes=150,
+                   blob_spill_dir=None)
+    s.executor.shutdown()
+    submitted = []
+    monkeypatch.setattr(s.executor, 'submit',
+                        lambda serialized, address, source:
+                        submitted.append(serialized['attrs']['id']))
+    master = ('127.0.0.1', 34410)
+    first = s.blobs.put(b'a' * 100)
+    # The first blob is dropped to make room for the second one.
+    s.add_blob(s.blobs.compute_digest(b'b' * 100), b'b' * 100)
+    assert first not in s.blobs
+
+    for tu_id in '01':
+        s.task_q.append((master, {'class': 'taskunit.TaskUnit',
+                                  'attrs': {'id': tu_id, 'job_id': 'a',
+                                            'blob_digest': first}}))
+    s.run_taskunits()
+    # Asked for once, for both of the taskunits waiting for it.
+    assert s.messenger.messages == [(master, {'class': 'FETCH',
+                                              'digests': [first]})]
+    assert submitted == []
+
+    s.add_blob(first, b'a' * 100)
+    assert submitted == ['0', '1']
+    assert s.fetching == {}
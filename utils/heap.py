@@ -1,3 +1,5 @@
+import heapq
+import itertools
 import math
 
 
@@ -166,3 +168,111 @@ class Heap(object):
                     lchild_index = None
                 if rchild_index >= len(items):
                     rchild_index = None
+
+
+class IndexedHeap(object):
+    '''
+    A min heap of items with priorities, backed by ``heapq``.
+
+    Pushing an item returns a handle to it. The handle can be used to change
+    the priority of the item (or remove it) in O(log n), e.g. to update the
+    load of a machine in place.
+
+    The priorities are compared directly (there's no key function) so
+    priorities should be numbers or tuples of numbers. Ties are broken by
+    the order the items were pushed in.
+    '''
+    # Index of the fields of an entry (and handle). An entry is a list so
+    # that heapq compares entries by (priority, count) in C.
+    PRIORITY, COUNT, ITEM, VALID = range(4)
+
+    def __init__(self, items=()):
+        '''
+        Initialize a heap of items.
+
+        :type items: iterable
+        :param items: (item, priority) pairs to be heapified.
+        '''
+        self.counter = itertools.count()
+        self.entries = [[priority, next(self.counter), item, True]
+                        for item, priority in items]
+        heapq.heapify(self.entries)
+        # Number of entries in the heap that were updated or removed.
+        self.stale = 0
+
+    def __len__(self):
+        return len(self.entries) - self.stale
+
+    def size(self):
+        '''Get the number of items in the heap.
+        '''
+        return len(self)
+
+    def push(self, item, priority):
+        '''Push the item with the priority into the heap.
+
+        :returns: A handle to the item.
+        '''
+        entry = [priority, next(self.counter), item, True]
+        heapq.heappush(self.entries, entry)
+
+        return entry
+
+    def pop(self):
+        '''Remove the item with the lowest priority and return it.
+
+        :returns: (item, priority)
+        '''
+        entries = self.entries
+        while entries:
+            entry = heapq.heappop(entries)
+            if entry[self.VALID]:
+                entry[self.VALID] = False
+                return (entry[self.ITEM], entry[self.PRIORITY])
+            self.stale -= 1
+        raise IndexError('pop from an empty heap')
+
+    def peek(self):
+        '''Get the item with the lowest priority without removing it.
+
+        :returns: (item, priority)
+        '''
+        entries = self.entries
+        while entries and not entries[0][self.VALID]:
+            heapq.heappop(entries)
+            self.stale -= 1
+        if not entries:
+            raise IndexError('peek at an empty heap')
+
+        return (entries[0][self.ITEM], entries[0][self.PRIORITY])
+
+    def priority(self, handle):
+        '''Get the priority of the item with the handle.
+        '''
+        return handle[self.PRIORITY]
+
+    def update(self, handle, priority):
+        '''Change the priority of the item with the handle.
+
+        :returns: The new handle to the item. The old one can't be used
+        anymore.
+        '''
+        self.remove(handle)
+
+        return self.push(handle[self.ITEM], priority)
+
+    def remove(self, handle):
+        '''Remove the item with the handle from the heap.
+        '''
+        if not handle[self.VALID]:
+            raise KeyError('the item is not in the heap')
+        # The entry is left in the heap and skipped when it gets to the top.
+        handle[self.VALID] = False
+        self.stale += 1
+        if self.stale > len(self.entries) // 2:
+            self.entries = [entry for entry in self.entries
+                            if entry[self.VALID]]
+            heapq.heapify(self.entries)
+            self.stale = 0
+
+        return